@@ -1,7 +1,7 @@
 """
 聊天 API
 """
-from fastapi import APIRouter, Depends, HTTPException, status, WebSocket, WebSocketDisconnect
+from fastapi import APIRouter, Depends, HTTPException, Query, Response, status, WebSocket, WebSocketDisconnect
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from sqlalchemy.orm import Session
 from typing import List, Optional
@@ -15,6 +15,9 @@ from app.schemas.chat import ChatRequest, ChatResponse
 router = APIRouter()
 security = HTTPBearer()
 
+# 会话列表单页最大条数
+_MAX_SESSION_PAGE_SIZE = 100
+
 @router.post("/", response_model=ChatResponse)
 async def chat(
     request: ChatRequest,
@@ -41,10 +44,13 @@ async def chat(
 
 @router.get("/sessions")
 async def get_chat_sessions(
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=_MAX_SESSION_PAGE_SIZE),
+    offset: int = Query(0, ge=0),
     credentials: HTTPAuthorizationCredentials = Depends(security),
     db: Session = Depends(get_db)
 ):
-    """获取聊天会话列表"""
+    """获取聊天会话列表（会话总数通过 X-Total-Count 响应头返回）"""
     auth_service = AuthService(db)
     chat_service = ChatService(db)
     
@@ -52,7 +58,14 @@ async def get_chat_sessions(
     current_user = auth_service.get_current_user(credentials.credentials)
     
     # 获取用户的聊天会话
-    sessions = chat_service.get_user_sessions(current_user.id)
+    sessions = chat_service.get_user_sessions(current_user.id, limit=limit, offset=offset)
+    
+    # 未分页时列表即为全部会话，无需额外计数
+    if limit is None and not offset:
+        total = len(sessions)
+    else:
+        total = chat_service.count_user_sessions(current_user.id)
+    response.headers["X-Total-Count"] = str(total)
     return sessions
 
 @router.post("/sessions")
@@ -58,6 +58,8 @@ class PipelineConfigRequest(BaseModel):
     enable_hybrid_retrieval: bool = True
     fusion_strategy: FusionStrategy = FusionStrategy.WEIGHTED_SUM
     retrieval_weights: Optional[Dict[str, float]] = None
+    enable_result_cache: bool = False
+    semantic_cache_threshold: Optional[float] = None
     enable_reranking: bool = True
     rerank_strategy: RerankStrategy = RerankStrategy.HYBRID
     rerank_top_k: int = 20
@@ -157,6 +159,8 @@ async def update_pipeline_config(
             enable_hybrid_retrieval=config.enable_hybrid_retrieval,
             fusion_strategy=config.fusion_strategy,
             retrieval_weights=config.retrieval_weights,
+            enable_result_cache=config.enable_result_cache,
+            semantic_cache_threshold=config.semantic_cache_threshold,
             enable_reranking=config.enable_reranking,
             rerank_strategy=config.rerank_strategy,
             rerank_top_k=config.rerank_top_k,
@@ -197,6 +201,8 @@ async def get_pipeline_config(
             "enable_hybrid_retrieval": config.enable_hybrid_retrieval,
             "fusion_strategy": config.fusion_strategy.value,
             "retrieval_weights": config.retrieval_weights,
+            "enable_result_cache": config.enable_result_cache,
+            "semantic_cache_threshold": config.semantic_cache_threshold,
             "enable_reranking": config.enable_reranking,
             "rerank_strategy": config.rerank_strategy.value,
             "rerank_top_k": config.rerank_top_k,
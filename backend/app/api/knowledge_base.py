@@ -5,7 +5,9 @@ from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File,
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from sqlalchemy.orm import Session
 from typing import List, Optional
+import os
 
+from app.core.config import settings
 from app.core.database import get_db
 from app.services.auth_service import AuthService
 from app.services.knowledge_base_service import KnowledgeBaseService
@@ -15,6 +17,19 @@ from app.services.text_splitter import SmartConfigManager
 router = APIRouter()
 security = HTTPBearer()
 
+def _check_upload_size(file: UploadFile) -> None:
+    """上传文件超过 MAX_FILE_SIZE 时返回 413"""
+    size = file.size
+    if size is None:
+        file.file.seek(0, os.SEEK_END)
+        size = file.file.tell()
+        file.file.seek(0)
+    if size > settings.MAX_FILE_SIZE:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"文件超过大小限制: {settings.MAX_FILE_SIZE} 字节"
+        )
+
 @router.get("/")
 async def get_knowledge_bases(
     credentials: HTTPAuthorizationCredentials = Depends(security),
@@ -149,6 +164,7 @@ async def upload_document(
     
     # 验证当前用户
     current_user = auth_service.get_current_user(credentials.credentials)
+    _check_upload_size(file)
     
     # 上传文档
     result = await kb_service.upload_document(
@@ -179,6 +195,7 @@ async def upload_image(
     
     # 验证当前用户
     current_user = auth_service.get_current_user(credentials.credentials)
+    _check_upload_size(file)
     
     # 上传图片
     result = await kb_service.upload_image(
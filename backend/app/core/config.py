@@ -27,6 +27,7 @@ class Settings(BaseSettings):
     JWT_SECRET_KEY: str = "your-secret-key-change-in-production"
     JWT_ALGORITHM: str = "HS256"
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 30
+    BCRYPT_ROUNDS: int = 10
     
     # 文件上传配置
     MAX_FILE_SIZE: int = 104857600  # 100MB
@@ -36,6 +37,7 @@ class Settings(BaseSettings):
     # 缓存配置
     REDIS_URL: Optional[str] = None
     CACHE_TTL: int = 3600  # 1小时
+    EMBEDDING_CACHE_PATH: Optional[str] = None  # 磁盘向量缓存文件（SQLite），为空时仅使用内存缓存
     
     # 日志配置
     LOG_LEVEL: str = "INFO"
@@ -48,6 +50,7 @@ class Settings(BaseSettings):
     # 向量模型配置
     TEXT_EMBEDDING_MODEL: str = "text-embedding-ada-002"
     TEXT_EMBEDDING_DIMENSION: int = 1536
+    EMBEDDING_HTTP_TIMEOUT: int = 300  # 向量接口请求总超时（秒）
     IMAGE_EMBEDDING_MODEL: str = "clip-vit-base-patch32"
     IMAGE_EMBEDDING_DIMENSION: int = 512
     
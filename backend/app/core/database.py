@@ -3,7 +3,7 @@
 """
 from sqlalchemy import create_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
 from sqlalchemy.pool import StaticPool
 from app.core.config import settings
 
@@ -21,6 +21,19 @@ SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 # 创建基础模型类
 Base = declarative_base()
 
+def commit_without_expire(db: Session) -> None:
+    """提交当前事务，但不使会话中的对象过期
+    
+    用于刚写入、随后只读取已加载字段（如 INSERT 时回填的主键）的对象，
+    省去提交后 refresh() 或访问属性触发的再次查询；会话的默认行为不变。
+    """
+    previous = getattr(db, "expire_on_commit", True)
+    db.expire_on_commit = False
+    try:
+        db.commit()
+    finally:
+        db.expire_on_commit = previous
+
 def get_db():
     """获取数据库会话"""
     db = SessionLocal()
@@ -10,6 +10,7 @@ import logging
 from app.core.config import settings
 from app.api import router
 from app.plugins.init_plugins import init_plugins
+from app.services.embedding_router import close_http_session, close_embedding_cache
 
 # 配置日志
 logging.basicConfig(level=logging.INFO)
@@ -31,6 +32,7 @@ app.add_middleware(
     allow_credentials=settings.CORS_ALLOW_CREDENTIALS,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Total-Count"],
 )
 
 # 挂载静态文件
@@ -51,6 +53,14 @@ async def startup_event():
     else:
         logger.error("插件系统初始化失败")
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """应用关闭事件"""
+    # 关闭 Embedding 服务共享的 HTTP 连接池
+    await close_http_session()
+    close_embedding_cache()
+    logger.info("MetaBox API 已关闭")
+
 # 健康检查端点
 @app.get("/health")
 async def health_check():
@@ -312,27 +312,31 @@ class AgentService:
         # 简单的回答生成逻辑
         # 实际项目中应该使用LLM生成更智能的回答
         
-        response_parts = [f"任务: {task}"]
-        response_parts.append(f"执行了 {len(reasoning_steps)} 个推理步骤:")
-        
-        for step in reasoning_steps:
-            response_parts.append(f"- 步骤 {step['step']}: {step['reasoning']}")
-        
-        if results:
-            response_parts.append("执行结果:")
+        def lines():
+            yield f"任务: {task}"
+            yield f"执行了 {len(reasoning_steps)} 个推理步骤:"
+            
+            for step in reasoning_steps:
+                yield f"- 步骤 {step['step']}: {step['reasoning']}"
+            
+            if not results:
+                return
+            
+            yield "执行结果:"
             for result in results:
+                outcome = result["result"]
                 if result["type"] == "knowledge_search":
-                    if result["result"]["success"]:
-                        response_parts.append(f"- 知识库搜索: 找到 {len(result['result']['results'])} 条相关结果")
+                    if outcome["success"]:
+                        yield f"- 知识库搜索: 找到 {len(outcome['results'])} 条相关结果"
                     else:
-                        response_parts.append(f"- 知识库搜索: {result['result']['error']}")
+                        yield f"- 知识库搜索: {outcome['error']}"
                 elif result["type"] == "plugin_call":
-                    if result["result"]["success"]:
-                        response_parts.append(f"- 插件调用: {result['result']['result']}")
+                    if outcome["success"]:
+                        yield f"- 插件调用: {outcome['result']}"
                     else:
-                        response_parts.append(f"- 插件调用: {result['result']['error']}")
+                        yield f"- 插件调用: {outcome['error']}"
         
-        return "\n".join(response_parts)
+        return "\n".join(lines())
     
     def _extract_plugin_args(self, task: str, plugin_name: str) -> Dict[str, Any]:
         """提取插件参数"""
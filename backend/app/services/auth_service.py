@@ -1,18 +1,77 @@
 """
 认证服务
 """
+from sqlalchemy import func
 from sqlalchemy.orm import Session
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Optional, Tuple
+import hashlib
+import hmac
+import os
+import threading
+import time
+import uuid
+from functools import lru_cache
 import jwt
+from cachetools import TTLCache
 from passlib.context import CryptContext
 
 from app.core.config import settings
+from app.core.database import commit_without_expire
 from app.models.user import User
 from app.schemas.auth import UserRegister
 
 # 密码加密上下文
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# 新哈希使用配置的轮数；低于该轮数的旧哈希在用户下次成功登录时重新生成，
+# 轮数更高的已有哈希保持不变，不会在登录时降级
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__rounds=settings.BCRYPT_ROUNDS,
+    bcrypt__min_rounds=settings.BCRYPT_ROUNDS
+)
+
+# 用户不存在时用于比对的哈希，保证登录耗时与用户是否存在无关
+_DUMMY_HASH = pwd_context.hash("metabox-dummy-password")
+
+def _prepare_jwt_key(key: str):
+    """按签名算法预先解析密钥，避免每次签发/校验时重复解析"""
+    try:
+        algorithm = jwt.algorithms.get_default_algorithms()[settings.JWT_ALGORITHM]
+    except (AttributeError, KeyError):
+        return key
+    return algorithm.prepare_key(key)
+
+
+_JWT_KEY = _prepare_jwt_key(settings.JWT_SECRET_KEY)
+
+@lru_cache(maxsize=4096)
+def _parse_uuid(value: str) -> uuid.UUID:
+    """解析用户ID（非法ID抛出 ValueError，异常不会被缓存）"""
+    return uuid.UUID(value)
+
+
+# 令牌解码结果缓存：键为令牌摘要（不保存原始令牌），值为 (用户ID, 缓存失效时间)
+_TOKEN_CACHE_TTL = min(30, settings.ACCESS_TOKEN_EXPIRE_MINUTES * 60)
+_token_cache: TTLCache = TTLCache(maxsize=10000, ttl=_TOKEN_CACHE_TTL)
+_token_cache_lock = threading.Lock()
+
+
+def _token_cache_key(token: str) -> str:
+    """计算令牌缓存键"""
+    return hashlib.sha256(token.encode()).hexdigest()[:32]
+
+# 密码校验结果缓存：值为校验通过时的密码哈希，密码变更后旧条目自然失效
+_password_cache: TTLCache = TTLCache(maxsize=1024, ttl=60)
+_password_cache_lock = threading.Lock()
+# 进程级随机密钥，缓存键中不出现可离线比对的密码摘要
+_PASSWORD_CACHE_SECRET = os.urandom(32)
+
+
+def _password_cache_key(username: str, password: str) -> str:
+    """计算密码校验缓存键"""
+    digest = hmac.new(_PASSWORD_CACHE_SECRET, password.encode(), hashlib.sha256).hexdigest()
+    return f"{username}:{digest}"
 
 class AuthService:
     """认证服务类"""
@@ -38,15 +97,35 @@ class AuthService:
     
     def get_user_by_id(self, user_id: str) -> Optional[User]:
         """根据ID获取用户"""
-        return self.db.query(User).filter(User.id == user_id).first()
+        try:
+            parsed_id = _parse_uuid(str(user_id))
+        except ValueError:
+            return None
+        return self.db.query(User).filter(User.id == parsed_id).first()
     
     def authenticate_user(self, username: str, password: str) -> Optional[User]:
         """验证用户凭据"""
         user = self.get_user_by_username(username)
-        if not user:
-            return None
-        if not self.verify_password(password, user.password_hash):
+        user_exists = user is not None
+        
+        # 相同凭据在短时间内重复登录时跳过 bcrypt 计算
+        cache_key = _password_cache_key(username, password)
+        if user_exists:
+            with _password_cache_lock:
+                cached_hash = _password_cache.get(cache_key)
+            if cached_hash is not None and hmac.compare_digest(cached_hash, user.password_hash):
+                return user
+        
+        # 无论用户是否存在都执行一次完整的哈希比对，避免时序侧信道
+        target_hash = user.password_hash if user_exists else _DUMMY_HASH
+        verified, new_hash = pwd_context.verify_and_update(password, target_hash)
+        if not (user_exists and verified):
             return None
+        if new_hash is not None:
+            user.password_hash = new_hash
+            self.db.commit()
+        with _password_cache_lock:
+            _password_cache[cache_key] = user.password_hash
         return user
     
     def create_user(self, user_data: UserRegister) -> User:
@@ -62,8 +141,8 @@ class AuthService:
         )
         
         self.db.add(user)
-        self.db.commit()
-        self.db.refresh(user)
+        # 主键在插入时回填，提交后无需 refresh() 再次查询
+        commit_without_expire(self.db)
         
         return user
     
@@ -78,18 +157,26 @@ class AuthService:
         
         encoded_jwt = jwt.encode(
             to_encode, 
-            settings.JWT_SECRET_KEY, 
+            _JWT_KEY, 
             algorithm=settings.JWT_ALGORITHM
         )
         
         return encoded_jwt
     
-    def get_current_user(self, token: str) -> User:
-        """从令牌获取当前用户"""
+    def _decode_token(self, token: str) -> str:
+        """解码令牌并返回用户ID，验证通过的结果会被短暂缓存"""
+        cache_key = _token_cache_key(token)
+        now = time.time()
+        
+        with _token_cache_lock:
+            cached: Optional[Tuple[str, float]] = _token_cache.get(cache_key)
+        if cached is not None and cached[1] > now:
+            return cached[0]
+        
         try:
             payload = jwt.decode(
                 token, 
-                settings.JWT_SECRET_KEY, 
+                _JWT_KEY, 
                 algorithms=[settings.JWT_ALGORITHM]
             )
             user_id = payload.get("sub")
@@ -102,6 +189,19 @@ class AuthService:
         except jwt.JWTError:
             raise ValueError("无效的令牌")
         
+        # 缓存时间不超过令牌自身的剩余有效期；无效令牌不会走到这里
+        expires_at = now + _TOKEN_CACHE_TTL
+        if payload.get("exp") is not None:
+            expires_at = min(expires_at, float(payload["exp"]))
+        with _token_cache_lock:
+            _token_cache[cache_key] = (user_id, expires_at)
+        
+        return user_id
+    
+    def get_current_user(self, token: str) -> User:
+        """从令牌获取当前用户"""
+        user_id = self._decode_token(token)
+        
         user = self.get_user_by_id(user_id)
         if user is None:
             raise ValueError("用户不存在")
@@ -116,7 +216,7 @@ class AuthService:
         
         user.username = username
         user.email = email
-        user.updated_at = datetime.utcnow()
+        user.updated_at = func.now()
         
         self.db.commit()
         return True
@@ -128,7 +228,7 @@ class AuthService:
             return False
         
         user.password_hash = self.get_password_hash(new_password)
-        user.updated_at = datetime.utcnow()
+        user.updated_at = func.now()
         
         self.db.commit()
         return True 
\ No newline at end of file
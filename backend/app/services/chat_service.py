@@ -1,20 +1,65 @@
 """
 聊天服务
 """
+from sqlalchemy import case, func
 from sqlalchemy.orm import Session
-from typing import List, Optional, Dict, Any, AsyncGenerator
+from typing import List, Optional, Dict, Any, AsyncGenerator, Iterator, Tuple
 from datetime import datetime
 import asyncio
 import logging
+import re
+import threading
+
+from cachetools import TTLCache
 
 from app.models.chat import ChatSession, ChatMessage
 from app.models.knowledge_base import KnowledgeBaseChunk as TextChunk, KnowledgeBaseImage as ImageVector
 from app.schemas.chat import ChatResponse
 from app.services.vector_service import VectorService
 from app.core.config import settings
+from app.core.database import commit_without_expire
 
 logger = logging.getLogger(__name__)
 
+# 会话权限检查缓存：键为 (会话ID, 用户ID)，只缓存校验通过的结果
+_session_access_cache: TTLCache = TTLCache(maxsize=4096, ttl=60)
+_session_access_lock = threading.Lock()
+
+_ANSWER_CHUNK_RE = re.compile(r"\S+\s*")
+
+# 回答模板
+_RAG_ANSWER_TEMPLATE = """基于知识库内容，为您提供以下回答：
+
+问题：{query}
+
+{context}
+
+回答：根据检索到的相关内容，{query} 的相关信息如上所示。"""
+_KEYWORD_ANSWER_TEMPLATE = """基于知识库内容，为您提供以下回答：
+
+问题：{query}
+
+相关参考：
+{context}
+
+回答：根据检索到的相关内容，{query} 的相关信息如上所示。如需更详细的解答，请提供更具体的问题。"""
+_BEST_MATCH_TEMPLATE = "\n\n最相关的信息：{content}..."
+_NO_KB_TEMPLATE = "这是对 '{query}' 的回复。请先选择知识库以获取更准确的答案。"
+_EMPTY_KB_TEMPLATE = "这是对 '{query}' 的回复。所选知识库暂无内容，请先上传文档。"
+_NO_MATCH_TEMPLATE = "抱歉，在知识库中未找到与 '{query}' 直接相关的内容。请尝试使用其他关键词或检查知识库是否包含相关信息。"
+_SESSION_NAME_TIME_FORMAT = "%Y-%m-%d %H:%M"
+
+
+def _iter_answer_chunks(answer: str) -> Iterator[Tuple[str, bool]]:
+    """按词切分回答，逐个产出 (片段, 是否最后一个)"""
+    matches = _ANSWER_CHUNK_RE.finditer(answer)
+    previous = next(matches, None)
+    while previous is not None:
+        current = next(matches, None)
+        yield previous.group(), current is None
+        previous = current
+
+
 class ChatService:
     """聊天服务类"""
     
@@ -22,40 +67,87 @@ class ChatService:
         self.db = db
         self.vector_service = VectorService(db)
     
-    def get_user_sessions(self, user_id: str) -> List[ChatSession]:
-        """获取用户的聊天会话列表"""
-        return self.db.query(ChatSession).filter(
+    def get_user_sessions(
+        self,
+        user_id: str,
+        limit: Optional[int] = None,
+        offset: int = 0
+    ) -> List[ChatSession]:
+        """获取用户的聊天会话列表（支持分页）"""
+        query = self.db.query(ChatSession).filter(
+            ChatSession.user_id == user_id
+        ).order_by(ChatSession.updated_at.desc())
+        if offset:
+            query = query.offset(offset)
+        if limit is not None:
+            query = query.limit(limit)
+        return query.all()
+    
+    def count_user_sessions(self, user_id: str) -> int:
+        """统计用户的聊天会话数量（不加载会话对象）"""
+        return self.db.query(func.count(ChatSession.id)).filter(
             ChatSession.user_id == user_id
-        ).order_by(ChatSession.updated_at.desc()).all()
+        ).scalar() or 0
     
     def get_session_by_id(self, session_id: str, user_id: str) -> Optional[ChatSession]:
         """根据ID获取会话（检查权限）"""
-        return self.db.query(ChatSession).filter(
+        session = self.db.query(ChatSession).filter(
             ChatSession.id == session_id,
             ChatSession.user_id == user_id
         ).first()
+        if session:
+            with _session_access_lock:
+                _session_access_cache[(str(session_id), str(user_id))] = True
+        return session
     
-    def get_session_messages(self, session_id: str, user_id: str) -> List[ChatMessage]:
-        """获取会话消息"""
-        # 先检查权限
+    def has_session_access(self, session_id: str, user_id: str) -> bool:
+        """检查用户是否有权访问会话，校验通过的结果会被短暂缓存"""
+        cache_key = (str(session_id), str(user_id))
+        with _session_access_lock:
+            if _session_access_cache.get(cache_key):
+                return True
+        
+        found = self.db.query(ChatSession.id).filter(
+            ChatSession.id == session_id,
+            ChatSession.user_id == user_id
+        ).first() is not None
+        if found:
+            with _session_access_lock:
+                _session_access_cache[cache_key] = True
+        return found
+    
+    def delete_session(self, session_id: str, user_id: str) -> bool:
+        """删除会话"""
         session = self.get_session_by_id(session_id, user_id)
+        with _session_access_lock:
+            _session_access_cache.pop((str(session_id), str(user_id)), None)
         if not session:
-            return []
+            return False
         
-        return self.db.query(ChatMessage).filter(
-            ChatMessage.session_id == session_id
+        self.db.delete(session)
+        self.db.commit()
+        return True
+    
+    def get_session_messages(self, session_id: str, user_id: str) -> List[ChatMessage]:
+        """获取会话消息"""
+        # 通过关联会话表在同一查询中完成权限检查，无权限时返回空列表
+        return self.db.query(ChatMessage).join(
+            ChatSession, ChatSession.id == ChatMessage.session_id
+        ).filter(
+            ChatSession.id == session_id,
+            ChatSession.user_id == user_id
         ).order_by(ChatMessage.created_at).all()
     
     def create_session(self, user_id: str, name: Optional[str], kb_ids: Optional[List[str]]) -> ChatSession:
         """创建新的聊天会话"""
         session = ChatSession(
             user_id=user_id,
-            name=name or f"新对话 {datetime.now().strftime('%Y-%m-%d %H:%M')}",
+            name=name or f"新对话 {datetime.now().strftime(_SESSION_NAME_TIME_FORMAT)}",
             knowledge_base_ids=kb_ids or []
         )
         self.db.add(session)
-        self.db.commit()
-        self.db.refresh(session)
+        # 主键在插入时回填，提交后无需 refresh() 再次查询
+        commit_without_expire(self.db)
         return session
     
     async def process_chat(
@@ -68,42 +160,38 @@ class ChatService:
     ) -> ChatResponse:
         """处理聊天请求"""
         # 获取或创建会话
+        # 同步数据库调用放到线程池中执行，避免阻塞事件循环
         if session_id:
-            session = self.get_session_by_id(session_id, user_id)
-            if not session:
+            if not await asyncio.to_thread(self.has_session_access, session_id, user_id):
                 raise ValueError("会话不存在或无权限访问")
         else:
-            session = self.create_session(user_id, None, kb_ids)
+            session = await asyncio.to_thread(self.create_session, user_id, None, kb_ids)
+            session_id = session.id
         
-        # 保存用户消息
+        # 执行 RAG 检索
+        answer = await self._rag_search(message, kb_ids or [])
+        
+        # 用户消息与助手回复在同一事务中保存
         user_message = ChatMessage(
-            session_id=session.id,
+            session_id=session_id,
             role="user",
             content=message,
             message_type="text"
         )
-        self.db.add(user_message)
-        
-        # 执行 RAG 检索
-        answer = await self._rag_search(message, kb_ids or [])
-        
-        # 保存助手回复
         assistant_message = ChatMessage(
-            session_id=session.id,
+            session_id=session_id,
             role="assistant",
             content=answer,
             message_type="text"
         )
-        self.db.add(assistant_message)
+        self.db.add_all([user_message, assistant_message])
         
-        # 更新会话时间
-        session.updated_at = datetime.utcnow()
-        
-        self.db.commit()
+        # 更新会话时间并提交
+        await asyncio.to_thread(self._touch_session_and_commit, session_id)
         
         return ChatResponse(
             answer=answer,
-            session_id=str(session.id),
+            session_id=str(session_id),
             message_id=str(assistant_message.id)
         )
     
@@ -114,7 +202,7 @@ class ChatService:
         kb_ids: List[str]
     ) -> AsyncGenerator[Dict[str, Any], None]:
         """处理流式聊天请求"""
-        # 保存用户消息
+        # 先加入用户消息，与助手回复在同一事务中提交
         user_message = ChatMessage(
             session_id=session_id,
             role="user",
@@ -122,46 +210,47 @@ class ChatService:
             message_type="text"
         )
         self.db.add(user_message)
-        self.db.commit()
         
-        # 执行 RAG 检索并流式返回
-        answer = await self._rag_search(message, kb_ids)
-        
-        # 流式返回答案
-        words = answer.split()
-        for i, word in enumerate(words):
-            yield {
-                "type": "chunk",
-                "content": word + " ",
-                "is_end": i == len(words) - 1
-            }
-            await asyncio.sleep(0.1)  # 模拟流式效果
-        
-        # 保存助手回复
-        assistant_message = ChatMessage(
-            session_id=session_id,
-            role="assistant",
-            content=answer,
-            message_type="text"
-        )
-        self.db.add(assistant_message)
-        
-        # 更新会话时间
-        session = self.db.query(ChatSession).filter(ChatSession.id == session_id).first()
-        if session:
-            session.updated_at = datetime.utcnow()
-        
-        self.db.commit()
+        try:
+            # 执行 RAG 检索并流式返回
+            answer = await self._rag_search(message, kb_ids)
+            
+            # 流式返回答案
+            for chunk, is_last in _iter_answer_chunks(answer):
+                yield {
+                    "type": "chunk",
+                    "content": chunk,
+                    "is_end": is_last
+                }
+            
+            assistant_message = ChatMessage(
+                session_id=session_id,
+                role="assistant",
+                content=answer,
+                message_type="text"
+            )
+            self.db.add(assistant_message)
+        finally:
+            # 更新会话时间并提交（直接 UPDATE，无需先查询会话）；
+            # 客户端中途断开或检索出错时也会保存用户消息
+            await asyncio.to_thread(self._touch_session_and_commit, session_id)
         
         yield {
             "type": "complete",
             "message_id": str(assistant_message.id)
         }
     
+    def _touch_session_and_commit(self, session_id: str) -> None:
+        """更新会话时间并提交当前事务（提交后调用方仍需读取新消息的ID）"""
+        self.db.query(ChatSession).filter(
+            ChatSession.id == session_id
+        ).update({ChatSession.updated_at: func.now()}, synchronize_session=False)
+        commit_without_expire(self.db)
+    
     async def _rag_search(self, query: str, kb_ids: List[str]) -> str:
         """RAG 检索 - 使用向量化引擎"""
         if not kb_ids:
-            return f"这是对 '{query}' 的回复。请先选择知识库以获取更准确的答案。"
+            return _NO_KB_TEMPLATE.format(query=query)
         
         try:
             # 使用向量化服务进行混合搜索
@@ -175,7 +264,7 @@ class ChatService:
             image_results = search_results["image"]
             
             if not text_results and not image_results:
-                return f"抱歉，在知识库中未找到与 '{query}' 直接相关的内容。请尝试使用其他关键词或检查知识库是否包含相关信息。"
+                return _NO_MATCH_TEMPLATE.format(query=query)
             
             # 构建上下文
             context_parts = []
@@ -183,30 +272,25 @@ class ChatService:
             # 添加文本结果
             if text_results:
                 context_parts.append("相关文本内容：")
-                for i, result in enumerate(text_results[:3], 1):
-                    context_parts.append(f"{i}. {result['content'][:200]}...")
+                context_parts.extend(
+                    f"{i}. {result['content'][:200]}..."
+                    for i, result in enumerate(text_results[:3], 1)
+                )
             
             # 添加图片结果
             if image_results:
                 context_parts.append("\n相关图片：")
-                for i, result in enumerate(image_results[:2], 1):
-                    context_parts.append(f"{i}. {result['description']}")
-            
-            context = "\n".join(context_parts)
+                context_parts.extend(
+                    f"{i}. {result['description']}"
+                    for i, result in enumerate(image_results[:2], 1)
+                )
             
             # 构建回答
-            answer = f"""基于知识库内容，为您提供以下回答：
-
-问题：{query}
-
-{context}
-
-回答：根据检索到的相关内容，{query} 的相关信息如上所示。"""
+            answer = _RAG_ANSWER_TEMPLATE.format(query=query, context="\n".join(context_parts))
             
             # 如果有高相关性结果，提供更具体的回答
             if text_results and text_results[0]["score"] > 0.8:
-                best_match = text_results[0]["content"]
-                answer += f"\n\n最相关的信息：{best_match[:300]}..."
+                answer += _BEST_MATCH_TEMPLATE.format(content=text_results[0]["content"][:300])
             
             return answer
             
@@ -217,44 +301,48 @@ class ChatService:
     
     def _fallback_keyword_search(self, query: str, kb_ids: List[str]) -> str:
         """降级关键词搜索"""
-        # 获取知识库内容
-        chunks = []
-        for kb_id in kb_ids:
-            kb_chunks = self.db.query(TextChunk).filter(
-                TextChunk.knowledge_base_id == kb_id
-            ).all()
-            chunks.extend(kb_chunks)
-        
-        if not chunks:
-            return f"这是对 '{query}' 的回复。所选知识库暂无内容，请先上传文档。"
+        # 在数据库中完成匹配与排序，只取回前3个最相关的分块
+        top_contents = self._search_chunks_by_keywords(query, kb_ids, limit=3)
         
-        # 简单的关键词匹配
-        relevant_chunks = []
-        query_words = query.lower().split()
+        if not top_contents:
+            has_chunks = self.db.query(
+                self.db.query(TextChunk).filter(
+                    TextChunk.knowledge_base_id.in_(kb_ids)
+                ).exists()
+            ).scalar()
+            if not has_chunks:
+                return _EMPTY_KB_TEMPLATE.format(query=query)
+            return _NO_MATCH_TEMPLATE.format(query=query)
         
-        for chunk in chunks:
-            content_lower = chunk.content.lower()
-            score = sum(1 for word in query_words if word in content_lower)
-            if score > 0:
-                relevant_chunks.append((chunk, score))
+        # 构建基于检索结果的回答
+        return _KEYWORD_ANSWER_TEMPLATE.format(query=query, context="\n".join(top_contents))
+    
+    def _search_chunks_by_keywords(self, query: str, kb_ids: List[str], limit: int) -> List[str]:
+        """按关键词检索分块内容，优先使用 PostgreSQL 全文检索"""
+        base_query = self.db.query(TextChunk.content).filter(
+            TextChunk.knowledge_base_id.in_(kb_ids)
+        )
         
-        # 按相关性排序
-        relevant_chunks.sort(key=lambda x: x[1], reverse=True)
+        if self.db.bind is not None and self.db.bind.dialect.name == "postgresql":
+            # 全文匹配并按 ts_rank 排序，只取回前 limit 条
+            ts_vector = func.to_tsvector("simple", TextChunk.content)
+            ts_query = func.plainto_tsquery("simple", query)
+            rows = base_query.filter(
+                ts_vector.op("@@")(ts_query)
+            ).order_by(
+                func.ts_rank(ts_vector, ts_query).desc()
+            ).limit(limit).all()
+            if rows:
+                return [content for (content,) in rows]
         
-        if relevant_chunks:
-            # 构建基于检索结果的回答
-            top_chunks = relevant_chunks[:3]  # 取前3个最相关的分块
-            context = "\n".join([chunk.content for chunk, _ in top_chunks])
-            
-            answer = f"""基于知识库内容，为您提供以下回答：
-
-问题：{query}
-
-相关参考：
-{context}
-
-回答：根据检索到的相关内容，{query} 的相关信息如上所示。如需更详细的解答，请提供更具体的问题。"""
-        else:
-            answer = f"抱歉，在知识库中未找到与 '{query}' 直接相关的内容。请尝试使用其他关键词或检查知识库是否包含相关信息。"
+        # 全文检索不可用或无命中（如中文未分词）时，退化为大小写不敏感的子串匹配计分
+        query_words = query.lower().split()
+        if not query_words:
+            return []
         
-        return answer 
\ No newline at end of file
+        score = sum(
+            case((TextChunk.content.icontains(word, autoescape=True), 1), else_=0)
+            for word in query_words
+        )
+        rows = base_query.filter(score > 0).order_by(score.desc()).limit(limit).all()
+        return [content for (content,) in rows]
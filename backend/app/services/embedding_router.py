@@ -3,9 +3,15 @@ Embedding路由服务
 支持多模型选择和父子联合Embedding
 """
 import asyncio
+import hashlib
+import os
+import re
+import sqlite3
+import threading
 import aiohttp
 import numpy as np
-from typing import List, Optional, Dict, Any
+from collections import OrderedDict
+from typing import List, Optional, Dict, Any, Tuple
 import logging
 from enum import Enum
 
@@ -13,6 +19,262 @@ from app.core.config import settings
 
 logger = logging.getLogger(__name__)
 
+# 进程内共享的HTTP会话，复用连接池（DNS缓存、TCP/TLS长连接）
+_http_session: Optional[aiohttp.ClientSession] = None
+
+
+async def get_http_session() -> aiohttp.ClientSession:
+    """获取共享的HTTP会话（惰性创建）"""
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        _http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=100,
+                limit_per_host=32,
+                ttl_dns_cache=300,
+                keepalive_timeout=60
+            ),
+            timeout=aiohttp.ClientTimeout(total=settings.EMBEDDING_HTTP_TIMEOUT)
+        )
+    return _http_session
+
+
+# 精确匹配的向量缓存：键为 sha256(模型|文本)，按LRU淘汰
+_EMBEDDING_CACHE_SIZE = 50000
+# 缓存中的向量按行量化为 int8，值为 (量化向量, 缩放系数)
+_embedding_cache: "OrderedDict[bytes, Tuple[np.ndarray, float]]" = OrderedDict()
+
+
+def embedding_cache_key(text: str, model_name: str) -> bytes:
+    """计算向量缓存键（按模型名区分命名空间）"""
+    return hashlib.sha256(f"{model_name}|{text}".encode()).digest()
+
+
+def _embedding_cache_key(text: str, model: "EmbeddingModel") -> bytes:
+    """计算路由模型的向量缓存键"""
+    return embedding_cache_key(text, model.value)
+
+
+def quantize_embedding(embedding) -> Tuple[np.ndarray, float]:
+    """将向量按行对称量化为 int8
+    
+    scale = max(|v|) / 127，每个分量的重建误差不超过 scale / 2；
+    对归一化向量而言约为 0.004 以内。
+    """
+    vector = np.asarray(embedding, dtype=np.float32)
+    max_abs = float(np.max(np.abs(vector))) if vector.size else 0.0
+    if max_abs == 0.0:
+        return np.zeros(vector.shape, dtype=np.int8), 0.0
+    scale = max_abs / 127.0
+    quantized = np.clip(np.rint(vector / scale), -127, 127).astype(np.int8)
+    return quantized, scale
+
+
+def dequantize_embedding(quantized: np.ndarray, scale: float) -> np.ndarray:
+    """将 int8 量化向量还原为 float32"""
+    return quantized.astype(np.float32) * np.float32(scale)
+
+
+# 磁盘向量缓存（可选）：进程重启或发布后仍可复用已获取的向量
+_DISK_CACHE_SCHEMA_VERSION = 2
+_disk_cache_conn: Optional[sqlite3.Connection] = None
+_disk_cache_lock = threading.Lock()
+_disk_cache_failed = False
+
+
+def _disk_cache_enabled() -> bool:
+    """是否启用了磁盘缓存（未启用时无需切换到工作线程）"""
+    return bool(settings.EMBEDDING_CACHE_PATH) and not _disk_cache_failed
+
+
+def _get_disk_cache() -> Optional[sqlite3.Connection]:
+    """获取磁盘缓存连接（未配置 EMBEDDING_CACHE_PATH 时返回 None）
+    
+    连接在工作线程中使用，所有访问都通过 _disk_cache_lock 串行化。
+    """
+    if _disk_cache_conn is not None:
+        return _disk_cache_conn
+    if not _disk_cache_enabled():
+        return None
+    with _disk_cache_lock:
+        return _open_disk_cache()
+
+
+def _open_disk_cache() -> Optional[sqlite3.Connection]:
+    """打开并初始化磁盘缓存（调用方需持有 _disk_cache_lock）"""
+    global _disk_cache_conn, _disk_cache_failed
+    if _disk_cache_conn is not None or _disk_cache_failed:
+        return _disk_cache_conn
+    
+    try:
+        directory = os.path.dirname(settings.EMBEDDING_CACHE_PATH)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(settings.EMBEDDING_CACHE_PATH, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        # 结构版本变化时丢弃旧缓存
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version != _DISK_CACHE_SCHEMA_VERSION:
+            conn.execute("DROP TABLE IF EXISTS emb_cache")
+            conn.execute(f"PRAGMA user_version = {_DISK_CACHE_SCHEMA_VERSION}")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS emb_cache ("
+            "key BLOB PRIMARY KEY, model TEXT NOT NULL, "
+            "dim INTEGER NOT NULL, scale REAL NOT NULL, vector BLOB NOT NULL)"
+        )
+        conn.commit()
+        _disk_cache_conn = conn
+    except (sqlite3.Error, OSError) as e:
+        logger.warning(f"磁盘向量缓存不可用，仅使用内存缓存: {e}")
+        _disk_cache_failed = True
+    return _disk_cache_conn
+
+
+# 单条 IN 查询的最大键数（低于 SQLite 默认的变量数上限）
+_DISK_CACHE_QUERY_BATCH = 500
+
+
+def _load_disk_embeddings(keys: List[bytes]) -> Dict[bytes, Tuple[np.ndarray, float]]:
+    """从磁盘缓存批量读取量化向量，返回命中的 {键: (量化向量, 缩放系数)}"""
+    conn = _get_disk_cache()
+    if conn is None or not keys:
+        return {}
+    found = {}
+    try:
+        with _disk_cache_lock:
+            for start in range(0, len(keys), _DISK_CACHE_QUERY_BATCH):
+                batch = keys[start:start + _DISK_CACHE_QUERY_BATCH]
+                placeholders = ",".join("?" * len(batch))
+                rows = conn.execute(
+                    f"SELECT key, vector, scale FROM emb_cache WHERE key IN ({placeholders})",
+                    batch
+                ).fetchall()
+                for key, vector, scale in rows:
+                    found[key] = (np.frombuffer(vector, dtype=np.int8), scale)
+    except sqlite3.Error as e:
+        logger.warning(f"读取磁盘向量缓存失败: {e}")
+    return found
+
+
+def _store_disk_embeddings(items: List[tuple]) -> None:
+    """批量写入磁盘缓存，items 为 (键, 模型名, 量化向量, 缩放系数) 列表"""
+    conn = _get_disk_cache()
+    if conn is None or not items:
+        return
+    rows = [
+        (key, model, quantized.size, scale, quantized.tobytes())
+        for key, model, quantized, scale in items
+    ]
+    try:
+        with _disk_cache_lock:
+            conn.executemany(
+                "INSERT OR REPLACE INTO emb_cache (key, model, dim, scale, vector) "
+                "VALUES (?, ?, ?, ?, ?)",
+                rows
+            )
+            conn.commit()
+    except sqlite3.Error as e:
+        logger.warning(f"写入磁盘向量缓存失败: {e}")
+
+
+async def get_cached_embeddings(keys: List[bytes]) -> List[Optional[List[float]]]:
+    """批量读取缓存的向量（反量化后返回，未命中为 None），命中时刷新LRU顺序
+    
+    内存未命中的键在工作线程中用一次查询读取磁盘缓存，不阻塞事件循环。
+    """
+    entries: List[Optional[Tuple[np.ndarray, float]]] = []
+    # 按首次出现顺序去重的未命中键
+    missing: Dict[bytes, None] = {}
+    for key in keys:
+        entry = _embedding_cache.get(key)
+        if entry is not None:
+            _embedding_cache.move_to_end(key)
+        else:
+            missing[key] = None
+        entries.append(entry)
+    
+    if missing and _disk_cache_enabled():
+        loaded = await asyncio.to_thread(_load_disk_embeddings, list(missing))
+        for key, entry in loaded.items():
+            _remember_embedding(key, entry)
+        entries = [
+            entry if entry is not None else loaded.get(key)
+            for key, entry in zip(keys, entries)
+        ]
+    
+    return [
+        dequantize_embedding(*entry).tolist() if entry is not None else None
+        for entry in entries
+    ]
+
+
+async def get_cached_embedding(key: bytes) -> Optional[List[float]]:
+    """读取单条缓存的向量"""
+    return (await get_cached_embeddings([key]))[0]
+
+
+def _remember_embedding(key: bytes, entry: Tuple[np.ndarray, float]) -> None:
+    """写入内存缓存，超出容量时淘汰最久未使用的条目"""
+    _embedding_cache[key] = entry
+    _embedding_cache.move_to_end(key)
+    if len(_embedding_cache) > _EMBEDDING_CACHE_SIZE:
+        _embedding_cache.popitem(last=False)
+
+
+async def cache_embeddings(items: List[tuple]) -> List[List[float]]:
+    """量化后写入内存缓存和磁盘缓存，items 为 (键, 模型名, 向量) 列表
+    
+    返回量化后还原的向量：调用方应使用返回值，使同一文本无论是否命中缓存
+    得到的向量都一致。磁盘写入在工作线程中执行，不阻塞事件循环。
+    """
+    quantized_items = []
+    restored = []
+    for key, model, embedding in items:
+        quantized, scale = quantize_embedding(embedding)
+        _remember_embedding(key, (quantized, scale))
+        quantized_items.append((key, model, quantized, scale))
+        restored.append(dequantize_embedding(quantized, scale).tolist())
+    if quantized_items and _disk_cache_enabled():
+        await asyncio.to_thread(_store_disk_embeddings, quantized_items)
+    return restored
+
+
+async def _cache_embedding(key: bytes, model: "EmbeddingModel", embedding: List[float]) -> List[float]:
+    """写入单条向量缓存，返回量化后还原的向量"""
+    return (await cache_embeddings([(key, model.value, embedding)]))[0]
+
+
+# 进行中的向量请求：相同 (模型, 文本) 的并发调用共享同一次请求结果
+_inflight_embeddings: Dict[bytes, "asyncio.Future[Optional[List[float]]]"] = {}
+
+
+def clear_embedding_cache() -> None:
+    """清空向量缓存（模型或服务配置变更时调用）"""
+    _embedding_cache.clear()
+    conn = _get_disk_cache()
+    if conn is not None:
+        with _disk_cache_lock:
+            conn.execute("DELETE FROM emb_cache")
+            conn.commit()
+
+
+def close_embedding_cache() -> None:
+    """关闭磁盘向量缓存连接（应用关闭时调用）"""
+    global _disk_cache_conn
+    if _disk_cache_conn is not None:
+        with _disk_cache_lock:
+            _disk_cache_conn.close()
+        _disk_cache_conn = None
+
+
+async def close_http_session() -> None:
+    """关闭共享的HTTP会话（应用关闭时调用）"""
+    global _http_session
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+    _http_session = None
+
 
 class EmbeddingModel(str, Enum):
     """支持的Embedding模型"""
@@ -24,6 +286,29 @@ class EmbeddingModel(str, Enum):
     MINILM = "minilm"
 
 
+_MODEL_VALUES = frozenset(model.value for model in EmbeddingModel)
+
+# 代码特征关键字，按整词匹配（避免 "reformat" 之类的词误命中 "for"）
+_CODE_INDICATOR_RE = re.compile(
+    r"\b(?:def|class|import|from|return|function|const|let|var|public|private|if|for|while) "
+    r"|\btry:"
+)
+
+# 通过OpenAI兼容接口调用的模型，接口支持一次提交多条文本
+_OPENAI_MODELS = frozenset({
+    EmbeddingModel.OPENAI_ADA_002,
+    EmbeddingModel.OPENAI_3_SMALL,
+    EmbeddingModel.OPENAI_3_LARGE
+})
+# 单次批量请求的最大文本数与最大并发批次数
+_OPENAI_BATCH_SIZE = 512
+_MAX_CONCURRENT_BATCHES = 8
+# 本地模型逐条请求时的最大并发数
+_MAX_CONCURRENT_REQUESTS = 32
+# 单次批量请求的文本长度预算（按字符数保守估计token数）
+_OPENAI_BATCH_TOKEN_BUDGET = 120000
+
+
 class TextType(str, Enum):
     """文本类型"""
     SHORT = "short"  # 短文本/问句
@@ -97,11 +382,19 @@ class EmbeddingRouter:
             TextType.CODE: [EmbeddingModel.MINILM, EmbeddingModel.OPENAI_3_SMALL],
             TextType.HYBRID: [EmbeddingModel.BGE_M3, EmbeddingModel.GTE_LARGE]
         }
+        
+        # 模型可用性在初始化时计算一次，配置变更后调用 refresh_availability 更新
+        self._availability: Dict[EmbeddingModel, bool] = {}
+        self.refresh_availability()
+    
+    def refresh_availability(self) -> None:
+        """重新计算各模型的可用性"""
+        self._availability = {model: self._is_model_available(model) for model in EmbeddingModel}
     
     def select_model(self, text: str, text_type: Optional[TextType] = None, 
                     preferred_model: Optional[str] = None) -> EmbeddingModel:
         """选择Embedding模型"""
-        if preferred_model and preferred_model in [m.value for m in EmbeddingModel]:
+        if preferred_model and preferred_model in _MODEL_VALUES:
             return EmbeddingModel(preferred_model)
         
         # 自动检测文本类型
@@ -113,7 +406,7 @@ class EmbeddingRouter:
         
         # 优先选择本地模型（降低成本）
         for model in available_models:
-            if self._is_model_available(model):
+            if self._availability[model]:
                 return model
         
         # 降级到OpenAI
@@ -134,12 +427,7 @@ class EmbeddingRouter:
     
     def _is_code_text(self, text: str) -> bool:
         """检测是否为代码文本"""
-        code_indicators = [
-            'def ', 'class ', 'import ', 'from ', 'return ',
-            'function ', 'const ', 'let ', 'var ', 'public ',
-            'private ', 'if ', 'for ', 'while ', 'try:'
-        ]
-        return any(indicator in text for indicator in code_indicators)
+        return _CODE_INDICATOR_RE.search(text) is not None
     
     def _is_model_available(self, model: EmbeddingModel) -> bool:
         """检查模型是否可用"""
@@ -159,76 +447,137 @@ class EmbeddingRouter:
         
         config = self.model_configs[model]
         
+        cache_key = _embedding_cache_key(text, model)
+        cached = await get_cached_embedding(cache_key)
+        if cached is not None:
+            return cached
+        
+        # 已有相同请求在进行中，等待其结果（失败时结果为 None）
+        inflight = _inflight_embeddings.get(cache_key)
+        if inflight is not None:
+            embedding = await asyncio.shield(inflight)
+            if embedding is not None:
+                return list(embedding)
+            return self._fallback_embedding(text, config["dimension"])
+        
+        future = asyncio.get_running_loop().create_future()
+        _inflight_embeddings[cache_key] = future
         try:
-            if model in [EmbeddingModel.OPENAI_ADA_002, EmbeddingModel.OPENAI_3_SMALL, EmbeddingModel.OPENAI_3_LARGE]:
-                return await self._get_openai_embedding(text, model, config)
+            if model in _OPENAI_MODELS:
+                embedding = await self._get_openai_embedding(text, model, config)
             else:
-                return await self._get_local_embedding(text, model, config)
+                embedding = await self._get_local_embedding(text, model, config)
+            # 降级向量不写入缓存，服务恢复后可重新获取真实向量；
+            # 返回与缓存命中时相同的还原向量
+            embedding = await _cache_embedding(cache_key, model, embedding)
+            future.set_result(embedding)
+            return embedding
         except Exception as e:
             logger.error(f"Embedding获取失败: {e}")
+            future.set_result(None)
             # 降级到简单向量化
             return self._fallback_embedding(text, config["dimension"])
+        finally:
+            _inflight_embeddings.pop(cache_key, None)
+            if not future.done():
+                # 请求被取消时唤醒等待者，由其各自降级处理
+                future.set_result(None)
     
     async def _get_openai_embedding(self, text: str, model: EmbeddingModel, 
                                   config: Dict[str, Any]) -> List[float]:
         """获取OpenAI Embedding"""
-        async with aiohttp.ClientSession() as session:
-            data = {
-                "input": text,
-                "model": model.value
-            }
-            
-            async with session.post(
-                config["url"],
-                headers=config["headers"],
-                json=data
-            ) as response:
-                if response.status == 200:
-                    result = await response.json()
-                    return result["data"][0]["embedding"]
-                else:
-                    raise Exception(f"OpenAI API错误: {response.status}")
+        session = await get_http_session()
+        data = {
+            "input": text,
+            "model": model.value
+        }
+        
+        async with session.post(
+            config["url"],
+            headers=config["headers"],
+            json=data
+        ) as response:
+            if response.status == 200:
+                result = await response.json()
+                return result["data"][0]["embedding"]
+            else:
+                raise Exception(f"OpenAI API错误: {response.status}")
+    
+    def _pack_batches(self, texts: List[str], indices: List[int]) -> List[List[int]]:
+        """按文本长度排序后打包批次，使同一批次内长度相近"""
+        batches = []
+        current: List[int] = []
+        current_tokens = 0
+        for i in sorted(indices, key=lambda idx: len(texts[idx])):
+            tokens = len(texts[i])
+            if current and (
+                len(current) >= _OPENAI_BATCH_SIZE
+                or current_tokens + tokens > _OPENAI_BATCH_TOKEN_BUDGET
+            ):
+                batches.append(current)
+                current = []
+                current_tokens = 0
+            current.append(i)
+            current_tokens += tokens
+        if current:
+            batches.append(current)
+        return batches
+    
+    async def _get_openai_embedding_batch(self, texts: List[str], model: EmbeddingModel,
+                                        config: Dict[str, Any]) -> List[List[float]]:
+        """批量获取OpenAI Embedding（一次请求提交多条文本）"""
+        session = await get_http_session()
+        data = {
+            "input": texts,
+            "model": model.value
+        }
+        
+        async with session.post(
+            config["url"],
+            headers=config["headers"],
+            json=data
+        ) as response:
+            if response.status == 200:
+                result = await response.json()
+                items = sorted(result["data"], key=lambda item: item["index"])
+                return [item["embedding"] for item in items]
+            else:
+                raise Exception(f"OpenAI API错误: {response.status}")
     
     async def _get_local_embedding(self, text: str, model: EmbeddingModel,
                                  config: Dict[str, Any]) -> List[float]:
         """获取本地模型Embedding"""
-        async with aiohttp.ClientSession() as session:
-            data = {
-                "text": text,
-                "model": model.value
-            }
-            
-            async with session.post(
-                config["url"],
-                headers=config["headers"],
-                json=data
-            ) as response:
-                if response.status == 200:
-                    result = await response.json()
-                    return result["embedding"]
-                else:
-                    raise Exception(f"本地模型API错误: {response.status}")
+        session = await get_http_session()
+        data = {
+            "text": text,
+            "model": model.value
+        }
+        
+        async with session.post(
+            config["url"],
+            headers=config["headers"],
+            json=data
+        ) as response:
+            if response.status == 200:
+                result = await response.json()
+                return result["embedding"]
+            else:
+                raise Exception(f"本地模型API错误: {response.status}")
     
     def _fallback_embedding(self, text: str, dimension: int) -> List[float]:
         """降级向量化"""
-        import string
-        import random
-        
-        # 简单的字符频率向量化
-        vector = [0.0] * dimension
-        
-        # 字符频率
-        for char in text.lower():
-            if char in string.ascii_lowercase:
-                idx = (ord(char) - ord('a')) % dimension
-                vector[idx] += 1.0
+        # 简单的字符频率向量化：统计 a-z 字符频率
+        codes = np.frombuffer(text.lower().encode("ascii", "ignore"), dtype=np.uint8)
+        codes = codes[(codes >= 97) & (codes <= 122)]
+        indices = (codes.astype(np.int64) - 97) % dimension
+        vector = np.bincount(indices, minlength=dimension).astype(np.float32)
         
         # 归一化
         norm = np.linalg.norm(vector)
         if norm > 0:
-            vector = [v / norm for v in vector]
+            vector /= norm
         
-        return vector
+        return vector.tolist()
     
     async def get_hybrid_embedding(self, parent_text: str, child_text: str,
                                  parent_weight: float = 0.3, child_weight: float = 0.7,
@@ -242,25 +591,22 @@ class EmbeddingRouter:
         parent_embedding = await self.get_embedding(parent_text, model)
         child_embedding = await self.get_embedding(child_text, model)
         
-        # 确保向量维度一致
-        if len(parent_embedding) != len(child_embedding):
-            # 如果维度不同，使用较小的维度
-            min_dim = min(len(parent_embedding), len(child_embedding))
-            parent_embedding = parent_embedding[:min_dim]
-            child_embedding = child_embedding[:min_dim]
+        parent_vector = np.asarray(parent_embedding, dtype=np.float32)
+        child_vector = np.asarray(child_embedding, dtype=np.float32)
+        
+        # 确保向量维度一致，维度不同时使用较小的维度
+        min_dim = min(parent_vector.shape[0], child_vector.shape[0])
         
         # 加权组合
-        hybrid_embedding = [
-            parent_weight * p + child_weight * c
-            for p, c in zip(parent_embedding, child_embedding)
-        ]
+        hybrid_embedding = parent_vector[:min_dim] * parent_weight
+        hybrid_embedding += child_vector[:min_dim] * child_weight
         
         # 归一化
         norm = np.linalg.norm(hybrid_embedding)
         if norm > 0:
-            hybrid_embedding = [v / norm for v in hybrid_embedding]
+            hybrid_embedding /= norm
         
-        return hybrid_embedding
+        return hybrid_embedding.tolist()
     
     def get_model_info(self, model: EmbeddingModel) -> Dict[str, Any]:
         """获取模型信息"""
@@ -270,7 +616,7 @@ class EmbeddingRouter:
             "dimension": config["dimension"],
             "max_tokens": config["max_tokens"],
             "cost_per_1k": config["cost_per_1k"],
-            "available": self._is_model_available(model)
+            "available": self._availability[model]
         }
     
     def estimate_cost(self, text: str, model: EmbeddingModel) -> float:
@@ -280,24 +626,68 @@ class EmbeddingRouter:
         return (token_count / 1000) * config["cost_per_1k"]
     
     async def batch_embedding(self, texts: List[str], model: Optional[EmbeddingModel] = None) -> List[List[float]]:
-        """批量获取向量"""
+        """批量获取向量，结果顺序与 texts 一致"""
         if not model:
             # 使用第一个文本选择模型
             model = self.select_model(texts[0] if texts else "")
         
-        # 并发获取向量
-        tasks = [self.get_embedding(text, model) for text in texts]
-        embeddings = await asyncio.gather(*tasks, return_exceptions=True)
+        config = self.model_configs[model]
+        dimension = config["dimension"]
+        out: List[Optional[List[float]]] = [None] * len(texts)
         
-        # 处理异常
-        result = []
-        for i, embedding in enumerate(embeddings):
-            if isinstance(embedding, Exception):
-                logger.error(f"文本 {i} 向量化失败: {embedding}")
-                # 使用降级向量化
-                config = self.model_configs[model]
-                result.append(self._fallback_embedding(texts[i], config["dimension"]))
+        # 本地模型服务只接受单条文本，逐条并发获取
+        if model not in _OPENAI_MODELS:
+            semaphore = asyncio.Semaphore(_MAX_CONCURRENT_REQUESTS)
+            
+            async def embed_one(i: int) -> Tuple[int, List[float]]:
+                async with semaphore:
+                    try:
+                        return i, await self.get_embedding(texts[i], model)
+                    except Exception as e:
+                        logger.error(f"文本 {i} 向量化失败: {e}")
+                        # 使用降级向量化
+                        return i, self._fallback_embedding(texts[i], dimension)
+            
+            # 按完成顺序写入结果列表，不额外保留全部中间结果
+            for next_done in asyncio.as_completed([embed_one(i) for i in range(len(texts))]):
+                i, embedding = await next_done
+                out[i] = embedding
+            
+            return out
+        
+        # 先查缓存，只对未命中的文本发起批量请求
+        cache_keys = [_embedding_cache_key(text, model) for text in texts]
+        pending = []
+        for i, cached in enumerate(await get_cached_embeddings(cache_keys)):
+            if cached is not None:
+                out[i] = cached
             else:
-                result.append(embedding)
+                pending.append(i)
+        
+        semaphore = asyncio.Semaphore(_MAX_CONCURRENT_BATCHES)
+        
+        async def embed_batch(indices: List[int]) -> None:
+            async with semaphore:
+                try:
+                    embeddings = await self._get_openai_embedding_batch(
+                        [texts[i] for i in indices], model, config
+                    )
+                except Exception as e:
+                    logger.error(f"批量向量化失败（{len(indices)} 条文本）: {e}")
+                    # 使用降级向量化，且不写入缓存
+                    for i in indices:
+                        out[i] = self._fallback_embedding(texts[i], dimension)
+                    return
+            
+            restored = await cache_embeddings([
+                (cache_keys[i], model.value, embedding)
+                for i, embedding in zip(indices, embeddings)
+            ])
+            for i, embedding in zip(indices, restored):
+                out[i] = embedding
+        
+        await asyncio.gather(*(
+            embed_batch(indices) for indices in self._pack_batches(texts, pending)
+        ))
         
-        return result 
\ No newline at end of file
+        return out
@@ -5,10 +5,13 @@ EnhancedRetrievalPipeline 增强检索流水线
 from typing import List, Dict, Any, Optional, Tuple
 import asyncio
 import logging
+import random
 import time
 from dataclasses import dataclass
 from enum import Enum
 
+import numpy as np
+
 from .query_processor import QueryProcessor
 from .multi_query_expander import MultiQueryExpander, ExpansionStrategy, QueryType
 from .hybrid_retriever import HybridRetriever, FusionStrategy
@@ -49,6 +52,9 @@ class PipelineConfig:
     enable_hybrid_retrieval: bool = True
     fusion_strategy: FusionStrategy = FusionStrategy.WEIGHTED_SUM
     retrieval_weights: Dict[str, float] = None
+    enable_result_cache: bool = False
+    # 语义缓存相似度阈值（None 表示关闭）
+    semantic_cache_threshold: Optional[float] = None
     
     # 重排序配置
     enable_reranking: bool = True
@@ -59,6 +65,10 @@ class PipelineConfig:
     max_retrieval_results: int = 50
     final_top_k: int = 10
     enable_parallel_processing: bool = True
+    
+    # 统计配置：详细阶段统计按比例采样，未采样的查询只记录各阶段耗时
+    collect_detailed_stats: bool = False
+    stats_sample_rate: float = 1.0
 
 
 @dataclass
@@ -75,6 +85,57 @@ class PipelineResult:
     processing_time: float
 
 
+@dataclass
+class DocBatch:
+    """按列存储的文档批次，只在对外输出时转换为 RerankResult"""
+    ids: List[str]
+    scores: np.ndarray
+    contents: List[str]
+    source_files: List[str]
+    knowledge_base_ids: List[str]
+    metadata: List[Dict[str, Any]]
+    
+    @classmethod
+    def from_documents(cls, documents: List[Dict]) -> "DocBatch":
+        """从检索结果字典列表构建"""
+        return cls(
+            ids=[doc["id"] for doc in documents],
+            scores=np.fromiter(
+                (doc.get("score", 0.0) for doc in documents),
+                dtype=np.float64,
+                count=len(documents)
+            ),
+            contents=[doc["content"] for doc in documents],
+            source_files=[doc.get("source_file", "") for doc in documents],
+            knowledge_base_ids=[doc.get("knowledge_base_id", "") for doc in documents],
+            metadata=[doc.get("metadata", {}) for doc in documents]
+        )
+    
+    def __len__(self) -> int:
+        return len(self.ids)
+    
+    def to_rerank_results(self, indices: Optional[List[int]] = None,
+                          rerank_reason: str = "no_reranking") -> List[RerankResult]:
+        """转换为重排序结果（未重排序时三种分数相同）"""
+        if indices is None:
+            indices = range(len(self.ids))
+        results = []
+        for i in indices:
+            score = float(self.scores[i])
+            results.append(RerankResult(
+                id=self.ids[i],
+                content=self.contents[i],
+                original_score=score,
+                rerank_score=score,
+                final_score=score,
+                source_file=self.source_files[i],
+                knowledge_base_id=self.knowledge_base_ids[i],
+                metadata=self.metadata[i],
+                rerank_reason=rerank_reason
+            ))
+        return results
+
+
 class EnhancedRetrievalPipeline:
     """增强检索流水线"""
     
@@ -95,7 +156,9 @@ class EnhancedRetrievalPipeline:
             vector_service, 
             keyword_service,
             self.config.retrieval_weights,
-            self.config.fusion_strategy
+            self.config.fusion_strategy,
+            enable_result_cache=self.config.enable_result_cache,
+            semantic_cache_threshold=self.config.semantic_cache_threshold
         )
         self.reranker = Reranker(cross_encoder_client, self.config.rerank_strategy)
         
@@ -105,13 +168,16 @@ class EnhancedRetrievalPipeline:
             "successful_queries": 0,
             "failed_queries": 0,
             "avg_processing_time": 0.0,
+            "processing_time_variance": 0.0,
             "stage_performance": {}
         }
+        # Welford 算法的二阶中心矩累计值
+        self._processing_time_m2 = 0.0
     
     async def retrieve(self, query: str, kb_ids: List[str], 
                       user_context: Dict[str, Any] = None) -> PipelineResult:
         """执行增强检索流水线"""
-        start_time = time.time()
+        start_time = time.perf_counter()
         original_query = query
         
         try:
@@ -119,32 +185,46 @@ class EnhancedRetrievalPipeline:
             
             # 初始化结果
             stage_results = {}
+            detailed = self._should_collect_detailed_stats()
             expanded_queries = [query]
             retrieved_documents = []
             reranked_documents = []
             final_documents = []
             
-            # 1. 查询预处理
-            if self.config.enable_query_preprocessing:
-                query, preprocessing_stats = await self._stage_query_preprocessing(query, user_context)
+            if (self.config.enable_parallel_processing
+                    and self.config.enable_query_preprocessing
+                    and self.config.enable_query_expansion):
+                # 1+2. 查询预处理与查询扩展并行执行，扩展以原始查询为种子
+                (query, preprocessing_stats), (expanded_queries, expansion_stats) = await asyncio.gather(
+                    self._stage_query_preprocessing(query, user_context, detailed),
+                    self._stage_query_expansion(query, user_context, detailed)
+                )
+                # 扩展结果首项为原始查询，替换为预处理后的查询
+                expanded_queries = [query] + [q for q in expanded_queries[1:] if q != query]
                 stage_results[PipelineStage.QUERY_PREPROCESSING] = preprocessing_stats
-            
-            # 2. 查询扩展
-            if self.config.enable_query_expansion:
-                expanded_queries, expansion_stats = await self._stage_query_expansion(query, user_context)
                 stage_results[PipelineStage.QUERY_EXPANSION] = expansion_stats
+            else:
+                # 1. 查询预处理
+                if self.config.enable_query_preprocessing:
+                    query, preprocessing_stats = await self._stage_query_preprocessing(query, user_context, detailed)
+                    stage_results[PipelineStage.QUERY_PREPROCESSING] = preprocessing_stats
+                
+                # 2. 查询扩展
+                if self.config.enable_query_expansion:
+                    expanded_queries, expansion_stats = await self._stage_query_expansion(query, user_context, detailed)
+                    stage_results[PipelineStage.QUERY_EXPANSION] = expansion_stats
             
             # 3. 混合检索
             if self.config.enable_hybrid_retrieval:
                 retrieved_documents, retrieval_stats = await self._stage_hybrid_retrieval(
-                    expanded_queries, kb_ids
+                    expanded_queries, kb_ids, detailed
                 )
                 stage_results[PipelineStage.HYBRID_RETRIEVAL] = retrieval_stats
             
             # 4. 元数据过滤
             if self.config.enable_metadata_filtering and retrieved_documents:
                 filtered_documents, filtering_stats = await self._stage_metadata_filtering(
-                    retrieved_documents
+                    retrieved_documents, detailed
                 )
                 stage_results[PipelineStage.METADATA_FILTERING] = filtering_stats
                 retrieved_documents = filtered_documents
@@ -152,7 +232,7 @@ class EnhancedRetrievalPipeline:
             # 5. 重排序
             if self.config.enable_reranking and retrieved_documents:
                 reranked_documents, reranking_stats = await self._stage_reranking(
-                    query, retrieved_documents
+                    query, retrieved_documents, detailed
                 )
                 stage_results[PipelineStage.RERANKING] = reranking_stats
             else:
@@ -161,12 +241,12 @@ class EnhancedRetrievalPipeline:
             
             # 6. 后处理
             final_documents, post_processing_stats = await self._stage_post_processing(
-                reranked_documents
+                reranked_documents, detailed
             )
             stage_results[PipelineStage.POST_PROCESSING] = post_processing_stats
             
             # 计算处理时间
-            processing_time = time.time() - start_time
+            processing_time = time.perf_counter() - start_time
             
             # 构建最终结果
             result = PipelineResult(
@@ -189,7 +269,7 @@ class EnhancedRetrievalPipeline:
             
         except Exception as e:
             logger.error(f"增强检索流水线失败: {e}")
-            processing_time = time.time() - start_time
+            processing_time = time.perf_counter() - start_time
             
             # 返回降级结果
             return PipelineResult(
@@ -204,15 +284,19 @@ class EnhancedRetrievalPipeline:
                 processing_time=processing_time
             )
     
-    async def _stage_query_preprocessing(self, query: str, user_context: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
+    async def _stage_query_preprocessing(self, query: str, user_context: Dict[str, Any],
+                                         detailed: bool = True) -> Tuple[str, Dict[str, Any]]:
         """查询预处理阶段"""
         try:
-            start_time = time.time()
+            start_time = time.perf_counter()
             
             # 执行查询预处理
             processed_query = await self.query_processor.preprocess_query(query, user_context)
             
-            processing_time = time.time() - start_time
+            processing_time = time.perf_counter() - start_time
+            
+            if not detailed:
+                return processed_query, {"processing_time": processing_time}
             
             stats = {
                 "original_query": query,
@@ -228,10 +312,11 @@ class EnhancedRetrievalPipeline:
             logger.error(f"查询预处理失败: {e}")
             return query, {"error": str(e)}
     
-    async def _stage_query_expansion(self, query: str, user_context: Dict[str, Any]) -> Tuple[List[str], Dict[str, Any]]:
+    async def _stage_query_expansion(self, query: str, user_context: Dict[str, Any],
+                                     detailed: bool = True) -> Tuple[List[str], Dict[str, Any]]:
         """查询扩展阶段"""
         try:
-            start_time = time.time()
+            start_time = time.perf_counter()
             
             # 执行查询扩展
             expanded_queries = await self.query_expander.expand_query(
@@ -240,7 +325,10 @@ class EnhancedRetrievalPipeline:
                 strategy=self.config.expansion_strategy
             )
             
-            processing_time = time.time() - start_time
+            processing_time = time.perf_counter() - start_time
+            
+            if not detailed:
+                return expanded_queries, {"processing_time": processing_time}
             
             stats = {
                 "original_query": query,
@@ -257,12 +345,19 @@ class EnhancedRetrievalPipeline:
             logger.error(f"查询扩展失败: {e}")
             return [query], {"error": str(e)}
     
-    async def _stage_hybrid_retrieval(self, queries: List[str], kb_ids: List[str]) -> Tuple[List[Dict], Dict[str, Any]]:
+    async def _stage_hybrid_retrieval(self, queries: List[str], kb_ids: List[str],
+                                      detailed: bool = True) -> Tuple[List[Dict], Dict[str, Any]]:
         """混合检索阶段"""
         try:
-            start_time = time.time()
+            start_time = time.perf_counter()
             
-            if self.config.enable_parallel_processing and len(queries) > 1:
+            if len(queries) == 1:
+                # 单个查询直接检索，融合结果本身无重复，无需去重
+                retrieved_documents = await self.hybrid_retriever.retrieve(
+                    queries[0], kb_ids, self.config.max_retrieval_results
+                )
+                
+            elif self.config.enable_parallel_processing:
                 # 并行检索
                 retrieval_tasks = []
                 for query in queries:
@@ -296,7 +391,10 @@ class EnhancedRetrievalPipeline:
                 # 去重
                 retrieved_documents = self._deduplicate_documents(retrieved_documents)
             
-            processing_time = time.time() - start_time
+            processing_time = time.perf_counter() - start_time
+            
+            if not detailed:
+                return retrieved_documents, {"processing_time": processing_time}
             
             stats = {
                 "queries_count": len(queries),
@@ -312,10 +410,11 @@ class EnhancedRetrievalPipeline:
             logger.error(f"混合检索失败: {e}")
             return [], {"error": str(e)}
     
-    async def _stage_metadata_filtering(self, documents: List[Dict]) -> Tuple[List[Dict], Dict[str, Any]]:
+    async def _stage_metadata_filtering(self, documents: List[Dict],
+                                        detailed: bool = True) -> Tuple[List[Dict], Dict[str, Any]]:
         """元数据过滤阶段"""
         try:
-            start_time = time.time()
+            start_time = time.perf_counter()
             
             # 执行元数据过滤
             filtered_documents = await self.metadata_filter.filter_documents(
@@ -324,7 +423,10 @@ class EnhancedRetrievalPipeline:
                 predefined_filters=self.config.predefined_filters
             )
             
-            processing_time = time.time() - start_time
+            processing_time = time.perf_counter() - start_time
+            
+            if not detailed:
+                return filtered_documents, {"processing_time": processing_time}
             
             stats = {
                 "original_count": len(documents),
@@ -341,17 +443,21 @@ class EnhancedRetrievalPipeline:
             logger.error(f"元数据过滤失败: {e}")
             return documents, {"error": str(e)}
     
-    async def _stage_reranking(self, query: str, documents: List[Dict]) -> Tuple[List[RerankResult], Dict[str, Any]]:
+    async def _stage_reranking(self, query: str, documents: List[Dict],
+                               detailed: bool = True) -> Tuple[List[RerankResult], Dict[str, Any]]:
         """重排序阶段"""
         try:
-            start_time = time.time()
+            start_time = time.perf_counter()
             
             # 执行重排序
             reranked_documents = await self.reranker.rerank(
                 query, documents, self.config.rerank_top_k
             )
             
-            processing_time = time.time() - start_time
+            processing_time = time.perf_counter() - start_time
+            
+            if not detailed:
+                return reranked_documents, {"processing_time": processing_time}
             
             stats = {
                 "original_count": len(documents),
@@ -367,14 +473,37 @@ class EnhancedRetrievalPipeline:
             logger.error(f"重排序失败: {e}")
             return self._convert_to_rerank_results(documents), {"error": str(e)}
     
-    async def _stage_post_processing(self, reranked_documents: List[RerankResult]) -> Tuple[List[Dict], Dict[str, Any]]:
+    @staticmethod
+    def _select_top_k(results: List[RerankResult], k: int) -> List[int]:
+        """按 final_score 降序返回前 k 个结果的下标"""
+        n = len(results)
+        if n == 0 or k <= 0:
+            return []
+        scores = np.fromiter((r.final_score for r in results), dtype=np.float64, count=n)
+        if k < n:
+            # 第 k 大的分数作为阈值；与阈值同分的结果按原有先后补足 k 个，与稳定排序一致
+            threshold = -np.partition(-scores, k - 1)[k - 1]
+            above = np.flatnonzero(scores > threshold)
+            ties = np.flatnonzero(scores == threshold)[:k - len(above)]
+            indices = np.concatenate([above, ties])
+        else:
+            indices = np.arange(n)
+        indices = indices[np.argsort(-scores[indices], kind="stable")]
+        return indices.tolist()
+    
+    async def _stage_post_processing(self, reranked_documents: List[RerankResult],
+                                     detailed: bool = True) -> Tuple[List[Dict], Dict[str, Any]]:
         """后处理阶段"""
         try:
-            start_time = time.time()
+            start_time = time.perf_counter()
+            
+            # 选出得分最高的 final_top_k 个结果，只对入选结果排序
+            top_indices = self._select_top_k(reranked_documents, self.config.final_top_k)
             
             # 转换为最终格式
             final_documents = []
-            for result in reranked_documents[:self.config.final_top_k]:
+            for i in top_indices:
+                result = reranked_documents[i]
                 final_documents.append({
                     "id": result.id,
                     "content": result.content,
@@ -387,7 +516,10 @@ class EnhancedRetrievalPipeline:
                     "rerank_score": result.rerank_score
                 })
             
-            processing_time = time.time() - start_time
+            processing_time = time.perf_counter() - start_time
+            
+            if not detailed:
+                return final_documents, {"processing_time": processing_time}
             
             stats = {
                 "input_count": len(reranked_documents),
@@ -402,36 +534,26 @@ class EnhancedRetrievalPipeline:
             logger.error(f"后处理失败: {e}")
             return [], {"error": str(e)}
     
+    def _should_collect_detailed_stats(self) -> bool:
+        """判断本次查询是否采集详细阶段统计"""
+        if not self.config.collect_detailed_stats:
+            return False
+        return random.random() < self.config.stats_sample_rate
+    
     def _deduplicate_documents(self, documents: List[Dict]) -> List[Dict]:
-        """去重文档"""
-        seen_ids = set()
-        unique_documents = []
+        """去重文档（保留每个ID首次出现的文档及其顺序，忽略无ID文档）"""
+        unique_documents: Dict[Any, Dict] = {}
         
         for doc in documents:
             doc_id = doc.get("id")
-            if doc_id and doc_id not in seen_ids:
-                seen_ids.add(doc_id)
-                unique_documents.append(doc)
+            if doc_id and doc_id not in unique_documents:
+                unique_documents[doc_id] = doc
         
-        return unique_documents
+        return list(unique_documents.values())
     
     def _convert_to_rerank_results(self, documents: List[Dict]) -> List[RerankResult]:
         """将文档转换为重排序结果格式"""
-        rerank_results = []
-        for doc in documents:
-            score = doc.get("score", 0.0)
-            rerank_results.append(RerankResult(
-                id=doc["id"],
-                content=doc["content"],
-                original_score=score,
-                rerank_score=score,
-                final_score=score,
-                source_file=doc.get("source_file", ""),
-                knowledge_base_id=doc.get("knowledge_base_id", ""),
-                metadata=doc.get("metadata", {}),
-                rerank_reason="no_reranking"
-            ))
-        return rerank_results
+        return DocBatch.from_documents(documents).to_rerank_results()
     
     def _calculate_pipeline_stats(self, stage_results: Dict[str, Any], processing_time: float) -> Dict[str, Any]:
         """计算流水线统计信息"""
@@ -463,10 +585,12 @@ class EnhancedRetrievalPipeline:
         else:
             self.pipeline_stats["failed_queries"] += 1
         
-        # 更新平均处理时间
-        total_time = self.pipeline_stats["avg_processing_time"] * (self.pipeline_stats["total_queries"] - 1)
-        total_time += result.processing_time
-        self.pipeline_stats["avg_processing_time"] = total_time / self.pipeline_stats["total_queries"]
+        # 增量更新平均处理时间和方差（Welford 算法）
+        count = self.pipeline_stats["total_queries"]
+        delta = result.processing_time - self.pipeline_stats["avg_processing_time"]
+        self.pipeline_stats["avg_processing_time"] += delta / count
+        self._processing_time_m2 += delta * (result.processing_time - self.pipeline_stats["avg_processing_time"])
+        self.pipeline_stats["processing_time_variance"] = self._processing_time_m2 / count
     
     def get_pipeline_stats(self) -> Dict[str, Any]:
         """获取流水线统计信息"""
@@ -481,4 +605,6 @@ class EnhancedRetrievalPipeline:
         self.hybrid_retriever.fusion_strategy = config.fusion_strategy
         if config.retrieval_weights:
             self.hybrid_retriever.weights = config.retrieval_weights
+        self.hybrid_retriever.enable_result_cache = config.enable_result_cache
+        self.hybrid_retriever.semantic_cache_threshold = config.semantic_cache_threshold
         self.reranker.strategy = config.rerank_strategy 
\ No newline at end of file
@@ -3,17 +3,49 @@
 支持Parent-Child分块和结构化分块
 """
 from typing import List, Dict, Any, Optional, Tuple
+import os
 import re
-import uuid
+from bisect import bisect_left
 from dataclasses import dataclass
 from enum import Enum
 import logging
 
+import numpy as np
+
 from app.services.text_splitter import TextSplitterFactory, TextChunk
 from app.services.embedding_router import EmbeddingRouter, EmbeddingModel
 
 logger = logging.getLogger(__name__)
 
+# Markdown 特征，合并为一个正则只匹配一次
+_MARKDOWN_INDICATOR_RE = re.compile(
+    "|".join(f"(?:{pattern})" for pattern in [
+        r'^#\s+', r'^##\s+', r'^###\s+',  # 标题
+        r'\*\*.*?\*\*', r'\*.*?\*',       # 粗体/斜体
+        r'`.*?`', r'```[\w]*\n',          # 代码
+        r'\[.*?\]\(.*?\)',                # 链接
+        r'^\s*[-*+]\s+',                  # 列表
+        r'^\s*\d+\.\s+'                   # 有序列表
+    ]),
+    re.MULTILINE
+)
+
+_UUID_VARIANT_CHARS = "89ab"
+_PERIOD_RE = re.compile(r"\.")
+
+
+def _gen_ids(n: int) -> List[str]:
+    """批量生成 n 个 UUID4 格式的分块ID（一次读取随机字节）"""
+    hex_str = os.urandom(16 * n).hex()
+    ids = []
+    for offset in range(0, 32 * n, 32):
+        h = hex_str[offset:offset + 32]
+        ids.append(
+            f"{h[:8]}-{h[8:12]}-4{h[13:16]}-"
+            f"{_UUID_VARIANT_CHARS[int(h[16], 16) & 3]}{h[17:20]}-{h[20:]}"
+        )
+    return ids
+
 
 class ChunkType(str, Enum):
     """分块类型"""
@@ -22,7 +54,7 @@ class ChunkType(str, Enum):
     STANDALONE = "standalone"
 
 
-@dataclass
+@dataclass(slots=True)
 class HybridChunk:
     """混合分块数据结构"""
     chunk_id: str
@@ -40,12 +72,75 @@ class HybridChunk:
             self.metadata = {}
 
 
+_CHUNK_TYPES = list(ChunkType)
+_CHUNK_TYPE_CODES = {chunk_type: code for code, chunk_type in enumerate(_CHUNK_TYPES)}
+
+
+@dataclass
+class ChunkStore:
+    """按列存储的分块属性，用于批量统计"""
+    chunk_types: np.ndarray    # ChunkType 编码（int8）
+    levels: np.ndarray         # 层级深度（int32）
+    content_lengths: np.ndarray  # 内容长度（int64）
+    
+    @classmethod
+    def from_chunks(cls, chunks: List[HybridChunk]) -> "ChunkStore":
+        """从分块列表构建"""
+        count = len(chunks)
+        return cls(
+            chunk_types=np.fromiter(
+                (_CHUNK_TYPE_CODES[c.chunk_type] for c in chunks), dtype=np.int8, count=count
+            ),
+            levels=np.fromiter((c.level for c in chunks), dtype=np.int32, count=count),
+            content_lengths=np.fromiter((len(c.content) for c in chunks), dtype=np.int64, count=count)
+        )
+    
+    def __len__(self) -> int:
+        return len(self.chunk_types)
+    
+    def statistics(self) -> Dict[str, Any]:
+        """按列计算分块统计信息"""
+        type_count = len(_CHUNK_TYPES)
+        counts = np.bincount(self.chunk_types, minlength=type_count)
+        size_sums = np.bincount(self.chunk_types, weights=self.content_lengths, minlength=type_count)
+        
+        parent_code = _CHUNK_TYPE_CODES[ChunkType.PARENT]
+        child_code = _CHUNK_TYPE_CODES[ChunkType.CHILD]
+        parent_count = int(counts[parent_code])
+        child_count = int(counts[child_code])
+        
+        return {
+            "total_chunks": len(self),
+            "parent_chunks": parent_count,
+            "child_chunks": child_count,
+            "standalone_chunks": int(counts[_CHUNK_TYPE_CODES[ChunkType.STANDALONE]]),
+            "avg_parent_size": float(size_sums[parent_code]) / parent_count if parent_count else 0,
+            "avg_child_size": float(size_sums[child_code]) / child_count if child_count else 0,
+            "max_level": int(self.levels.max()) if len(self) else 0
+        }
+
+
 class HybridChunker:
     """混合分块器"""
     
     def __init__(self, embedding_router: Optional[EmbeddingRouter] = None):
         self.embedding_router = embedding_router or EmbeddingRouter()
         self.text_splitter_factory = TextSplitterFactory()
+        # 分割器只保存配置、不保存调用状态，按参数缓存复用
+        self._splitter_cache: Dict[Tuple[str, int, int], Any] = {}
+    
+    def _get_splitter(self, kind: str, chunk_size: int, chunk_overlap: int):
+        """获取（缓存的）指定参数的分割器"""
+        key = (kind, chunk_size, chunk_overlap)
+        splitter = self._splitter_cache.get(key)
+        if splitter is None:
+            splitter = self.text_splitter_factory.create_splitter(
+                kind,
+                chunk_size=chunk_size,
+                chunk_overlap=chunk_overlap
+            )
+            self._splitter_cache[key] = splitter
+        return splitter
     
     async def create_hybrid_chunks(
         self,
@@ -73,19 +168,7 @@ class HybridChunker:
     
     def _is_markdown_document(self, text: str) -> bool:
         """检测是否为Markdown文档"""
-        markdown_indicators = [
-            r'^#\s+', r'^##\s+', r'^###\s+',  # 标题
-            r'\*\*.*?\*\*', r'\*.*?\*',       # 粗体/斜体
-            r'`.*?`', r'```[\w]*\n',          # 代码
-            r'\[.*?\]\(.*?\)',                # 链接
-            r'^\s*[-*+]\s+',                  # 列表
-            r'^\s*\d+\.\s+'                   # 有序列表
-        ]
-        
-        for pattern in markdown_indicators:
-            if re.search(pattern, text, re.MULTILINE):
-                return True
-        return False
+        return _MARKDOWN_INDICATOR_RE.search(text) is not None
     
     async def _create_markdown_hybrid_chunks(
         self,
@@ -95,15 +178,14 @@ class HybridChunker:
         child_overlap: int
     ) -> List[HybridChunk]:
         """创建Markdown混合分块"""
-        chunks = []
-        
         # 使用Markdown标题分割器
         markdown_splitter = self.text_splitter_factory.create_splitter("markdown_header")
         header_chunks = markdown_splitter.split_text(text)
+        parent_ids = _gen_ids(len(header_chunks))
         
-        for header_chunk in header_chunks:
+        parents = []
+        for header_chunk, parent_id in zip(header_chunks, parent_ids):
             # 创建父块
-            parent_id = str(uuid.uuid4())
             parent_chunk = HybridChunk(
                 chunk_id=parent_id,
                 content=header_chunk.content,
@@ -115,17 +197,10 @@ class HybridChunker:
                 },
                 level=header_chunk.metadata.get("level", 0)
             )
-            chunks.append(parent_chunk)
-            
             # 如果父块内容较长，创建子块
-            if len(header_chunk.content) > child_chunk_size:
-                child_chunks = await self._create_child_chunks(
-                    header_chunk.content, parent_id, child_chunk_size, child_overlap
-                )
-                chunks.extend(child_chunks)
-                parent_chunk.child_ids = [chunk.chunk_id for chunk in child_chunks]
+            parents.append((parent_chunk, len(header_chunk.content) > child_chunk_size))
         
-        return chunks
+        return await self._attach_child_chunks(parents, child_chunk_size, child_overlap)
     
     async def _create_standard_hybrid_chunks(
         self,
@@ -136,8 +211,6 @@ class HybridChunker:
         use_semantic: bool
     ) -> List[HybridChunk]:
         """创建标准混合分块"""
-        chunks = []
-        
         # 选择分割器
         if use_semantic:
             splitter = self.text_splitter_factory.create_splitter("semantic")
@@ -146,9 +219,11 @@ class HybridChunker:
         
         # 创建父块
         parent_chunks = splitter.split_text(text)
+        parent_ids = _gen_ids(len(parent_chunks))
         
+        parents = []
         for i, parent_chunk in enumerate(parent_chunks):
-            parent_id = str(uuid.uuid4())
+            parent_id = parent_ids[i]
             hybrid_parent = HybridChunk(
                 chunk_id=parent_id,
                 content=parent_chunk.content,
@@ -159,14 +234,29 @@ class HybridChunker:
                 },
                 level=0
             )
-            chunks.append(hybrid_parent)
-            
-            # 创建子块
-            child_chunks = await self._create_child_chunks(
-                parent_chunk.content, parent_id, child_chunk_size, child_overlap
-            )
-            chunks.extend(child_chunks)
-            hybrid_parent.child_ids = [chunk.chunk_id for chunk in child_chunks]
+            parents.append((hybrid_parent, True))
+        
+        return await self._attach_child_chunks(parents, child_chunk_size, child_overlap)
+    
+    async def _attach_child_chunks(
+        self,
+        parents: List[Tuple[HybridChunk, bool]],
+        child_chunk_size: int,
+        child_overlap: int
+    ) -> List[HybridChunk]:
+        """为父块创建子块，按父块顺序输出父块及其子块
+        
+        parents 为 (父块, 是否需要子块) 列表
+        """
+        chunks = []
+        for parent, needs_children in parents:
+            chunks.append(parent)
+            if needs_children:
+                child_chunks = await self._create_child_chunks(
+                    parent.content, parent.chunk_id, child_chunk_size, child_overlap
+                )
+                chunks.extend(child_chunks)
+                parent.child_ids = [chunk.chunk_id for chunk in child_chunks]
         
         return chunks
     
@@ -181,26 +271,28 @@ class HybridChunker:
         child_chunks = []
         
         # 使用递归分割器创建子块
-        child_splitter = self.text_splitter_factory.create_splitter(
-            "recursive",
-            chunk_size=child_chunk_size,
-            chunk_overlap=child_overlap
-        )
+        child_splitter = self._get_splitter("recursive", child_chunk_size, child_overlap)
         
         text_chunks = child_splitter.split_text(parent_content)
+        child_ids = _gen_ids(len(text_chunks))
+        
+        # 同一父块的子块元数据只有 child_index 不同：复制模板后改写该字段
+        # （元数据会直接序列化返回给前端，需保持普通 dict）
+        metadata_template = {
+            "splitter": "recursive",
+            "child_index": 0,
+            "parent_id": parent_id
+        }
         
         for i, text_chunk in enumerate(text_chunks):
-            child_id = str(uuid.uuid4())
+            metadata = metadata_template.copy()
+            metadata["child_index"] = i
             child_chunk = HybridChunk(
-                chunk_id=child_id,
+                chunk_id=child_ids[i],
                 content=text_chunk.content,
                 chunk_type=ChunkType.CHILD,
                 parent_id=parent_id,
-                metadata={
-                    "splitter": "recursive",
-                    "child_index": i,
-                    "parent_id": parent_id
-                },
+                metadata=metadata,
                 level=1
             )
             child_chunks.append(child_chunk)
@@ -219,11 +311,11 @@ class HybridChunker:
         # 使用语义分割器
         semantic_splitter = self.text_splitter_factory.create_splitter("semantic")
         text_chunks = await semantic_splitter.split_text(text)
+        chunk_ids = _gen_ids(len(text_chunks))
         
         for i, text_chunk in enumerate(text_chunks):
-            chunk_id = str(uuid.uuid4())
             chunk = HybridChunk(
-                chunk_id=chunk_id,
+                chunk_id=chunk_ids[i],
                 content=text_chunk.content,
                 chunk_type=ChunkType.STANDALONE,
                 metadata={
@@ -239,63 +331,48 @@ class HybridChunker:
     
     def get_chunk_hierarchy(self, chunks: List[HybridChunk]) -> Dict[str, Any]:
         """获取分块层次结构"""
-        hierarchy = {
-            "parents": [],
-            "children": [],
-            "standalone": []
-        }
+        parents = []
+        children = []
+        standalone = []
         
         for chunk in chunks:
+            content = chunk.content
+            if len(content) > 100:
+                content = content[:100] + "..."
+            
             if chunk.chunk_type == ChunkType.PARENT:
-                hierarchy["parents"].append({
+                parents.append({
                     "id": chunk.chunk_id,
-                    "content": chunk.content[:100] + "..." if len(chunk.content) > 100 else chunk.content,
+                    "content": content,
                     "child_count": len(chunk.child_ids),
                     "level": chunk.level,
                     "metadata": chunk.metadata
                 })
             elif chunk.chunk_type == ChunkType.CHILD:
-                hierarchy["children"].append({
+                children.append({
                     "id": chunk.chunk_id,
                     "parent_id": chunk.parent_id,
-                    "content": chunk.content[:100] + "..." if len(chunk.content) > 100 else chunk.content,
+                    "content": content,
                     "level": chunk.level,
                     "metadata": chunk.metadata
                 })
             else:
-                hierarchy["standalone"].append({
+                standalone.append({
                     "id": chunk.chunk_id,
-                    "content": chunk.content[:100] + "..." if len(chunk.content) > 100 else chunk.content,
+                    "content": content,
                     "level": chunk.level,
                     "metadata": chunk.metadata
                 })
         
-        return hierarchy
+        return {
+            "parents": parents,
+            "children": children,
+            "standalone": standalone
+        }
     
     def get_chunk_statistics(self, chunks: List[HybridChunk]) -> Dict[str, Any]:
         """获取分块统计信息"""
-        stats = {
-            "total_chunks": len(chunks),
-            "parent_chunks": len([c for c in chunks if c.chunk_type == ChunkType.PARENT]),
-            "child_chunks": len([c for c in chunks if c.chunk_type == ChunkType.CHILD]),
-            "standalone_chunks": len([c for c in chunks if c.chunk_type == ChunkType.STANDALONE]),
-            "avg_parent_size": 0,
-            "avg_child_size": 0,
-            "max_level": 0
-        }
-        
-        parent_sizes = [len(c.content) for c in chunks if c.chunk_type == ChunkType.PARENT]
-        child_sizes = [len(c.content) for c in chunks if c.chunk_type == ChunkType.CHILD]
-        
-        if parent_sizes:
-            stats["avg_parent_size"] = sum(parent_sizes) / len(parent_sizes)
-        if child_sizes:
-            stats["avg_child_size"] = sum(child_sizes) / len(child_sizes)
-        
-        if chunks:
-            stats["max_level"] = max(c.level for c in chunks)
-        
-        return stats
+        return ChunkStore.from_chunks(chunks).statistics()
     
     async def optimize_chunks(
         self,
@@ -305,25 +382,46 @@ class HybridChunker:
     ) -> List[HybridChunk]:
         """优化分块大小"""
         optimized_chunks = []
+        # 正在接收合并的独立块及其待拼接内容，切换到下一个块时一次性拼接
+        merge_target: Optional[HybridChunk] = None
+        merge_parts: List[str] = []
+        merge_length = 0
         
         for chunk in chunks:
-            if len(chunk.content) > target_chunk_size:
+            content_length = len(chunk.content)
+            
+            # 合并过小的独立块
+            if (merge_target is not None
+                    and content_length < min_chunk_size
+                    and chunk.chunk_type == ChunkType.STANDALONE
+                    and merge_length + content_length <= target_chunk_size):
+                merge_parts.append(chunk.content)
+                merge_length += content_length + 2
+                continue
+            
+            if len(merge_parts) > 1:
+                merge_target.content = "\n\n".join(merge_parts)
+            
+            if content_length > target_chunk_size:
                 # 分割过大的块
                 sub_chunks = await self._split_large_chunk(
                     chunk, target_chunk_size, min_chunk_size
                 )
                 optimized_chunks.extend(sub_chunks)
-            elif len(chunk.content) < min_chunk_size and chunk.chunk_type == ChunkType.STANDALONE:
-                # 合并过小的独立块
-                if optimized_chunks and optimized_chunks[-1].chunk_type == ChunkType.STANDALONE:
-                    last_chunk = optimized_chunks[-1]
-                    if len(last_chunk.content) + len(chunk.content) <= target_chunk_size:
-                        last_chunk.content += "\n\n" + chunk.content
-                        continue
-                
-                optimized_chunks.append(chunk)
             else:
                 optimized_chunks.append(chunk)
+            
+            last_chunk = optimized_chunks[-1] if optimized_chunks else None
+            if last_chunk is not None and last_chunk.chunk_type == ChunkType.STANDALONE:
+                merge_target = last_chunk
+                merge_parts = [last_chunk.content]
+                merge_length = len(last_chunk.content)
+            else:
+                merge_target = None
+                merge_parts = []
+        
+        if len(merge_parts) > 1:
+            merge_target.content = "\n\n".join(merge_parts)
         
         return optimized_chunks
     
@@ -336,51 +434,54 @@ class HybridChunker:
         """分割过大的块"""
         if chunk.chunk_type == ChunkType.PARENT:
             # 父块分割为多个子块
-            sub_chunks = []
+            sub_contents = []
             content = chunk.content
+            # 预先定位所有句号，循环内二分查找，避免重复扫描重叠区间
+            periods = [match.start() for match in _PERIOD_RE.finditer(content)]
             start = 0
             
             while start < len(content):
                 end = start + target_size
                 if end < len(content):
-                    # 尝试在句子边界分割
-                    sentence_end = content.rfind('.', start, end)
-                    if sentence_end > start + min_size:
-                        end = sentence_end + 1
+                    # 尝试在句子边界分割：取 end 之前最后一个句号
+                    period_index = bisect_left(periods, end) - 1
+                    if period_index >= 0 and periods[period_index] > start + min_size:
+                        end = periods[period_index] + 1
                 
                 sub_content = content[start:end].strip()
                 if sub_content:
-                    sub_chunk = HybridChunk(
-                        chunk_id=str(uuid.uuid4()),
-                        content=sub_content,
-                        chunk_type=ChunkType.CHILD,
-                        parent_id=chunk.chunk_id,
-                        metadata={
-                            "splitter": "optimization",
-                            "original_chunk_id": chunk.chunk_id,
-                            "sub_index": len(sub_chunks)
-                        },
-                        level=chunk.level + 1
-                    )
-                    sub_chunks.append(sub_chunk)
+                    sub_contents.append(sub_content)
                 
                 start = end
             
+            sub_chunks = []
+            for i, (sub_id, sub_content) in enumerate(zip(_gen_ids(len(sub_contents)), sub_contents)):
+                sub_chunk = HybridChunk(
+                    chunk_id=sub_id,
+                    content=sub_content,
+                    chunk_type=ChunkType.CHILD,
+                    parent_id=chunk.chunk_id,
+                    metadata={
+                        "splitter": "optimization",
+                        "original_chunk_id": chunk.chunk_id,
+                        "sub_index": i
+                    },
+                    level=chunk.level + 1
+                )
+                sub_chunks.append(sub_chunk)
+            
             return sub_chunks
         else:
             # 其他类型的块直接分割
-            splitter = self.text_splitter_factory.create_splitter(
-                "recursive",
-                chunk_size=target_size,
-                chunk_overlap=50
-            )
+            splitter = self._get_splitter("recursive", target_size, 50)
             
             text_chunks = splitter.split_text(chunk.content)
+            chunk_ids = _gen_ids(len(text_chunks))
             sub_chunks = []
             
             for i, text_chunk in enumerate(text_chunks):
                 sub_chunk = HybridChunk(
-                    chunk_id=str(uuid.uuid4()),
+                    chunk_id=chunk_ids[i],
                     content=text_chunk.content,
                     chunk_type=chunk.chunk_type,
                     parent_id=chunk.parent_id,
@@ -2,14 +2,40 @@
 HybridRetriever 混合检索模块
 支持向量检索和关键词检索的融合
 """
-from typing import List, Dict, Any, Optional, Tuple
+from typing import List, Dict, Any, Optional, Set, Tuple
 import asyncio
+import heapq
+import itertools
 import logging
+import threading
+import time
+from collections import OrderedDict
 from enum import Enum
-from collections import defaultdict
+from operator import itemgetter
+
+import numpy as np
+from cachetools import TTLCache
 
 logger = logging.getLogger(__name__)
 
+# 检索结果缓存：知识库内容会更新，缓存只短时间有效
+_RESULT_CACHE_SIZE = 1024
+_RESULT_CACHE_TTL = 300
+# 语义缓存保存的最近查询数
+_SEMANTIC_CACHE_SIZE = 256
+# 向量检索微批：单批最大查询数与最长等待时间
+_VECTOR_BATCH_SIZE = 32
+_VECTOR_BATCH_WAIT = 0.01
+
+# 知识库内容版本：内容变更时更新，缓存键包含所查知识库的版本，旧条目不再命中
+_kb_versions: Dict[str, int] = {}
+_kb_version_counter = itertools.count(1)
+
+
+def invalidate_retrieval_cache(kb_id: str) -> None:
+    """知识库内容变更（上传、删除）后调用，使所有检索器中该知识库的缓存结果失效"""
+    _kb_versions[kb_id] = next(_kb_version_counter)
+
 
 class FusionStrategy(str, Enum):
     """融合策略"""
@@ -20,12 +46,77 @@ class FusionStrategy(str, Enum):
     BORDA_COUNT = "borda_count"             # Borda计数
 
 
+class _BatchedVectorSearcher:
+    """向量检索微批器
+    
+    将并发 retrieve 调用的向量检索请求合并为一次 search_text_batch 调用：
+    凑满一批后立即提交；没有批次在执行时在本轮事件循环结束时提交（只合并
+    同时发起的请求，不额外等待），否则最多等待 max_wait 积累请求。
+    结果分发给各调用方
+    """
+    
+    def __init__(self, vector_service, max_batch: int = _VECTOR_BATCH_SIZE,
+                 max_wait: float = _VECTOR_BATCH_WAIT):
+        self.vector_service = vector_service
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._pending: List[Tuple[str, List[str], int, asyncio.Future]] = []
+        self._flush_handle: Optional[asyncio.Handle] = None
+        # 执行中的批次任务，保持引用直到完成
+        self._tasks: Set[asyncio.Task] = set()
+    
+    async def search(self, query: str, kb_ids: List[str], top_k: int) -> List[Dict]:
+        """提交一个检索请求并等待所在批次的结果"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((query, kb_ids, top_k, future))
+        
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._flush_handle is None:
+            if self._tasks:
+                self._flush_handle = loop.call_later(self.max_wait, self._flush)
+            else:
+                self._flush_handle = loop.call_soon(self._flush)
+        
+        return await future
+    
+    def _flush(self):
+        """提交当前批次"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.get_running_loop().create_task(self._run_batch(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+    
+    async def _run_batch(self, batch: List[Tuple[str, List[str], int, asyncio.Future]]):
+        """执行一批检索并分发结果"""
+        try:
+            results = await self.vector_service.search_text_batch(
+                [(query, kb_ids, top_k) for query, kb_ids, top_k, _ in batch]
+            )
+        except Exception as e:
+            for *_, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        
+        for (*_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+
 class HybridRetriever:
     """混合检索器"""
     
     def __init__(self, vector_service, keyword_service=None, 
                  weights: Optional[Dict[str, float]] = None,
-                 fusion_strategy: FusionStrategy = FusionStrategy.WEIGHTED_SUM):
+                 fusion_strategy: FusionStrategy = FusionStrategy.WEIGHTED_SUM,
+                 enable_result_cache: bool = False,
+                 semantic_cache_threshold: Optional[float] = None):
         self.vector_service = vector_service
         self.keyword_service = keyword_service
         self.weights = weights or {"vector": 0.7, "keyword": 0.3}
@@ -35,24 +126,132 @@ class HybridRetriever:
         total_weight = sum(self.weights.values())
         if total_weight > 0:
             self.weights = {k: v / total_weight for k, v in self.weights.items()}
+        
+        # 精确匹配缓存（可选）：(查询, 知识库及其版本, top_k, 融合配置) -> 检索结果
+        self.enable_result_cache = enable_result_cache
+        self._result_cache = TTLCache(maxsize=_RESULT_CACHE_SIZE, ttl=_RESULT_CACHE_TTL)
+        self._result_cache_lock = threading.Lock()
+        # 语义缓存（可选）：相似度不低于阈值的近似查询复用检索结果
+        # 值为 (缓存范围, 归一化查询向量, 结果, 过期时间)，按LRU淘汰
+        self.semantic_cache_threshold = semantic_cache_threshold
+        self._semantic_cache: "OrderedDict[str, Tuple[tuple, np.ndarray, List[Dict], float]]" = OrderedDict()
+        
+        # 向量服务支持批量检索时，合并并发请求（按类型判断，避免误判 Mock 等动态属性）
+        self._vector_batcher = None
+        if vector_service is not None and hasattr(type(vector_service), "search_text_batch"):
+            self._vector_batcher = _BatchedVectorSearcher(vector_service)
     
     async def retrieve(self, query: str, kb_ids: List[str], top_k: int = 10) -> List[Dict]:
-        """混合检索主入口"""
+        """混合检索主入口（带结果缓存）"""
+        if not self.enable_result_cache and self.semantic_cache_threshold is None:
+            return await self._retrieve_uncached(query, kb_ids, top_k)
+        
+        sorted_kb_ids = tuple(sorted(kb_ids or []))
+        scope = (
+            sorted_kb_ids, tuple(_kb_versions.get(kb_id, 0) for kb_id in sorted_kb_ids),
+            top_k, self.fusion_strategy.value, tuple(sorted(self.weights.items()))
+        )
+        cache_key = (query,) + scope
+        if self.enable_result_cache:
+            with self._result_cache_lock:
+                cached = self._result_cache.get(cache_key)
+            if cached is not None:
+                return self._copy_results(cached)
+        
+        query_embedding = None
+        if self.semantic_cache_threshold is not None:
+            query_embedding = await self._embed_query(query)
+            if query_embedding is not None:
+                cached = self._lookup_semantic_cache(scope, query_embedding)
+                if cached is not None:
+                    return self._copy_results(cached)
+        
+        results = await self._retrieve_uncached(query, kb_ids, top_k)
+        
+        # 空结果可能来自服务故障，不缓存
+        if results:
+            snapshot = self._copy_results(results)
+            if self.enable_result_cache:
+                with self._result_cache_lock:
+                    self._result_cache[cache_key] = snapshot
+            if query_embedding is not None:
+                self._store_semantic_cache(query, scope, query_embedding, snapshot)
+        
+        return results
+    
+    def clear_cache(self):
+        """清空检索结果缓存（知识库内容变更后调用）"""
+        with self._result_cache_lock:
+            self._result_cache.clear()
+        self._semantic_cache.clear()
+    
+    @staticmethod
+    def _copy_results(results: List[Dict]) -> List[Dict]:
+        """复制结果列表，避免下游修改影响缓存"""
+        return [dict(result) for result in results]
+    
+    async def _embed_query(self, query: str) -> Optional[np.ndarray]:
+        """获取归一化的查询向量，失败时返回 None"""
+        try:
+            # 与向量检索共用查询向量缓存，未命中语义缓存时检索无需再次向量化
+            embeddings = await self.vector_service.get_query_embeddings([query])
+            embedding = np.asarray(embeddings[0], dtype=np.float32)
+        except Exception as e:
+            logger.warning(f"语义缓存获取查询向量失败: {e}")
+            return None
+        norm = np.linalg.norm(embedding)
+        if norm == 0:
+            return None
+        return embedding / norm
+    
+    def _lookup_semantic_cache(self, scope: tuple, query_embedding: np.ndarray) -> Optional[List[Dict]]:
+        """在相同检索范围的近期查询中查找最相似的一条"""
+        now = time.monotonic()
+        candidates = [
+            (key, embedding, results)
+            for key, (entry_scope, embedding, results, expires_at) in self._semantic_cache.items()
+            if entry_scope == scope and expires_at > now and embedding.shape == query_embedding.shape
+        ]
+        if not candidates:
+            return None
+        
+        similarities = np.stack([embedding for _, embedding, _ in candidates]) @ query_embedding
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.semantic_cache_threshold:
+            return None
+        
+        key, _, results = candidates[best]
+        self._semantic_cache.move_to_end(key)
+        return results
+    
+    def _store_semantic_cache(self, query: str, scope: tuple, query_embedding: np.ndarray,
+                              results: List[Dict]):
+        """写入语义缓存，超出容量时淘汰最久未使用的条目"""
+        key = repr((query,) + scope)
+        self._semantic_cache[key] = (
+            scope, query_embedding, results, time.monotonic() + _RESULT_CACHE_TTL
+        )
+        self._semantic_cache.move_to_end(key)
+        while len(self._semantic_cache) > _SEMANTIC_CACHE_SIZE:
+            self._semantic_cache.popitem(last=False)
+    
+    async def _retrieve_uncached(self, query: str, kb_ids: List[str], top_k: int) -> List[Dict]:
+        """执行混合检索"""
         try:
-            # 1. 并行执行向量检索和关键词检索
+            # 1. 并行执行向量检索和关键词检索，结果按来源标记
             search_tasks = []
             
             # 向量检索
             if self.vector_service:
-                search_tasks.append(
-                    self._vector_search(query, kb_ids, top_k * 2)
-                )
+                search_tasks.append(self._tagged_search(
+                    "vector", self._vector_search(query, kb_ids, top_k * 2)
+                ))
             
             # 关键词检索
             if self.keyword_service:
-                search_tasks.append(
-                    self._keyword_search(query, kb_ids, top_k * 2)
-                )
+                search_tasks.append(self._tagged_search(
+                    "keyword", self._keyword_search(query, kb_ids, top_k * 2)
+                ))
             
             # 如果没有可用的检索服务，降级到简单检索
             if not search_tasks:
@@ -60,63 +259,52 @@ class HybridRetriever:
                 return await self._fallback_search(query, kb_ids, top_k)
             
             # 并行执行检索
-            search_results = await asyncio.gather(*search_tasks, return_exceptions=True)
+            results_by_source = dict(await asyncio.gather(*search_tasks))
             
             # 2. 处理检索结果
-            vector_results = []
-            keyword_results = []
-            
-            for i, result in enumerate(search_results):
-                if isinstance(result, Exception):
-                    logger.error(f"检索失败 {i}: {result}")
-                    continue
-                
-                if i == 0 and self.vector_service:
-                    vector_results = result
-                elif i == 1 and self.keyword_service:
-                    keyword_results = result
+            vector_results = results_by_source.get("vector", [])
+            keyword_results = results_by_source.get("keyword", [])
             
-            # 3. 结果融合
+            # 3. 结果融合（融合结果已按文档ID去重，直接取前 top_k 个）
             if vector_results and keyword_results:
                 merged_results = self._merge_results(vector_results, keyword_results)
-            elif vector_results:
-                merged_results = vector_results
-            elif keyword_results:
-                merged_results = keyword_results
-            else:
-                logger.warning("所有检索都失败，返回空结果")
-                return []
+                return heapq.nlargest(top_k, merged_results, key=itemgetter("fused_score"))
             
-            # 4. 去重和排序
-            final_results = self._deduplicate_and_sort(merged_results, top_k)
+            # 4. 单路结果去重和排序
+            if vector_results:
+                return self._deduplicate_and_sort(vector_results, top_k)
+            if keyword_results:
+                return self._deduplicate_and_sort(keyword_results, top_k)
             
-            return final_results
+            logger.warning("所有检索都失败，返回空结果")
+            return []
             
         except Exception as e:
             logger.error(f"混合检索失败: {e}")
             return await self._fallback_search(query, kb_ids, top_k)
     
+    @staticmethod
+    async def _tagged_search(source: str, search) -> Tuple[str, List[Dict]]:
+        """执行一路检索并标记来源，失败时返回空结果"""
+        try:
+            return source, await search
+        except Exception as e:
+            logger.error(f"检索失败 {source}: {e}")
+            return source, []
+    
     async def _vector_search(self, query: str, kb_ids: List[str], top_k: int) -> List[Dict]:
         """向量检索"""
         try:
-            # 使用现有的向量服务
-            search_results = await self.vector_service.hybrid_search(query, kb_ids, top_k)
+            if self._vector_batcher is not None:
+                # 与并发的其他查询合并为一次批量检索
+                text_results = await self._vector_batcher.search(query, kb_ids, top_k)
+            else:
+                # 使用现有的向量服务
+                search_results = await self.vector_service.hybrid_search(query, kb_ids, top_k)
+                text_results = search_results.get("text", [])
             
             # 处理结果格式
-            vector_results = []
-            if "text" in search_results:
-                for result in search_results["text"]:
-                    vector_results.append({
-                        "id": result["id"],
-                        "content": result["content"],
-                        "score": result["score"],
-                        "source": "vector",
-                        "source_file": result.get("source_file", ""),
-                        "knowledge_base_id": result.get("knowledge_base_id", ""),
-                        "metadata": result.get("metadata", {})
-                    })
-            
-            return vector_results
+            return self._normalize_results(text_results, "vector")
             
         except Exception as e:
             logger.error(f"向量检索失败: {e}")
@@ -132,208 +320,162 @@ class HybridRetriever:
             keyword_results = await self.keyword_service.search(query, kb_ids, top_k)
             
             # 处理结果格式
-            processed_results = []
-            for result in keyword_results:
-                processed_results.append({
-                    "id": result["id"],
-                    "content": result["content"],
-                    "score": result["score"],
-                    "source": "keyword",
-                    "source_file": result.get("source_file", ""),
-                    "knowledge_base_id": result.get("knowledge_base_id", ""),
-                    "metadata": result.get("metadata", {})
-                })
-            
-            return processed_results
+            return self._normalize_results(keyword_results, "keyword")
             
         except Exception as e:
             logger.error(f"关键词检索失败: {e}")
             return []
     
+    @staticmethod
+    def _normalize_results(results: List[Dict], source: str) -> List[Dict]:
+        """就地补全检索结果字段并标记来源
+        
+        检索服务每次调用都返回新建的结果字典，直接在其上补全字段，避免逐条复制
+        """
+        for result in results:
+            result["source"] = source
+            result.setdefault("source_file", "")
+            result.setdefault("knowledge_base_id", "")
+            result.setdefault("metadata", {})
+        return results
+    
     def _merge_results(self, vector_results: List[Dict], keyword_results: List[Dict]) -> List[Dict]:
-        """融合检索结果"""
-        if self.fusion_strategy == FusionStrategy.WEIGHTED_SUM:
-            return self._weighted_sum_fusion(vector_results, keyword_results)
-        elif self.fusion_strategy == FusionStrategy.RECIPROCAL_RANK:
-            return self._reciprocal_rank_fusion(vector_results, keyword_results)
-        elif self.fusion_strategy == FusionStrategy.COMB_SUM:
-            return self._comb_sum_fusion(vector_results, keyword_results)
-        elif self.fusion_strategy == FusionStrategy.COMB_MNZ:
-            return self._comb_mnz_fusion(vector_results, keyword_results)
-        elif self.fusion_strategy == FusionStrategy.BORDA_COUNT:
-            return self._borda_count_fusion(vector_results, keyword_results)
-        else:
-            return self._weighted_sum_fusion(vector_results, keyword_results)
+        """融合检索结果（按当前融合策略查表分派，未知策略使用加权求和）"""
+        fusion = _FUSION_METHODS.get(self.fusion_strategy, HybridRetriever._weighted_sum_fusion)
+        return fusion(self, vector_results, keyword_results)
     
-    def _weighted_sum_fusion(self, vector_results: List[Dict], keyword_results: List[Dict]) -> List[Dict]:
-        """加权求和融合"""
-        # 创建文档ID到结果的映射
-        doc_scores = defaultdict(lambda: {"vector_score": 0.0, "keyword_score": 0.0, "doc": None})
+    @staticmethod
+    def _index_results(vector_results: List[Dict], keyword_results: List[Dict]) -> Tuple[List[Dict], np.ndarray, np.ndarray]:
+        """为两路结果建立统一的文档下标
+        
+        返回去重后的文档列表（向量结果优先）以及两路结果各自对应的文档下标
+        """
+        id_to_idx: Dict[Any, int] = {}
+        docs: List[Dict] = []
         
-        # 处理向量检索结果
+        vector_idx = np.empty(len(vector_results), dtype=np.intp)
         for i, result in enumerate(vector_results):
-            doc_id = result["id"]
-            doc_scores[doc_id]["vector_score"] = result["score"]
-            doc_scores[doc_id]["doc"] = result
+            idx = id_to_idx.get(result["id"])
+            if idx is None:
+                idx = id_to_idx[result["id"]] = len(docs)
+                docs.append(result)
+            else:
+                docs[idx] = result
+            vector_idx[i] = idx
         
-        # 处理关键词检索结果
+        keyword_idx = np.empty(len(keyword_results), dtype=np.intp)
         for i, result in enumerate(keyword_results):
-            doc_id = result["id"]
-            doc_scores[doc_id]["keyword_score"] = result["score"]
-            if doc_scores[doc_id]["doc"] is None:
-                doc_scores[doc_id]["doc"] = result
+            idx = id_to_idx.get(result["id"])
+            if idx is None:
+                idx = id_to_idx[result["id"]] = len(docs)
+                docs.append(result)
+            keyword_idx[i] = idx
         
-        # 计算融合分数
-        merged_results = []
-        for doc_id, scores in doc_scores.items():
-            doc = scores["doc"]
-            fused_score = (
-                scores["vector_score"] * self.weights["vector"] +
-                scores["keyword_score"] * self.weights["keyword"]
-            )
-            
-            merged_results.append({
-                **doc,
-                "fused_score": fused_score,
-                "vector_score": scores["vector_score"],
-                "keyword_score": scores["keyword_score"]
-            })
+        return docs, vector_idx, keyword_idx
+    
+    @staticmethod
+    def _scatter(size: int, indices: np.ndarray, values: np.ndarray, fill: float) -> np.ndarray:
+        """将一路结果的分值按文档下标写入长度为 size 的数组，缺失处为 fill"""
+        scattered = np.full(size, fill, dtype=np.float64)
+        scattered[indices] = values
+        return scattered
+    
+    @staticmethod
+    def _result_scores(results: List[Dict]) -> np.ndarray:
+        """提取结果分数"""
+        return np.fromiter((r["score"] for r in results), dtype=np.float64, count=len(results))
+    
+    def _score_fusion(self, vector_results: List[Dict], keyword_results: List[Dict],
+                      vector_values: np.ndarray, keyword_values: np.ndarray) -> List[Dict]:
+        """按两路分值加权求和融合（未命中的一路记 0 分）"""
+        docs, vector_idx, keyword_idx = self._index_results(vector_results, keyword_results)
+        vector_scores = self._scatter(len(docs), vector_idx, vector_values, 0.0)
+        keyword_scores = self._scatter(len(docs), keyword_idx, keyword_values, 0.0)
+        fused_scores = vector_scores * self.weights["vector"] + keyword_scores * self.weights["keyword"]
+        
+        # 检索结果字典由本模块独占，直接写入融合分数
+        for doc, fused_score, vector_score, keyword_score in zip(
+            docs, fused_scores.tolist(), vector_scores.tolist(), keyword_scores.tolist()
+        ):
+            doc["fused_score"] = fused_score
+            doc["vector_score"] = vector_score
+            doc["keyword_score"] = keyword_score
         
-        return merged_results
+        return docs
+    
+    def _weighted_sum_fusion(self, vector_results: List[Dict], keyword_results: List[Dict]) -> List[Dict]:
+        """加权求和融合"""
+        return self._score_fusion(
+            vector_results, keyword_results,
+            self._result_scores(vector_results),
+            self._result_scores(keyword_results)
+        )
     
     def _reciprocal_rank_fusion(self, vector_results: List[Dict], keyword_results: List[Dict]) -> List[Dict]:
         """倒数排名融合"""
-        doc_ranks = defaultdict(lambda: {"vector_rank": float('inf'), "keyword_rank": float('inf'), "doc": None})
+        docs, vector_idx, keyword_idx = self._index_results(vector_results, keyword_results)
         
-        # 记录向量检索排名
-        for i, result in enumerate(vector_results):
-            doc_id = result["id"]
-            doc_ranks[doc_id]["vector_rank"] = i + 1
-            doc_ranks[doc_id]["doc"] = result
-        
-        # 记录关键词检索排名
-        for i, result in enumerate(keyword_results):
-            doc_id = result["id"]
-            doc_ranks[doc_id]["keyword_rank"] = i + 1
-            if doc_ranks[doc_id]["doc"] is None:
-                doc_ranks[doc_id]["doc"] = result
+        # 未出现在某一路结果中的文档排名记为无穷大（贡献为 0）
+        vector_ranks = self._scatter(
+            len(docs), vector_idx, np.arange(1, len(vector_results) + 1), np.inf
+        )
+        keyword_ranks = self._scatter(
+            len(docs), keyword_idx, np.arange(1, len(keyword_results) + 1), np.inf
+        )
+        fused_scores = (
+            self.weights["vector"] / vector_ranks +
+            self.weights["keyword"] / keyword_ranks
+        )
         
-        # 计算融合分数
-        merged_results = []
-        for doc_id, ranks in doc_ranks.items():
-            doc = ranks["doc"]
-            fused_score = (
-                1.0 / ranks["vector_rank"] * self.weights["vector"] +
-                1.0 / ranks["keyword_rank"] * self.weights["keyword"]
-            )
-            
-            merged_results.append({
-                **doc,
-                "fused_score": fused_score,
-                "vector_rank": ranks["vector_rank"],
-                "keyword_rank": ranks["keyword_rank"]
-            })
+        for doc, fused_score, vector_rank, keyword_rank in zip(
+            docs, fused_scores.tolist(), vector_ranks.tolist(), keyword_ranks.tolist()
+        ):
+            doc["fused_score"] = fused_score
+            doc["vector_rank"] = int(vector_rank) if vector_rank != float('inf') else vector_rank
+            doc["keyword_rank"] = int(keyword_rank) if keyword_rank != float('inf') else keyword_rank
         
-        return merged_results
-    
-    def _comb_sum_fusion(self, vector_results: List[Dict], keyword_results: List[Dict]) -> List[Dict]:
-        """组合求和融合"""
-        return self._weighted_sum_fusion(vector_results, keyword_results)
+        return docs
     
     def _comb_mnz_fusion(self, vector_results: List[Dict], keyword_results: List[Dict]) -> List[Dict]:
         """组合最大归一化融合"""
-        # 获取最大分数用于归一化
-        max_vector_score = max([r["score"] for r in vector_results]) if vector_results else 1.0
-        max_keyword_score = max([r["score"] for r in keyword_results]) if keyword_results else 1.0
-        
-        doc_scores = defaultdict(lambda: {"vector_score": 0.0, "keyword_score": 0.0, "doc": None})
-        
-        # 处理向量检索结果
-        for result in vector_results:
-            doc_id = result["id"]
-            doc_scores[doc_id]["vector_score"] = result["score"] / max_vector_score
-            doc_scores[doc_id]["doc"] = result
+        vector_scores = self._result_scores(vector_results)
+        keyword_scores = self._result_scores(keyword_results)
         
-        # 处理关键词检索结果
-        for result in keyword_results:
-            doc_id = result["id"]
-            doc_scores[doc_id]["keyword_score"] = result["score"] / max_keyword_score
-            if doc_scores[doc_id]["doc"] is None:
-                doc_scores[doc_id]["doc"] = result
-        
-        # 计算融合分数
-        merged_results = []
-        for doc_id, scores in doc_scores.items():
-            doc = scores["doc"]
-            fused_score = (
-                scores["vector_score"] * self.weights["vector"] +
-                scores["keyword_score"] * self.weights["keyword"]
-            )
-            
-            merged_results.append({
-                **doc,
-                "fused_score": fused_score,
-                "vector_score": scores["vector_score"],
-                "keyword_score": scores["keyword_score"]
-            })
+        # 按各自最大分数归一化
+        max_vector_score = vector_scores.max() if vector_scores.size else 1.0
+        max_keyword_score = keyword_scores.max() if keyword_scores.size else 1.0
         
-        return merged_results
+        return self._score_fusion(
+            vector_results, keyword_results,
+            vector_scores / (max_vector_score or 1.0),
+            keyword_scores / (max_keyword_score or 1.0)
+        )
     
     def _borda_count_fusion(self, vector_results: List[Dict], keyword_results: List[Dict]) -> List[Dict]:
         """Borda计数融合"""
-        doc_scores = defaultdict(lambda: {"vector_score": 0.0, "keyword_score": 0.0, "doc": None})
-        
         # 计算Borda分数
         max_rank = max(len(vector_results), len(keyword_results))
         
-        # 处理向量检索结果
-        for i, result in enumerate(vector_results):
-            doc_id = result["id"]
-            doc_scores[doc_id]["vector_score"] = max_rank - i
-            doc_scores[doc_id]["doc"] = result
-        
-        # 处理关键词检索结果
-        for i, result in enumerate(keyword_results):
-            doc_id = result["id"]
-            doc_scores[doc_id]["keyword_score"] = max_rank - i
-            if doc_scores[doc_id]["doc"] is None:
-                doc_scores[doc_id]["doc"] = result
-        
-        # 计算融合分数
-        merged_results = []
-        for doc_id, scores in doc_scores.items():
-            doc = scores["doc"]
-            fused_score = (
-                scores["vector_score"] * self.weights["vector"] +
-                scores["keyword_score"] * self.weights["keyword"]
-            )
-            
-            merged_results.append({
-                **doc,
-                "fused_score": fused_score,
-                "vector_score": scores["vector_score"],
-                "keyword_score": scores["keyword_score"]
-            })
-        
-        return merged_results
+        return self._score_fusion(
+            vector_results, keyword_results,
+            max_rank - np.arange(len(vector_results), dtype=np.float64),
+            max_rank - np.arange(len(keyword_results), dtype=np.float64)
+        )
     
     def _deduplicate_and_sort(self, results: List[Dict], top_k: int) -> List[Dict]:
-        """去重和排序"""
-        # 按文档ID去重，保留最高分数的版本
-        unique_docs = {}
+        """去重并取分数最高的 top_k 个结果"""
+        # 按文档ID去重，保留最高分数的版本（排序键在去重时计算一次）
+        unique_docs: Dict[Any, Tuple[float, Dict]] = {}
         for result in results:
             doc_id = result["id"]
-            if doc_id not in unique_docs or result.get("fused_score", result["score"]) > unique_docs[doc_id].get("fused_score", unique_docs[doc_id]["score"]):
-                unique_docs[doc_id] = result
-        
-        # 按融合分数排序
-        sorted_results = sorted(
-            unique_docs.values(),
-            key=lambda x: x.get("fused_score", x["score"]),
-            reverse=True
-        )
+            score = result.get("fused_score", result["score"])
+            existing = unique_docs.get(doc_id)
+            if existing is None or score > existing[0]:
+                unique_docs[doc_id] = (score, result)
         
-        return sorted_results[:top_k]
+        # 只选出前 top_k 个，无需对全部结果排序
+        top_entries = heapq.nlargest(top_k, unique_docs.values(), key=itemgetter(0))
+        return [result for _, result in top_entries]
     
     async def _fallback_search(self, query: str, kb_ids: List[str], top_k: int) -> List[Dict]:
         """降级检索"""
@@ -376,4 +518,14 @@ class HybridRetriever:
             "fallback_results": fallback_count,
             "fusion_strategy": self.fusion_strategy.value,
             "weights": self.weights
-        } 
\ No newline at end of file
+        } 
+
+
+# 融合策略分派表（组合求和与加权求和计算方式相同）
+_FUSION_METHODS = {
+    FusionStrategy.WEIGHTED_SUM: HybridRetriever._weighted_sum_fusion,
+    FusionStrategy.RECIPROCAL_RANK: HybridRetriever._reciprocal_rank_fusion,
+    FusionStrategy.COMB_SUM: HybridRetriever._weighted_sum_fusion,
+    FusionStrategy.COMB_MNZ: HybridRetriever._comb_mnz_fusion,
+    FusionStrategy.BORDA_COUNT: HybridRetriever._borda_count_fusion,
+}
@@ -1,17 +1,95 @@
 """
 知识库服务
 """
+from sqlalchemy import func, insert
 from sqlalchemy.orm import Session
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Tuple, Iterable, Iterator
 from fastapi import UploadFile
 import uuid
 import os
-from datetime import datetime
+import io
+import codecs
+import shutil
 import asyncio
 
 from app.models.knowledge_base import KnowledgeBase, KnowledgeBaseChunk as TextChunk, KnowledgeBaseImage as ImageVector
 from app.core.config import settings
+from app.core.database import commit_without_expire
 from app.services.vector_service import VectorService
+from app.services.hybrid_retriever import invalidate_retrieval_cache
+
+# 上传文件按块写入磁盘，单个请求的内存占用与文件大小无关
+_UPLOAD_CHUNK_SIZE = 1 << 20
+
+# 允许上传的扩展名（小写集合，O(1) 查找）
+_ALLOWED_EXTENSIONS = frozenset(ext.lower() for ext in settings.ALLOWED_EXTENSIONS)
+_IMAGE_EXTENSIONS = frozenset({"jpg", "jpeg", "png", "gif"})
+
+
+def _file_extension(filename: str) -> str:
+    """获取文件扩展名（小写，不含点）"""
+    return os.path.splitext(filename)[1][1:].lower()
+
+
+def _iter_file_paragraphs(file_path: str) -> Iterator[str]:
+    """按块读取文本文件并逐个产出段落（等价于 text.split('\\n\\n')）
+    
+    使用增量 UTF-8 解码，无需一次性读入并解码整个文件。
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+    # 尚未遇到段落分隔符的文本片段
+    pending: List[str] = []
+    with open(file_path, "rb") as f:
+        while block := f.read(_UPLOAD_CHUNK_SIZE):
+            piece = decoder.decode(block)
+            if not piece:
+                continue
+            # 分隔符可能跨越两个片段的边界
+            if "\n\n" in piece or (piece[0] == "\n" and pending and pending[-1].endswith("\n")):
+                parts = ("".join(pending) + piece).split("\n\n")
+                pending = [parts.pop()]
+                yield from parts
+            else:
+                pending.append(piece)
+    yield "".join(pending) + decoder.decode(b"", final=True)
+
+
+def _copy_upload_file(src, file_path: str) -> int:
+    """将上传文件的底层文件对象复制到 file_path，返回文件大小
+    
+    源文件有文件描述符时使用 os.sendfile 在内核态复制，
+    没有文件描述符或平台不支持时退回 shutil.copyfileobj 分块复制。
+    """
+    src.seek(0, os.SEEK_END)
+    size = src.tell()
+    src.seek(0)
+    
+    # 没有文件描述符的文件对象（如 BytesIO）直接分块复制；
+    # 未溢出的 SpooledTemporaryFile 会在 fileno() 时先落盘，其大小不超过内存上限
+    src_fd = None
+    if hasattr(os, "sendfile"):
+        try:
+            src_fd = src.fileno()
+        except (OSError, io.UnsupportedOperation):
+            src_fd = None
+    with open(file_path, "wb") as buffer:
+        if src_fd is not None:
+            try:
+                offset = 0
+                while offset < size:
+                    sent = os.sendfile(buffer.fileno(), src_fd, offset, size - offset)
+                    if sent == 0:
+                        break
+                    offset += sent
+                if offset == size:
+                    return size
+            except (OSError, io.UnsupportedOperation):
+                pass
+            src.seek(0)
+            buffer.seek(0)
+            buffer.truncate()
+        shutil.copyfileobj(src, buffer, _UPLOAD_CHUNK_SIZE)
+    return size
 
 class KnowledgeBaseService:
     """知识库服务类"""
@@ -35,24 +113,22 @@ class KnowledgeBaseService:
     
     def get_knowledge_base_chunks(self, kb_id: str, user_id: str) -> List[TextChunk]:
         """获取知识库的文本分块"""
-        # 先检查权限
-        kb = self.get_knowledge_base_by_id(kb_id, user_id)
-        if not kb:
-            return []
-        
-        return self.db.query(TextChunk).filter(
-            TextChunk.knowledge_base_id == kb_id
+        # 通过关联知识库表在同一查询中完成权限检查，无权限时返回空列表
+        return self.db.query(TextChunk).join(
+            KnowledgeBase, KnowledgeBase.id == TextChunk.knowledge_base_id
+        ).filter(
+            KnowledgeBase.id == kb_id,
+            KnowledgeBase.owner_id == user_id
         ).order_by(TextChunk.chunk_index).all()
     
     def get_knowledge_base_images(self, kb_id: str, user_id: str) -> List[ImageVector]:
         """获取知识库的图片"""
-        # 先检查权限
-        kb = self.get_knowledge_base_by_id(kb_id, user_id)
-        if not kb:
-            return []
-        
-        return self.db.query(ImageVector).filter(
-            ImageVector.knowledge_base_id == kb_id
+        # 通过关联知识库表在同一查询中完成权限检查，无权限时返回空列表
+        return self.db.query(ImageVector).join(
+            KnowledgeBase, KnowledgeBase.id == ImageVector.knowledge_base_id
+        ).filter(
+            KnowledgeBase.id == kb_id,
+            KnowledgeBase.owner_id == user_id
         ).order_by(ImageVector.created_at.desc()).all()
     
     def create_knowledge_base(self, user_id: str, name: str, description: str = "") -> KnowledgeBase:
@@ -75,7 +151,7 @@ class KnowledgeBaseService:
         
         knowledge_base.name = name
         knowledge_base.description = description
-        knowledge_base.updated_at = datetime.utcnow()
+        knowledge_base.updated_at = func.now()
         
         self.db.commit()
         self.db.refresh(knowledge_base)
@@ -89,6 +165,7 @@ class KnowledgeBaseService:
         
         self.db.delete(knowledge_base)
         self.db.commit()
+        invalidate_retrieval_cache(kb_id)
         return True
     
     async def upload_document(
@@ -100,7 +177,8 @@ class KnowledgeBaseService:
         """上传文档到知识库"""
         try:
             # 检查知识库权限
-            knowledge_base = self.get_knowledge_base_by_id(kb_id, user_id)
+            # 同步数据库调用放到线程池中执行，避免阻塞事件循环
+            knowledge_base = await asyncio.to_thread(self.get_knowledge_base_by_id, kb_id, user_id)
             if not knowledge_base:
                 return {
                     "success": False,
@@ -108,44 +186,30 @@ class KnowledgeBaseService:
                 }
             
             # 检查文件类型
-            file_extension = file.filename.split('.')[-1].lower()
-            if file_extension not in settings.ALLOWED_EXTENSIONS:
+            file_extension = _file_extension(file.filename)
+            if file_extension not in _ALLOWED_EXTENSIONS:
                 return {
                     "success": False,
                     "message": f"不支持的文件类型: {file_extension}"
                 }
             
             # 保存文件
-            file_path = os.path.join(settings.UPLOAD_DIR, f"{uuid.uuid4()}_{file.filename}")
-            with open(file_path, "wb") as buffer:
-                content = await file.read()
-                buffer.write(content)
-            
-            # 创建文本分块
-            chunks = self._create_text_chunks(content.decode('utf-8', errors='ignore'), file.filename)
-            created_chunks = []
-            
-            for i, chunk_content in enumerate(chunks):
-                text_chunk = TextChunk(
-                    knowledge_base_id=kb_id,
-                    content=chunk_content,
-                    source_file=file.filename,
-                    chunk_index=i
-                )
-                self.db.add(text_chunk)
-                created_chunks.append(text_chunk)
-            
-            self.db.commit()
+            file_path, _ = await self._save_upload(file)
             
-            # 异步向量化所有分块
-            vectorization_tasks = []
-            for chunk in created_chunks:
-                task = self.vector_service.vectorize_text_chunk(chunk)
-                vectorization_tasks.append(task)
+            # 从磁盘流式读取段落并创建分块
+            chunks = await asyncio.to_thread(
+                self._create_text_chunks, _iter_file_paragraphs(file_path), file.filename
+            )
+            created_chunks = await asyncio.to_thread(
+                self._add_text_chunks, kb_id, file.filename, chunks
+            )
             
-            # 等待所有向量化任务完成
-            if vectorization_tasks:
-                await asyncio.gather(*vectorization_tasks, return_exceptions=True)
+            # 批量向量化所有分块（内容未变化的分块复用缓存向量）
+            try:
+                await self.vector_service.vectorize_text_chunks(created_chunks)
+            finally:
+                # 知识库内容已变更，检索结果缓存失效
+                invalidate_retrieval_cache(kb_id)
             
             return {
                 "success": True,
@@ -170,7 +234,8 @@ class KnowledgeBaseService:
         """上传图片到知识库"""
         try:
             # 检查知识库权限
-            knowledge_base = self.get_knowledge_base_by_id(kb_id, user_id)
+            # 同步数据库调用放到线程池中执行，避免阻塞事件循环
+            knowledge_base = await asyncio.to_thread(self.get_knowledge_base_by_id, kb_id, user_id)
             if not knowledge_base:
                 return {
                     "success": False,
@@ -178,18 +243,15 @@ class KnowledgeBaseService:
                 }
             
             # 检查文件类型
-            file_extension = file.filename.split('.')[-1].lower()
-            if file_extension not in ['jpg', 'jpeg', 'png', 'gif']:
+            file_extension = _file_extension(file.filename)
+            if file_extension not in _IMAGE_EXTENSIONS:
                 return {
                     "success": False,
                     "message": f"不支持的图片格式: {file_extension}"
                 }
             
             # 保存文件
-            file_path = os.path.join(settings.UPLOAD_DIR, f"{uuid.uuid4()}_{file.filename}")
-            with open(file_path, "wb") as buffer:
-                content = await file.read()
-                buffer.write(content)
+            file_path, _ = await self._save_upload(file)
             
             # 创建图片记录
             image_vector = ImageVector(
@@ -198,12 +260,13 @@ class KnowledgeBaseService:
                 description=description,
                 file_path=file_path
             )
-            self.db.add(image_vector)
-            self.db.commit()
-            self.db.refresh(image_vector)
+            await asyncio.to_thread(self._add_and_commit, image_vector)
             
             # 异步向量化图片
-            await self.vector_service.vectorize_image(image_vector)
+            try:
+                await self.vector_service.vectorize_image(image_vector)
+            finally:
+                invalidate_retrieval_cache(kb_id)
             
             return {
                 "success": True,
@@ -218,44 +281,95 @@ class KnowledgeBaseService:
                 "message": f"上传失败: {str(e)}"
             }
     
-    def _create_text_chunks(self, text: str, filename: str) -> List[str]:
-        """创建文本分块（改进版）"""
-        # 按段落分割
-        paragraphs = text.split('\n\n')
+    def _add_text_chunks(self, kb_id: str, source_file: str, chunks: List[str]) -> List[TextChunk]:
+        """在同一事务中保存文档的所有文本分块
+        
+        使用批量 INSERT ... RETURNING，一条语句写入所有分块并返回带主键和
+        创建时间的对象，省去逐个对象的工作单元开销。
+        """
+        if not chunks:
+            return []
+        text_chunks = list(self.db.scalars(
+            insert(TextChunk).returning(TextChunk),
+            [
+                {
+                    "knowledge_base_id": kb_id,
+                    "content": chunk_content,
+                    "source_file": source_file,
+                    "chunk_index": i
+                }
+                for i, chunk_content in enumerate(chunks)
+            ]
+        ))
+        # RETURNING 已加载全部字段，向量化时读取分块不再逐个查询
+        commit_without_expire(self.db)
+        return text_chunks
+    
+    def _add_and_commit(self, instance) -> None:
+        """保存单条记录并刷新"""
+        self.db.add(instance)
+        self.db.commit()
+        self.db.refresh(instance)
+    
+    async def _save_upload(self, file: UploadFile) -> Tuple[str, int]:
+        """将上传文件写入上传目录，返回 (文件路径, 文件大小)
+        
+        复制失败时删除已写入的部分；文件大小限制由 API 层在调用前检查。
+        """
+        file_path = os.path.join(settings.UPLOAD_DIR, f"{uuid.uuid4()}_{file.filename}")
+        try:
+            # 文件复制放到线程池中执行，避免阻塞事件循环
+            size = await asyncio.to_thread(_copy_upload_file, file.file, file_path)
+        except Exception:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+            raise
+        return file_path, size
+    
+    def _create_text_chunks(self, paragraphs: Iterable[str], filename: str) -> List[str]:
+        """创建文本分块（改进版），paragraphs 为按 '\\n\\n' 分割的段落序列"""
         chunks = []
-        current_chunk = ""
+        # 当前块的段落列表及拼接后的长度，输出时再一次性拼接
+        current_parts: List[str] = []
+        current_len = 0
+        # 首个非空段落之前的空白段落，全文均为空白时用于还原整个文本
+        leading_blanks: List[str] = []
+        # 重叠策略：上一个块（未加重叠前）的结尾，在输出下一个块时直接拼接到开头
+        overlap = settings.CHUNK_OVERLAP
+        prev_tail: Optional[str] = None
+        
+        def emit(parts: List[str]) -> None:
+            nonlocal prev_tail
+            chunk = "\n\n".join(parts)
+            chunks.append(chunk if prev_tail is None else prev_tail + "\n\n" + chunk)
+            if overlap > 0:
+                prev_tail = chunk[-overlap:]
         
         for paragraph in paragraphs:
-            paragraph = paragraph.strip()
-            if not paragraph:
+            stripped = paragraph.strip()
+            if not stripped:
+                if not current_parts:
+                    leading_blanks.append(paragraph)
                 continue
+            paragraph = stripped
+            paragraph_len = len(paragraph)
                 
             # 如果当前块加上新段落超过限制，保存当前块
-            if len(current_chunk) + len(paragraph) > settings.CHUNK_SIZE:
-                if current_chunk:
-                    chunks.append(current_chunk.strip())
-                current_chunk = paragraph
+            if current_len + paragraph_len > settings.CHUNK_SIZE:
+                if current_parts:
+                    emit(current_parts)
+                current_parts = [paragraph]
+                current_len = paragraph_len
             else:
-                current_chunk += "\n\n" + paragraph if current_chunk else paragraph
+                current_len = current_len + 2 + paragraph_len if current_parts else paragraph_len
+                current_parts.append(paragraph)
         
         # 保存最后一个块
-        if current_chunk:
-            chunks.append(current_chunk.strip())
+        if current_parts:
+            emit(current_parts)
         
         # 如果没有分块，将整个文本作为一个块
         if not chunks:
-            chunks = [text]
-        
-        # 应用重叠策略
-        if len(chunks) > 1 and settings.CHUNK_OVERLAP > 0:
-            overlapped_chunks = []
-            for i, chunk in enumerate(chunks):
-                if i > 0:
-                    # 添加前一个块的结尾作为重叠
-                    prev_chunk = chunks[i-1]
-                    overlap_text = prev_chunk[-settings.CHUNK_OVERLAP:]
-                    chunk = overlap_text + "\n\n" + chunk
-                overlapped_chunks.append(chunk)
-            chunks = overlapped_chunks
+            chunks = ["\n\n".join(leading_blanks)]
         
-        return chunks 
\ No newline at end of file
+        return chunks
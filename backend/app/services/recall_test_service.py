@@ -1,3 +1,4 @@
+from sqlalchemy import func
 from sqlalchemy.orm import Session
 from typing import List, Optional
 from fastapi import HTTPException, status
@@ -6,7 +7,6 @@ from app.models.knowledge_base import KnowledgeBase, KnowledgeBaseChunk as TextC
 from app.schemas.recall_test import (
     RecallTestCreate, RecallTestUpdate, RecallTestCaseCreate, RecallTestCaseUpdate, BatchTestCaseImport, RecallTestRunRequest
 )
-from datetime import datetime
 import time
 
 class RecallTestService:
@@ -48,7 +48,7 @@ class RecallTestService:
             test.description = data.description
         if data.config:
             test.config = data.config
-        test.updated_at = datetime.utcnow()
+        test.updated_at = func.now()
         self.db.commit()
         return test
 
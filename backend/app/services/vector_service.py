@@ -2,18 +2,25 @@
 向量化服务
 """
 import asyncio
-import aiohttp
 import numpy as np
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Tuple
 from sqlalchemy.orm import Session
 import logging
 from app.core.config import settings
+from app.services.embedding_router import (
+    embedding_cache_key, get_cached_embeddings, cache_embeddings, get_http_session
+)
 from app.models.knowledge_base import KnowledgeBaseChunk as TextChunk, KnowledgeBaseImage as ImageVector
 import qdrant_client
-from qdrant_client.models import Distance, VectorParams, PointStruct
+from qdrant_client.models import Distance, VectorParams, PointStruct, SearchRequest
 
 logger = logging.getLogger(__name__)
 
+# 单次向量化请求的最大分块数
+_CHUNK_EMBEDDING_BATCH_SIZE = 256
+# 同时进行的批量向量化请求数上限，避免大文档触发接口限流
+_MAX_CONCURRENT_CHUNK_BATCHES = 4
+
 class VectorService:
     """向量化服务类"""
     
@@ -50,35 +57,71 @@ class VectorService:
     
     async def get_text_embedding(self, text: str) -> List[float]:
         """获取文本向量"""
-        if not settings.OPENAI_API_KEY:
+        embeddings = await self._fetch_text_embeddings([text])
+        if embeddings is None:
             # 使用简单的TF-IDF作为fallback
             return self._simple_text_embedding(text)
+        return embeddings[0]
+    
+    async def get_query_embeddings(self, queries: List[str]) -> List[List[float]]:
+        """获取查询向量，与分块向量共用 embedding_router 的共享向量缓存（降级向量不缓存）"""
+        model = settings.TEXT_EMBEDDING_MODEL
+        keys = [embedding_cache_key(query, model) for query in queries]
+        embeddings = await get_cached_embeddings(keys)
+        
+        # 未命中的查询按键去重后一次请求
+        missing: Dict[bytes, str] = {}
+        for key, query, embedding in zip(keys, queries, embeddings):
+            if embedding is None:
+                missing[key] = query
+        if not missing:
+            return embeddings
+        
+        fetched = await self._fetch_text_embeddings(list(missing.values()))
+        if fetched is None:
+            resolved = {key: self._simple_text_embedding(query) for key, query in missing.items()}
+        else:
+            restored = await cache_embeddings([
+                (key, model, embedding) for key, embedding in zip(missing, fetched)
+            ])
+            resolved = dict(zip(missing, restored))
+        
+        return [
+            embedding if embedding is not None else resolved[key]
+            for key, embedding in zip(keys, embeddings)
+        ]
+    
+    async def _fetch_text_embeddings(self, texts: List[str]) -> Optional[List[List[float]]]:
+        """通过接口批量获取文本向量，未配置或请求失败时返回 None"""
+        if not settings.OPENAI_API_KEY:
+            return None
         
         try:
-            async with aiohttp.ClientSession() as session:
-                headers = {
-                    "Authorization": f"Bearer {settings.OPENAI_API_KEY}",
-                    "Content-Type": "application/json"
-                }
-                data = {
-                    "input": text,
-                    "model": settings.TEXT_EMBEDDING_MODEL
-                }
-                
-                async with session.post(
-                    f"{settings.OPENAI_BASE_URL}/embeddings",
-                    headers=headers,
-                    json=data
-                ) as response:
-                    if response.status == 200:
-                        result = await response.json()
-                        return result["data"][0]["embedding"]
-                    else:
-                        logger.warning(f"OpenAI embedding failed: {response.status}")
-                        return self._simple_text_embedding(text)
+            # 复用 embedding_router 的共享HTTP会话（连接池）
+            session = await get_http_session()
+            headers = {
+                "Authorization": f"Bearer {settings.OPENAI_API_KEY}",
+                "Content-Type": "application/json"
+            }
+            data = {
+                "input": texts,
+                "model": settings.TEXT_EMBEDDING_MODEL
+            }
+            
+            async with session.post(
+                f"{settings.OPENAI_BASE_URL}/embeddings",
+                headers=headers,
+                json=data
+            ) as response:
+                if response.status == 200:
+                    result = await response.json()
+                    items = sorted(result["data"], key=lambda item: item["index"])
+                    return [item["embedding"] for item in items]
+                else:
+                    logger.warning(f"OpenAI embedding failed: {response.status}")
         except Exception as e:
             logger.error(f"Text embedding error: {e}")
-            return self._simple_text_embedding(text)
+        return None
     
     def _simple_text_embedding(self, text: str) -> List[float]:
         """简单的文本向量化（fallback）"""
@@ -147,6 +190,78 @@ class VectorService:
             logger.error(f"Vectorize text chunk error: {e}")
             return False
     
+    async def vectorize_text_chunks(self, chunks: List[TextChunk]) -> int:
+        """批量向量化文本分块，返回成功写入的分块数
+        
+        按 (模型, 内容) 哈希命中共享向量缓存（内存LRU，配置后还有磁盘缓存），
+        重复上传或版本化文档的相同分块无需重新向量化；仅对未缓存的分块
+        分批请求向量（限制并发批次数），所有分块一次写入Qdrant。
+        """
+        if not chunks:
+            return 0
+        
+        model = settings.TEXT_EMBEDDING_MODEL
+        keys = [embedding_cache_key(chunk.content, model) for chunk in chunks]
+        # 一次批量读取缓存（磁盘缓存只查询一次）
+        cached_vectors = await get_cached_embeddings(keys)
+        
+        vectors: Dict[bytes, Optional[List[float]]] = {}
+        missing: List[Tuple[bytes, str]] = []
+        for chunk, digest, cached in zip(chunks, keys, cached_vectors):
+            if digest in vectors:
+                continue
+            vectors[digest] = cached
+            if cached is None:
+                # 同一批次内的重复分块只请求一次
+                missing.append((digest, chunk.content))
+        
+        semaphore = asyncio.Semaphore(_MAX_CONCURRENT_CHUNK_BATCHES)
+        
+        async def embed_batch(batch: List[Tuple[bytes, str]]) -> None:
+            async with semaphore:
+                fetched = await self._fetch_text_embeddings([content for _, content in batch])
+            if fetched is None:
+                # 降级向量不缓存，接口恢复后可重新获取
+                for digest, content in batch:
+                    vectors[digest] = self._simple_text_embedding(content)
+                return
+            # 使用缓存还原后的向量，与缓存命中时写入的向量一致
+            restored = await cache_embeddings([
+                (digest, model, embedding)
+                for (digest, _), embedding in zip(batch, fetched)
+            ])
+            for (digest, _), embedding in zip(batch, restored):
+                vectors[digest] = embedding
+        
+        await asyncio.gather(*(
+            embed_batch(missing[start:start + _CHUNK_EMBEDDING_BATCH_SIZE])
+            for start in range(0, len(missing), _CHUNK_EMBEDDING_BATCH_SIZE)
+        ))
+        
+        try:
+            points = [
+                PointStruct(
+                    id=str(chunk.id),
+                    vector=vectors[digest],
+                    payload={
+                        "content": chunk.content,
+                        "source_file": chunk.source_file,
+                        "chunk_index": chunk.chunk_index,
+                        "knowledge_base_id": str(chunk.knowledge_base_id),
+                        "created_at": chunk.created_at.isoformat()
+                    }
+                )
+                for chunk, digest in zip(chunks, keys)
+            ]
+            self.qdrant_client.upsert(
+                collection_name="text_vectors",
+                points=points
+            )
+            return len(points)
+        except Exception as e:
+            logger.error(f"Vectorize text chunks error: {e}")
+            return 0
+    
     async def vectorize_image(self, image: ImageVector) -> bool:
         """向量化图片"""
         try:
@@ -179,7 +294,7 @@ class VectorService:
         """文本向量搜索"""
         try:
             # 获取查询向量
-            query_vector = await self.get_text_embedding(query)
+            query_vector = (await self.get_query_embeddings([query]))[0]
             
             # 构建过滤条件
             filter_conditions = []
@@ -198,26 +313,65 @@ class VectorService:
                 with_payload=True
             )
             
-            return [
-                {
-                    "id": result.id,
-                    "score": result.score,
-                    "content": result.payload["content"],
-                    "source_file": result.payload["source_file"],
-                    "chunk_index": result.payload["chunk_index"],
-                    "knowledge_base_id": result.payload["knowledge_base_id"]
-                }
-                for result in search_result
-            ]
+            return [self._text_hit(result) for result in search_result]
         except Exception as e:
             logger.error(f"Text search error: {e}")
             return []
     
+    async def search_text_batch(self, requests: List[Tuple[str, List[str], int]]) -> List[List[Dict[str, Any]]]:
+        """批量文本向量搜索，requests 为 (查询, 知识库ID列表, top_k) 列表
+        
+        所有查询一次向量化，并通过一次 Qdrant 批量搜索完成检索
+        """
+        try:
+            query_vectors = await self.get_query_embeddings([query for query, _, _ in requests])
+            
+            search_requests = []
+            for query_vector, (_, kb_ids, top_k) in zip(query_vectors, requests):
+                filter_conditions = []
+                if kb_ids:
+                    filter_conditions.append({
+                        "key": "knowledge_base_id",
+                        "match": {"any": kb_ids}
+                    })
+                search_requests.append(SearchRequest(
+                    vector=query_vector,
+                    filter={"must": filter_conditions} if filter_conditions else None,
+                    limit=top_k,
+                    with_payload=True
+                ))
+            
+            # 同步的 Qdrant 客户端调用放到线程池中执行，避免阻塞事件循环
+            batch_results = await asyncio.to_thread(
+                self.qdrant_client.search_batch,
+                collection_name="text_vectors",
+                requests=search_requests
+            )
+            return [
+                [self._text_hit(result) for result in search_result]
+                for search_result in batch_results
+            ]
+        except Exception as e:
+            logger.error(f"Text batch search error: {e}")
+            return [[] for _ in requests]
+    
+    @staticmethod
+    def _text_hit(result) -> Dict[str, Any]:
+        """转换文本搜索结果"""
+        return {
+            "id": result.id,
+            "score": result.score,
+            "content": result.payload["content"],
+            "source_file": result.payload["source_file"],
+            "chunk_index": result.payload["chunk_index"],
+            "knowledge_base_id": result.payload["knowledge_base_id"]
+        }
+    
     async def search_image(self, query: str, kb_ids: List[str], top_k: int = 5) -> List[Dict[str, Any]]:
         """图片向量搜索"""
         try:
             # 获取查询向量（将文本查询转换为向量）
-            query_vector = await self.get_text_embedding(query)
+            query_vector = (await self.get_query_embeddings([query]))[0]
             
             # 构建过滤条件
             filter_conditions = []
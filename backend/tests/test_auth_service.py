@@ -0,0 +1,219 @@
+"""
+认证服务测试
+"""
+import hashlib
+import time
+
+import jwt
+import pytest
+from unittest.mock import Mock, patch
+from passlib.hash import bcrypt
+from sqlalchemy.orm import Session
+
+from app.services import auth_service
+from app.services.auth_service import AuthService, pwd_context
+from app.core.config import settings
+
+
+@pytest.fixture
+def service():
+    """创建认证服务实例（数据库会话被替换）"""
+    return AuthService(Mock(spec=Session))
+
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    """每个测试前后清空模块级缓存"""
+    auth_service._token_cache.clear()
+    auth_service._password_cache.clear()
+    yield
+    auth_service._token_cache.clear()
+    auth_service._password_cache.clear()
+
+
+def _user(password_hash: str) -> Mock:
+    user = Mock()
+    user.password_hash = password_hash
+    return user
+
+
+class TestPasswordHashing:
+    """密码哈希测试"""
+    
+    def test_new_hashes_use_configured_rounds(self):
+        assert f"${settings.BCRYPT_ROUNDS:02d}$" in pwd_context.hash("secret")
+    
+    def test_stronger_hash_is_not_downgraded_on_login(self, service):
+        """轮数更高的已有哈希登录后保持不变"""
+        stronger_hash = bcrypt.using(rounds=settings.BCRYPT_ROUNDS + 1).hash("secret")
+        user = _user(stronger_hash)
+        service.get_user_by_username = Mock(return_value=user)
+        
+        assert service.authenticate_user("alice", "secret") is user
+        assert user.password_hash == stronger_hash
+        service.db.commit.assert_not_called()
+    
+    def test_weaker_hash_is_upgraded_on_login(self, service):
+        """轮数低于配置的旧哈希在成功登录后按配置轮数重新生成"""
+        weaker_hash = bcrypt.using(rounds=4).hash("secret")
+        user = _user(weaker_hash)
+        service.get_user_by_username = Mock(return_value=user)
+        
+        assert service.authenticate_user("alice", "secret") is user
+        assert user.password_hash != weaker_hash
+        assert f"${settings.BCRYPT_ROUNDS:02d}$" in user.password_hash
+        assert pwd_context.verify("secret", user.password_hash)
+        service.db.commit.assert_called_once()
+
+
+
+class TestTokenCache:
+    """令牌解码缓存测试"""
+    
+    def _encode(self, user_id: str, exp: float) -> str:
+        return jwt.encode(
+            {"sub": user_id, "exp": int(exp)},
+            auth_service._JWT_KEY,
+            algorithm=settings.JWT_ALGORITHM
+        )
+    
+    def test_cache_expiry_bounded_by_token_exp(self, service):
+        """缓存失效时间不超过令牌自身的过期时间"""
+        exp = time.time() + 5
+        token = self._encode("user-1", exp)
+        
+        assert service._decode_token(token) == "user-1"
+        
+        user_id, expires_at = auth_service._token_cache[auth_service._token_cache_key(token)]
+        assert user_id == "user-1"
+        assert expires_at <= int(exp)
+    
+    def test_cache_hit_skips_decode(self, service):
+        token = self._encode("user-1", time.time() + 3600)
+        service._decode_token(token)
+        
+        with patch.object(auth_service.jwt, "decode") as mock_decode:
+            assert service._decode_token(token) == "user-1"
+        mock_decode.assert_not_called()
+    
+    def test_stale_cache_entry_is_not_used(self, service):
+        """缓存条目超过令牌有效期后重新校验"""
+        token = self._encode("user-1", time.time() - 10)
+        auth_service._token_cache[auth_service._token_cache_key(token)] = ("user-1", time.time() - 1)
+        
+        with pytest.raises(ValueError):
+            service._decode_token(token)
+    
+    def test_expired_token_not_cached(self, service):
+        token = self._encode("user-1", time.time() - 10)
+        
+        with pytest.raises(ValueError):
+            service._decode_token(token)
+        assert auth_service._token_cache_key(token) not in auth_service._token_cache
+    
+    def test_invalid_token_not_cached(self, service):
+        with pytest.raises(ValueError):
+            service._decode_token("not-a-token")
+        assert len(auth_service._token_cache) == 0
+
+
+class TestAuthenticateUser:
+    """用户凭据校验测试"""
+    
+    def test_missing_user_still_runs_hash_check(self, service):
+        """用户不存在时仍对占位哈希执行一次完整比对"""
+        service.get_user_by_username = Mock(return_value=None)
+        
+        with patch.object(
+            pwd_context, "verify_and_update", wraps=pwd_context.verify_and_update
+        ) as mock_verify:
+            assert service.authenticate_user("ghost", "secret") is None
+        
+        mock_verify.assert_called_once_with("secret", auth_service._DUMMY_HASH)
+        assert len(auth_service._password_cache) == 0
+    
+    def test_wrong_password_is_rejected(self, service):
+        service.get_user_by_username = Mock(return_value=_user(pwd_context.hash("secret")))
+        
+        assert service.authenticate_user("alice", "wrong") is None
+
+
+class TestPasswordCache:
+    """密码校验缓存测试"""
+    
+    def test_repeat_login_skips_hash_check(self, service):
+        user = _user(pwd_context.hash("secret"))
+        service.get_user_by_username = Mock(return_value=user)
+        assert service.authenticate_user("alice", "secret") is user
+        
+        with patch.object(pwd_context, "verify_and_update") as mock_verify:
+            assert service.authenticate_user("alice", "secret") is user
+        mock_verify.assert_not_called()
+    
+    def test_wrong_password_with_cached_hash_is_rejected(self, service):
+        """缓存中已有正确密码的条目时，错误密码仍然被拒绝"""
+        user = _user(pwd_context.hash("secret"))
+        service.get_user_by_username = Mock(return_value=user)
+        assert service.authenticate_user("alice", "secret") is user
+        
+        assert service.authenticate_user("alice", "wrong") is None
+    
+    def test_cached_entry_invalid_after_password_change(self, service):
+        """密码哈希变更后旧缓存条目不再生效"""
+        user = _user(pwd_context.hash("secret"))
+        service.get_user_by_username = Mock(return_value=user)
+        assert service.authenticate_user("alice", "secret") is user
+        
+        user.password_hash = pwd_context.hash("changed")
+        assert service.authenticate_user("alice", "secret") is None
+    
+    def test_cache_key_does_not_expose_password(self):
+        """缓存键中既没有原始密码，也没有可离线比对的普通摘要"""
+        key = auth_service._password_cache_key("alice", "secret")
+        
+        assert "secret" not in key
+        assert hashlib.sha256(b"secret").hexdigest() not in key
+        assert key.startswith("alice:")
+
+
+class TestAccessToken:
+    """访问令牌签发测试"""
+    
+    def test_token_round_trip(self, service):
+        """预解析的密钥签发的令牌可以被正常解码"""
+        token = service.create_access_token("user-1")
+        
+        assert service._decode_token(token) == "user-1"
+    
+    def test_token_signed_with_other_key_is_rejected(self, service):
+        token = jwt.encode(
+            {"sub": "user-1", "exp": int(time.time()) + 60},
+            settings.JWT_SECRET_KEY + "-other",
+            algorithm=settings.JWT_ALGORITHM
+        )
+        
+        with pytest.raises(ValueError):
+            service._decode_token(token)
+
+
+class TestGetUserById:
+    """用户ID解析测试"""
+    
+    def test_valid_id_is_parsed_once(self, service):
+        auth_service._parse_uuid.cache_clear()
+        user_id = "12345678-1234-5678-1234-567812345678"
+        
+        service.get_user_by_id(user_id)
+        service.get_user_by_id(user_id)
+        
+        info = auth_service._parse_uuid.cache_info()
+        assert info.misses == 1
+        assert info.hits == 1
+    
+    def test_invalid_id_returns_none_and_is_not_cached(self, service):
+        auth_service._parse_uuid.cache_clear()
+        
+        assert service.get_user_by_id("not-a-uuid") is None
+        
+        service.db.query.assert_not_called()
+        assert auth_service._parse_uuid.cache_info().currsize == 0
@@ -0,0 +1,180 @@
+"""
+聊天服务测试
+"""
+import pytest
+from unittest.mock import Mock, MagicMock, AsyncMock, patch
+from sqlalchemy.orm import Session
+
+from app.services.chat_service import ChatService, _iter_answer_chunks
+
+
+class TestAnswerChunks:
+    """流式回答切分测试"""
+    
+    def test_chunks_keep_original_whitespace(self):
+        answer = "第一行\n第二行  结束"
+        chunks = list(_iter_answer_chunks(answer))
+        
+        assert "".join(chunk for chunk, _ in chunks) == answer
+        assert [is_last for _, is_last in chunks] == [False, False, True]
+    
+    def test_empty_answer_yields_nothing(self):
+        assert list(_iter_answer_chunks("")) == []
+
+
+class TestKeywordSearch:
+    """降级关键词检索测试"""
+    
+    @pytest.fixture
+    def mock_db(self):
+        """模拟数据库会话"""
+        db = MagicMock(spec=Session)
+        db.bind.dialect.name = "postgresql"
+        return db
+    
+    @pytest.fixture
+    def chat_service(self, mock_db):
+        """创建聊天服务实例"""
+        with patch('app.services.vector_service.qdrant_client.QdrantClient'):
+            return ChatService(mock_db)
+    
+    @staticmethod
+    def _ranked_rows(mock_db):
+        """过滤 -> 排序 -> 限制条数 -> all() 的调用链"""
+        base_query = mock_db.query.return_value.filter.return_value
+        return base_query.filter.return_value.order_by.return_value.limit.return_value.all
+    
+    def test_full_text_hits_skip_fallback(self, chat_service, mock_db):
+        """全文检索有命中时直接返回，不再执行子串匹配"""
+        rows = self._ranked_rows(mock_db)
+        rows.return_value = [("Python 安装指南",), ("Python 版本说明",)]
+        
+        result = chat_service._search_chunks_by_keywords("python 安装", ["kb1"], limit=3)
+        
+        assert result == ["Python 安装指南", "Python 版本说明"]
+        assert rows.call_count == 1
+    
+    def test_full_text_miss_falls_back_to_substring(self, chat_service, mock_db):
+        """全文检索无命中（如中文未分词）时退化为子串匹配"""
+        rows = self._ranked_rows(mock_db)
+        rows.side_effect = [[], [("机器学习入门",)]]
+        
+        result = chat_service._search_chunks_by_keywords("机器学习", ["kb1"], limit=3)
+        
+        assert result == ["机器学习入门"]
+        assert rows.call_count == 2
+    
+    def test_non_postgresql_uses_substring_only(self, chat_service, mock_db):
+        """非 PostgreSQL 数据库只执行子串匹配"""
+        mock_db.bind.dialect.name = "sqlite"
+        rows = self._ranked_rows(mock_db)
+        rows.return_value = [("hello world",)]
+        
+        result = chat_service._search_chunks_by_keywords("hello", ["kb1"], limit=3)
+        
+        assert result == ["hello world"]
+        assert rows.call_count == 1
+    
+    def test_blank_query_returns_empty(self, chat_service, mock_db):
+        """空白查询在全文检索无命中后直接返回空列表"""
+        rows = self._ranked_rows(mock_db)
+        rows.return_value = []
+        
+        assert chat_service._search_chunks_by_keywords("   ", ["kb1"], limit=3) == []
+        assert rows.call_count == 1
+
+
+class TestChatPersistence:
+    """聊天消息持久化测试"""
+    
+    @pytest.fixture
+    def mock_db(self):
+        """模拟数据库会话"""
+        return MagicMock(spec=Session)
+    
+    @pytest.fixture
+    def chat_service(self, mock_db):
+        """创建聊天服务实例（检索与权限检查均被替换）"""
+        with patch('app.services.vector_service.qdrant_client.QdrantClient'):
+            service = ChatService(mock_db)
+        service.has_session_access = Mock(return_value=True)
+        return service
+    
+    def test_create_session_commits_without_expiring(self, chat_service, mock_db):
+        """新建会话提交时不使对象过期，提交后恢复会话的默认设置"""
+        mock_db.expire_on_commit = True
+        flags = []
+        mock_db.commit.side_effect = lambda: flags.append(mock_db.expire_on_commit)
+        
+        session = chat_service.create_session("user1", "会话", ["kb1"])
+        
+        mock_db.add.assert_called_once_with(session)
+        mock_db.refresh.assert_not_called()
+        assert flags == [False]
+        assert mock_db.expire_on_commit is True
+    
+    @pytest.mark.asyncio
+    async def test_process_chat_saves_turn_in_one_commit(self, chat_service, mock_db):
+        """用户消息与助手回复在检索完成后一次提交"""
+        async def rag_search(query, kb_ids):
+            # 检索期间尚未写入任何消息
+            mock_db.add_all.assert_not_called()
+            mock_db.commit.assert_not_called()
+            return "回答内容"
+        
+        with patch.object(chat_service, '_rag_search', side_effect=rag_search):
+            await chat_service.process_chat("user1", "你好", ["kb1"], None, "session1")
+        
+        mock_db.add_all.assert_called_once()
+        messages = mock_db.add_all.call_args[0][0]
+        assert [m.role for m in messages] == ["user", "assistant"]
+        assert [m.content for m in messages] == ["你好", "回答内容"]
+        mock_db.commit.assert_called_once()
+    
+    @pytest.mark.asyncio
+    async def test_process_chat_stream_saves_after_streaming(self, chat_service, mock_db):
+        """用户消息在检索前加入会话，流式回答全部发送后两条消息一次提交"""
+        async def rag_search(query, kb_ids):
+            mock_db.add.assert_called_once()
+            return "第一段 第二段"
+        
+        with patch.object(chat_service, '_rag_search', side_effect=rag_search):
+            events = []
+            async for event in chat_service.process_chat_stream("session1", "你好", ["kb1"]):
+                if event["type"] == "chunk":
+                    mock_db.commit.assert_not_called()
+                events.append(event)
+        
+        assert [e["type"] for e in events] == ["chunk", "chunk", "complete"]
+        assert events[1]["is_end"] is True
+        messages = [call.args[0] for call in mock_db.add.call_args_list]
+        assert [(m.role, m.content) for m in messages] == [("user", "你好"), ("assistant", "第一段 第二段")]
+        mock_db.commit.assert_called_once()
+    
+    @pytest.mark.asyncio
+    async def test_process_chat_stream_saves_user_message_on_disconnect(self, chat_service, mock_db):
+        """客户端中途断开（生成器提前关闭）时仍提交用户消息"""
+        with patch.object(chat_service, '_rag_search', AsyncMock(return_value="第一段 第二段")):
+            stream = chat_service.process_chat_stream("session1", "你好", ["kb1"])
+            first = await stream.__anext__()
+            await stream.aclose()
+        
+        assert first["type"] == "chunk"
+        messages = [call.args[0] for call in mock_db.add.call_args_list]
+        assert [(m.role, m.content) for m in messages] == [("user", "你好")]
+        mock_db.commit.assert_called_once()
+    
+    @pytest.mark.asyncio
+    async def test_process_chat_runs_db_calls_in_threads(self, chat_service, mock_db):
+        """权限检查与提交通过线程池执行，不阻塞事件循环"""
+        offloaded = []
+        
+        async def fake_to_thread(func, *args):
+            offloaded.append(func)
+            return func(*args)
+        
+        with patch.object(chat_service, '_rag_search', AsyncMock(return_value="回答内容")):
+            with patch('app.services.chat_service.asyncio.to_thread', side_effect=fake_to_thread):
+                await chat_service.process_chat("user1", "你好", ["kb1"], None, "session1")
+        
+        assert offloaded == [chat_service.has_session_access, chat_service._touch_session_and_commit]
@@ -0,0 +1,232 @@
+"""
+Embedding路由服务测试
+"""
+import pytest
+import asyncio
+from unittest.mock import AsyncMock, patch
+
+from app.services import embedding_router
+from app.services.embedding_router import (
+    EmbeddingRouter,
+    EmbeddingModel,
+    embedding_cache_key,
+    get_cached_embedding,
+    get_cached_embeddings,
+    cache_embeddings,
+)
+
+
+class TestBatchEmbedding:
+    """批量向量化测试"""
+    
+    @pytest.fixture
+    def router(self):
+        return EmbeddingRouter()
+    
+    @pytest.mark.asyncio
+    async def test_local_model_preserves_order(self, router):
+        """本地模型逐条并发获取，先完成的结果不会打乱顺序"""
+        texts = ["a", "bb", "ccc"]
+        
+        async def get_embedding(text, model):
+            # 越靠后的文本越早完成
+            await asyncio.sleep(0.01 * (len(texts) - len(text)))
+            return [float(len(text))]
+        
+        with patch.object(router, 'get_embedding', side_effect=get_embedding):
+            result = await router.batch_embedding(texts, EmbeddingModel.BGE_M3)
+        
+        assert isinstance(result, list)
+        assert result == [[1.0], [2.0], [3.0]]
+    
+    @pytest.mark.asyncio
+    async def test_local_model_failure_falls_back_in_place(self, router):
+        """单条失败时在原位置使用降级向量"""
+        texts = ["first", "second", "third"]
+        dimension = router.model_configs[EmbeddingModel.BGE_M3]["dimension"]
+        
+        async def get_embedding(text, model):
+            if text == "second":
+                raise RuntimeError("service unavailable")
+            return [1.0] * dimension
+        
+        with patch.object(router, 'get_embedding', side_effect=get_embedding):
+            result = await router.batch_embedding(texts, EmbeddingModel.BGE_M3)
+        
+        assert result[0] == [1.0] * dimension
+        assert result[1] == router._fallback_embedding("second", dimension)
+        assert result[2] == [1.0] * dimension
+    
+    @pytest.mark.asyncio
+    async def test_openai_batches_preserve_order(self, router):
+        """批次按文本长度重新打包后，结果仍按输入顺序返回"""
+        texts = ["ccc", "a", "bb"]
+        
+        async def embed_batch(batch_texts, model, config):
+            return [[float(len(text))] for text in batch_texts]
+        
+        with patch('app.services.embedding_router.get_cached_embeddings', AsyncMock(return_value=[None] * 3)), \
+                patch('app.services.embedding_router.cache_embeddings',
+                      AsyncMock(side_effect=lambda items: [embedding for _, _, embedding in items])), \
+                patch.object(router, '_get_openai_embedding_batch', side_effect=embed_batch):
+            result = await router.batch_embedding(texts, EmbeddingModel.OPENAI_3_SMALL)
+        
+        assert result == [[3.0], [1.0], [2.0]]
+    
+    @pytest.mark.asyncio
+    async def test_cache_miss_matches_cache_hit(self, router, monkeypatch):
+        """未命中缓存时返回的向量与随后命中缓存时一致（均为量化还原后的向量）"""
+        monkeypatch.setattr(embedding_router.settings, "EMBEDDING_CACHE_PATH", None)
+        embedding_router._embedding_cache.clear()
+        raw = [0.123, -0.456, 0.789]
+        
+        with patch.object(router, '_get_local_embedding', AsyncMock(return_value=raw)) as fetch:
+            miss = await router.get_embedding("同一段文本", EmbeddingModel.BGE_M3)
+            hit = await router.get_embedding("同一段文本", EmbeddingModel.BGE_M3)
+        
+        fetch.assert_awaited_once()
+        assert miss == hit
+        assert miss == pytest.approx(raw, abs=0.004)
+        embedding_router._embedding_cache.clear()
+
+
+class TestInflightEmbeddings:
+    """相同文本并发请求合并测试"""
+    
+    @pytest.fixture
+    def router(self, monkeypatch):
+        monkeypatch.setattr(embedding_router.settings, "EMBEDDING_CACHE_PATH", None)
+        embedding_router._embedding_cache.clear()
+        embedding_router._inflight_embeddings.clear()
+        yield EmbeddingRouter()
+        embedding_router._embedding_cache.clear()
+        embedding_router._inflight_embeddings.clear()
+    
+    @pytest.mark.asyncio
+    async def test_concurrent_requests_share_one_backend_call(self, router):
+        """两个并发请求只触发一次后端调用，并得到相同结果"""
+        release = asyncio.Event()
+        
+        async def get_local_embedding(text, model, config):
+            await release.wait()
+            return [0.5, -0.5, 0.25]
+        
+        with patch.object(router, '_get_local_embedding', side_effect=get_local_embedding) as fetch:
+            tasks = [
+                asyncio.create_task(router.get_embedding("同一段文本", EmbeddingModel.BGE_M3))
+                for _ in range(2)
+            ]
+            await asyncio.sleep(0.01)
+            release.set()
+            first, second = await asyncio.gather(*tasks)
+        
+        assert fetch.await_count == 1
+        assert first == second
+        assert embedding_router._inflight_embeddings == {}
+    
+    @pytest.mark.asyncio
+    async def test_owner_failure_falls_back_for_waiters(self, router):
+        """发起请求失败时，等待者各自降级且不遗留进行中条目"""
+        release = asyncio.Event()
+        dimension = router.model_configs[EmbeddingModel.BGE_M3]["dimension"]
+        
+        async def get_local_embedding(text, model, config):
+            await release.wait()
+            raise RuntimeError("service unavailable")
+        
+        with patch.object(router, '_get_local_embedding', side_effect=get_local_embedding) as fetch:
+            tasks = [
+                asyncio.create_task(router.get_embedding("同一段文本", EmbeddingModel.BGE_M3))
+                for _ in range(2)
+            ]
+            await asyncio.sleep(0.01)
+            release.set()
+            results = await asyncio.gather(*tasks)
+        
+        fallback = router._fallback_embedding("同一段文本", dimension)
+        assert fetch.await_count == 1
+        assert results == [fallback, fallback]
+        assert embedding_router._inflight_embeddings == {}
+        assert len(embedding_router._embedding_cache) == 0
+    
+    @pytest.mark.asyncio
+    async def test_owner_cancellation_falls_back_for_waiters(self, router):
+        """发起请求被取消时，等待者被唤醒并降级"""
+        dimension = router.model_configs[EmbeddingModel.BGE_M3]["dimension"]
+        
+        async def get_local_embedding(text, model, config):
+            await asyncio.Event().wait()
+        
+        with patch.object(router, '_get_local_embedding', side_effect=get_local_embedding):
+            owner = asyncio.create_task(router.get_embedding("同一段文本", EmbeddingModel.BGE_M3))
+            await asyncio.sleep(0.01)
+            waiter = asyncio.create_task(router.get_embedding("同一段文本", EmbeddingModel.BGE_M3))
+            await asyncio.sleep(0.01)
+            owner.cancel()
+            result = await waiter
+        
+        with pytest.raises(asyncio.CancelledError):
+            await owner
+        assert result == router._fallback_embedding("同一段文本", dimension)
+        assert embedding_router._inflight_embeddings == {}
+
+
+class TestDiskEmbeddingCache:
+    """磁盘向量缓存测试"""
+    
+    @pytest.fixture
+    def disk_cache(self, tmp_path, monkeypatch):
+        """启用临时磁盘缓存，测试结束后关闭连接并清空内存缓存"""
+        monkeypatch.setattr(embedding_router.settings, "EMBEDDING_CACHE_PATH", str(tmp_path / "emb.db"))
+        monkeypatch.setattr(embedding_router, "_disk_cache_failed", False)
+        embedding_router._embedding_cache.clear()
+        yield
+        embedding_router.close_embedding_cache()
+        embedding_router._embedding_cache.clear()
+    
+    @pytest.mark.asyncio
+    async def test_disk_round_trip_runs_in_worker_thread(self, disk_cache):
+        """内存未命中时从磁盘读取，读写都在工作线程中执行"""
+        key = embedding_cache_key("hello", "test-model")
+        offloaded = []
+        real_to_thread = asyncio.to_thread
+        
+        async def spy_to_thread(func, *args):
+            offloaded.append(func)
+            return await real_to_thread(func, *args)
+        
+        with patch('app.services.embedding_router.asyncio.to_thread', side_effect=spy_to_thread):
+            await cache_embeddings([(key, "test-model", [0.5, -0.25, 1.0])])
+            embedding_router._embedding_cache.clear()
+            cached = await get_cached_embedding(key)
+        
+        assert offloaded == [embedding_router._store_disk_embeddings, embedding_router._load_disk_embeddings]
+        assert cached == pytest.approx([0.5, -0.25, 1.0], abs=0.01)
+    
+    @pytest.mark.asyncio
+    async def test_memory_only_skips_worker_thread(self, monkeypatch):
+        """未配置磁盘缓存时不切换线程"""
+        monkeypatch.setattr(embedding_router.settings, "EMBEDDING_CACHE_PATH", None)
+        embedding_router._embedding_cache.clear()
+        
+        with patch('app.services.embedding_router.asyncio.to_thread') as to_thread:
+            assert await get_cached_embedding(embedding_cache_key("missing", "test-model")) is None
+        
+        to_thread.assert_not_called()
+    
+    @pytest.mark.asyncio
+    async def test_batch_lookup_uses_one_disk_query(self, disk_cache):
+        """批量读取时未命中内存的键只查询一次磁盘，结果与输入顺序一致"""
+        keys = [embedding_cache_key(text, "test-model") for text in ["a", "b", "c"]]
+        await cache_embeddings([(keys[0], "test-model", [1.0, 0.0]), (keys[2], "test-model", [0.0, 1.0])])
+        embedding_router._embedding_cache.clear()
+        
+        with patch('app.services.embedding_router._load_disk_embeddings',
+                   wraps=embedding_router._load_disk_embeddings) as load:
+            cached = await get_cached_embeddings(keys + [keys[0]])
+        
+        load.assert_called_once_with(keys)
+        assert cached[0] == pytest.approx([1.0, 0.0], abs=0.01)
+        assert cached[1] is None
+        assert cached[2] == pytest.approx([0.0, 1.0], abs=0.01)
+        assert cached[3] == pytest.approx([1.0, 0.0], abs=0.01)
@@ -3,15 +3,16 @@
 """
 import pytest
 import asyncio
+from types import SimpleNamespace
 from unittest.mock import Mock, AsyncMock
 
 from app.services.query_processor import QueryProcessor
 from app.services.multi_query_expander import QueryType
 from app.services.multi_query_expander import MultiQueryExpander, ExpansionStrategy
-from app.services.hybrid_retriever import HybridRetriever, FusionStrategy
+from app.services.hybrid_retriever import HybridRetriever, FusionStrategy, invalidate_retrieval_cache, _BatchedVectorSearcher
 from app.services.reranker import Reranker, RerankStrategy
 from app.services.metadata_filter import MetadataFilter, FilterCondition, FilterOperator
-from app.services.enhanced_retrieval_pipeline import EnhancedRetrievalPipeline, PipelineConfig
+from app.services.enhanced_retrieval_pipeline import EnhancedRetrievalPipeline, PipelineConfig, DocBatch
 
 
 class TestQueryProcessor:
@@ -155,6 +156,176 @@ class TestHybridRetriever:
         
         assert len(result) > 0
         assert "fused_score" in result[0]
+    
+    @staticmethod
+    def _fusion_inputs():
+        """两路检索结果：B 同时出现在两路中"""
+        vector_results = [
+            {"id": "A", "content": "a", "score": 0.9, "source": "vector"},
+            {"id": "B", "content": "b", "score": 0.6, "source": "vector"},
+        ]
+        keyword_results = [
+            {"id": "B", "content": "b", "score": 2.0, "source": "keyword"},
+            {"id": "C", "content": "c", "score": 1.0, "source": "keyword"},
+        ]
+        return vector_results, keyword_results
+    
+    @pytest.mark.parametrize("strategy, expected", [
+        (FusionStrategy.WEIGHTED_SUM, {"A": 0.63, "B": 1.02, "C": 0.3}),
+        (FusionStrategy.COMB_SUM, {"A": 0.63, "B": 1.02, "C": 0.3}),
+        (FusionStrategy.RECIPROCAL_RANK, {"A": 0.7, "B": 0.65, "C": 0.15}),
+        (FusionStrategy.COMB_MNZ, {"A": 0.7, "B": 0.7 * 0.6 / 0.9 + 0.3, "C": 0.15}),
+        (FusionStrategy.BORDA_COUNT, {"A": 1.4, "B": 1.3, "C": 0.3}),
+    ])
+    def test_fusion_scores(self, strategy, expected):
+        """各融合策略的分数与逐文档计算结果一致，文档按首次出现顺序去重"""
+        retriever = HybridRetriever(
+            vector_service=None,
+            weights={"vector": 0.7, "keyword": 0.3},
+            fusion_strategy=strategy
+        )
+        
+        merged = retriever._merge_results(*self._fusion_inputs())
+        
+        assert [doc["id"] for doc in merged] == ["A", "B", "C"]
+        # 同时命中两路的文档保留向量检索结果
+        assert merged[1]["source"] == "vector"
+        for doc in merged:
+            assert doc["fused_score"] == pytest.approx(expected[doc["id"]])
+    
+    def test_reciprocal_rank_fusion_ranks(self):
+        retriever = HybridRetriever(vector_service=None, fusion_strategy=FusionStrategy.RECIPROCAL_RANK)
+        
+        merged = retriever._merge_results(*self._fusion_inputs())
+        
+        ranks = {doc["id"]: (doc["vector_rank"], doc["keyword_rank"]) for doc in merged}
+        assert ranks == {"A": (1, float('inf')), "B": (2, 1), "C": (float('inf'), 2)}
+    
+    def test_comb_mnz_zero_max_score(self):
+        """最大分数为 0 时不再除零"""
+        retriever = HybridRetriever(vector_service=None, fusion_strategy=FusionStrategy.COMB_MNZ)
+        vector_results = [{"id": "A", "score": 0.0}]
+        keyword_results = [{"id": "B", "score": 1.0}]
+        
+        merged = retriever._merge_results(vector_results, keyword_results)
+        
+        assert [doc["vector_score"] for doc in merged] == [0.0, 0.0]
+        assert [doc["keyword_score"] for doc in merged] == [0.0, 1.0]
+    
+    def test_retrieve_returns_top_k_fused_results(self):
+        """融合结果按融合分数取前 top_k 个，分数直接写在结果上"""
+        vector_results, keyword_results = self._fusion_inputs()
+        mock_vector_service = Mock()
+        mock_vector_service.hybrid_search = AsyncMock(return_value={"text": vector_results})
+        mock_keyword_service = Mock()
+        mock_keyword_service.search = AsyncMock(return_value=keyword_results)
+        retriever = HybridRetriever(
+            vector_service=mock_vector_service,
+            keyword_service=mock_keyword_service,
+            weights={"vector": 0.7, "keyword": 0.3}
+        )
+        
+        result = asyncio.run(retriever.retrieve("test", ["kb1"], top_k=2))
+        
+        assert [doc["id"] for doc in result] == ["B", "A"]
+        assert result[0]["fused_score"] == pytest.approx(1.02)
+        assert result[0]["vector_score"] == 0.6
+        assert result[0]["keyword_score"] == 2.0
+        assert result[1]["keyword_score"] == 0.0
+    
+    @staticmethod
+    def _counting_vector_service():
+        mock_vector_service = Mock()
+        mock_vector_service.hybrid_search = AsyncMock(return_value={
+            "text": [
+                {"id": "1", "content": "test1", "score": 0.8, "source_file": "", "knowledge_base_id": "", "metadata": {}}
+            ]
+        })
+        return mock_vector_service
+    
+    def test_result_cache_disabled_by_default(self):
+        mock_vector_service = self._counting_vector_service()
+        retriever = HybridRetriever(vector_service=mock_vector_service)
+        
+        async def run():
+            await retriever.retrieve("test", ["kb-cache-off"])
+            await retriever.retrieve("test", ["kb-cache-off"])
+        asyncio.run(run())
+        
+        assert mock_vector_service.hybrid_search.await_count == 2
+    
+    def test_result_cache_invalidated_on_kb_change(self):
+        mock_vector_service = self._counting_vector_service()
+        retriever = HybridRetriever(vector_service=mock_vector_service, enable_result_cache=True)
+        
+        async def run():
+            await retriever.retrieve("test", ["kb-cache-on"])
+            await retriever.retrieve("test", ["kb-cache-on"])
+            assert mock_vector_service.hybrid_search.await_count == 1
+            
+            # 知识库内容变更后不再命中旧结果
+            invalidate_retrieval_cache("kb-cache-on")
+            await retriever.retrieve("test", ["kb-cache-on"])
+            assert mock_vector_service.hybrid_search.await_count == 2
+        asyncio.run(run())
+    
+    def test_semantic_cache_reuses_similar_query(self):
+        """相似度不低于阈值的近似查询复用检索结果"""
+        mock_vector_service = self._counting_vector_service()
+        embeddings = {"如何安装Python": [1.0, 0.0], "怎样安装Python": [0.99, 0.1], "数据库配置": [0.0, 1.0]}
+        mock_vector_service.get_query_embeddings = AsyncMock(
+            side_effect=lambda queries: [embeddings[query] for query in queries]
+        )
+        retriever = HybridRetriever(vector_service=mock_vector_service, semantic_cache_threshold=0.95)
+        
+        async def run():
+            first = await retriever.retrieve("如何安装Python", ["kb-semantic"])
+            similar = await retriever.retrieve("怎样安装Python", ["kb-semantic"])
+            assert mock_vector_service.hybrid_search.await_count == 1
+            assert similar == first
+            
+            await retriever.retrieve("数据库配置", ["kb-semantic"])
+            assert mock_vector_service.hybrid_search.await_count == 2
+        asyncio.run(run())
+    
+    def test_pipeline_config_enables_retrieval_caches(self):
+        config = PipelineConfig(enable_result_cache=True, semantic_cache_threshold=0.9)
+        pipeline = EnhancedRetrievalPipeline(vector_service=Mock(), config=config)
+        
+        assert pipeline.hybrid_retriever.enable_result_cache is True
+        assert pipeline.hybrid_retriever.semantic_cache_threshold == 0.9
+        
+        pipeline.update_config(PipelineConfig())
+        assert pipeline.hybrid_retriever.enable_result_cache is False
+        assert pipeline.hybrid_retriever.semantic_cache_threshold is None
+
+
+class TestBatchedVectorSearcher:
+    """向量检索微批测试"""
+    
+    def test_concurrent_searches_share_one_batch(self):
+        mock_vector_service = Mock()
+        mock_vector_service.search_text_batch = AsyncMock(
+            side_effect=lambda requests: [[{"id": query}] for query, _, _ in requests]
+        )
+        # 空闲时不应等待超时
+        searcher = _BatchedVectorSearcher(mock_vector_service, max_wait=60)
+        
+        async def run():
+            results = await asyncio.wait_for(asyncio.gather(
+                searcher.search("q1", ["kb1"], 5),
+                searcher.search("q2", ["kb1"], 5)
+            ), timeout=1)
+            await asyncio.sleep(0)
+            return results
+        
+        results = asyncio.run(run())
+        
+        assert results == [[{"id": "q1"}], [{"id": "q2"}]]
+        mock_vector_service.search_text_batch.assert_awaited_once_with(
+            [("q1", ["kb1"], 5), ("q2", ["kb1"], 5)]
+        )
+        assert not searcher._tasks
 
 
 class TestEnhancedRetrievalPipeline:
@@ -203,6 +374,31 @@ class TestEnhancedRetrievalPipeline:
         assert "successful_queries" in stats
         assert "failed_queries" in stats
         assert "avg_processing_time" in stats
+    
+    def test_doc_batch_preserves_scores(self):
+        documents = [
+            {"id": "1", "content": "a", "score": 0.9},
+            {"id": "2", "content": "b", "score": 0.123456789}
+        ]
+        
+        results = DocBatch.from_documents(documents).to_rerank_results()
+        
+        # 分数经过列式存储后应与输入完全一致
+        assert [r.final_score for r in results] == [0.9, 0.123456789]
+        assert [r.original_score for r in results] == [0.9, 0.123456789]
+    
+    def test_select_top_k_matches_sorted(self):
+        # 0.3 与 0.30000001 在 float32 下相等，必须按 float64 区分先后
+        scores = [0.3, 0.30000001, 0.5, 0.1, 0.5]
+        results = [SimpleNamespace(final_score=score) for score in scores]
+        
+        expected = sorted(range(len(scores)), key=lambda i: -scores[i])
+        
+        assert EnhancedRetrievalPipeline._select_top_k(results, 3) == expected[:3]
+        assert EnhancedRetrievalPipeline._select_top_k(results, 10) == expected
+        assert EnhancedRetrievalPipeline._select_top_k(results, 0) == []
+        # 第 k 位出现同分时保留靠前的结果
+        assert EnhancedRetrievalPipeline._select_top_k(results, 1) == [2]
 
 
 if __name__ == "__main__":
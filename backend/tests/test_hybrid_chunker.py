@@ -0,0 +1,66 @@
+"""
+混合分块服务测试
+"""
+import pytest
+from unittest.mock import Mock
+
+from app.services.hybrid_chunker import HybridChunker, HybridChunk, ChunkType
+
+
+class TestMarkdownDetection:
+    """Markdown文档检测测试"""
+    
+    @pytest.fixture
+    def chunker(self):
+        return HybridChunker(embedding_router=Mock())
+    
+    @pytest.mark.parametrize("text", [
+        "# 标题\n正文",
+        "正文\n## 二级标题",
+        "这是**粗体**文字",
+        "调用 `main()` 函数",
+        "参考[文档](http://example.com)",
+        "清单：\n- 第一项",
+        "步骤：\n1. 第一步",
+    ])
+    def test_detects_markdown_indicators(self, chunker, text):
+        assert chunker._is_markdown_document(text)
+    
+    def test_plain_text_is_not_markdown(self, chunker):
+        assert not chunker._is_markdown_document("这是一段普通文本。\n第二行内容。" * 100)
+    
+    def test_detects_heading_after_long_plain_prefix(self, chunker):
+        """标题出现在较长的纯文本之后仍能识别"""
+        text = "普通文本内容。\n" * 10000 + "# 附录\n附录内容"
+        assert len(text) > 32768
+        assert chunker._is_markdown_document(text)
+
+
+class TestChunkStatistics:
+    """分块统计测试"""
+    
+    def test_statistics_by_type(self):
+        chunker = HybridChunker(embedding_router=Mock())
+        chunks = [
+            HybridChunk(chunk_id="p1", content="a" * 10, chunk_type=ChunkType.PARENT, level=1),
+            HybridChunk(chunk_id="c1", content="b" * 4, chunk_type=ChunkType.CHILD, parent_id="p1", level=2),
+            HybridChunk(chunk_id="c2", content="c" * 6, chunk_type=ChunkType.CHILD, parent_id="p1", level=2),
+            HybridChunk(chunk_id="s1", content="d" * 3, chunk_type=ChunkType.STANDALONE),
+        ]
+        
+        assert chunker.get_chunk_statistics(chunks) == {
+            "total_chunks": 4,
+            "parent_chunks": 1,
+            "child_chunks": 2,
+            "standalone_chunks": 1,
+            "avg_parent_size": 10.0,
+            "avg_child_size": 5.0,
+            "max_level": 2
+        }
+    
+    def test_empty_statistics(self):
+        chunker = HybridChunker(embedding_router=Mock())
+        stats = chunker.get_chunk_statistics([])
+        assert stats["total_chunks"] == 0
+        assert stats["avg_parent_size"] == 0
+        assert stats["max_level"] == 0
@@ -1,6 +1,7 @@
 import pytest
 from fastapi.testclient import TestClient
 from app.main import app
+from app.core.config import settings
 
 client = TestClient(app)
 
@@ -44,6 +45,15 @@ def test_get_knowledge_base_detail(admin_token):
     assert data["id"] == kb_id
     assert data["name"] == "测试知识库"
 
+def test_upload_too_large_returns_413(admin_token, monkeypatch):
+    monkeypatch.setattr(settings, "MAX_FILE_SIZE", 10)
+    resp = client.post(
+        f"/api/kb/{kb_id}/upload-doc",
+        files={"file": ("big.txt", b"x" * 11, "text/plain")},
+        headers=auth_header(admin_token)
+    )
+    assert resp.status_code == 413
+
 def test_delete_knowledge_base(admin_token):
     resp = client.delete(f"/api/kb/{kb_id}", headers=auth_header(admin_token))
     assert resp.status_code == 200
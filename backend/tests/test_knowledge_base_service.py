@@ -0,0 +1,158 @@
+"""
+知识库服务测试
+"""
+import io
+import os
+import random
+import tempfile
+import pytest
+from unittest.mock import Mock, patch
+from sqlalchemy.orm import Session
+
+from app.services import knowledge_base_service
+from app.services.knowledge_base_service import (
+    KnowledgeBaseService,
+    _copy_upload_file,
+    _iter_file_paragraphs,
+)
+from app.core.config import settings
+
+
+def _reference_chunks(text: str) -> list:
+    """逐段拼接后再统一添加重叠的分块方式，作为对照"""
+    chunks = []
+    current_chunk = ""
+    for paragraph in text.split('\n\n'):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if len(current_chunk) + len(paragraph) > settings.CHUNK_SIZE:
+            if current_chunk:
+                chunks.append(current_chunk.strip())
+            current_chunk = paragraph
+        else:
+            current_chunk += "\n\n" + paragraph if current_chunk else paragraph
+    if current_chunk:
+        chunks.append(current_chunk.strip())
+    if not chunks:
+        chunks = [text]
+    
+    if len(chunks) > 1 and settings.CHUNK_OVERLAP > 0:
+        chunks = [
+            chunks[i - 1][-settings.CHUNK_OVERLAP:] + "\n\n" + chunk if i > 0 else chunk
+            for i, chunk in enumerate(chunks)
+        ]
+    return chunks
+
+
+class TestTextChunks:
+    """文本分块测试"""
+    
+    @pytest.fixture
+    def kb_service(self):
+        with patch('app.services.vector_service.qdrant_client.QdrantClient'):
+            return KnowledgeBaseService(Mock(spec=Session))
+    
+    def test_overlap_prepends_previous_tail(self, kb_service, monkeypatch):
+        monkeypatch.setattr(settings, "CHUNK_SIZE", 10)
+        monkeypatch.setattr(settings, "CHUNK_OVERLAP", 3)
+        text = "aaaaaaaa\n\nbbbbbbbb\n\ncccccccc"
+        
+        chunks = kb_service._create_text_chunks(text.split("\n\n"), "test.txt")
+        
+        assert chunks == ["aaaaaaaa", "aaa\n\nbbbbbbbb", "bbb\n\ncccccccc"]
+    
+    @pytest.mark.parametrize("overlap", [0, 1, 7, 50])
+    def test_matches_reference_chunking(self, kb_service, monkeypatch, overlap):
+        monkeypatch.setattr(settings, "CHUNK_SIZE", 40)
+        monkeypatch.setattr(settings, "CHUNK_OVERLAP", overlap)
+        rng = random.Random(overlap)
+        
+        texts = ["", "  \n\n \n\n", "单个段落", "x" * 100]
+        for _ in range(50):
+            texts.append("\n\n".join(
+                rng.choice(["", "  ", "段" * rng.randint(1, 45), " 前后空白 "])
+                for _ in range(rng.randint(1, 12))
+            ))
+        
+        for text in texts:
+            assert kb_service._create_text_chunks(text.split("\n\n"), "test.txt") == _reference_chunks(text)
+
+
+
+class TestCopyUploadFile:
+    """上传文件复制测试"""
+    
+    def test_in_memory_file_uses_copyfileobj(self, tmp_path):
+        """没有文件描述符的 BytesIO 不调用 sendfile"""
+        content = "内存中的上传内容".encode("utf-8") * 100
+        target = tmp_path / "upload.bin"
+        
+        with patch.object(knowledge_base_service.os, "sendfile", create=True) as mock_sendfile:
+            size = _copy_upload_file(io.BytesIO(content), str(target))
+        
+        mock_sendfile.assert_not_called()
+        assert size == len(content)
+        assert target.read_bytes() == content
+    
+    @pytest.mark.skipif(not hasattr(os, "sendfile"), reason="平台不支持 os.sendfile")
+    def test_file_with_descriptor_uses_sendfile(self, tmp_path):
+        content = os.urandom(3 * 1024 * 1024 + 17)
+        target = tmp_path / "upload.bin"
+        
+        with tempfile.TemporaryFile() as src:
+            src.write(content)
+            with patch.object(knowledge_base_service.os, "sendfile", wraps=os.sendfile) as mock_sendfile:
+                size = _copy_upload_file(src, str(target))
+        
+        mock_sendfile.assert_called()
+        assert size == len(content)
+        assert target.read_bytes() == content
+    
+    @pytest.mark.skipif(not hasattr(os, "sendfile"), reason="平台不支持 os.sendfile")
+    def test_sendfile_failure_falls_back(self, tmp_path):
+        """sendfile 中途失败时清空目标文件并分块复制"""
+        content = b"x" * 4096
+        target = tmp_path / "upload.bin"
+        
+        with tempfile.TemporaryFile() as src:
+            src.write(content)
+            with patch.object(knowledge_base_service.os, "sendfile", side_effect=OSError("not supported")):
+                size = _copy_upload_file(src, str(target))
+        
+        assert size == len(content)
+        assert target.read_bytes() == content
+
+
+
+class TestIterFileParagraphs:
+    """按块读取段落测试"""
+    
+    def _paragraphs(self, tmp_path, text: str) -> list:
+        path = tmp_path / "doc.txt"
+        path.write_bytes(text.encode("utf-8"))
+        return list(_iter_file_paragraphs(str(path)))
+    
+    @pytest.mark.parametrize("block_size", [1, 2, 3, 5])
+    def test_matches_split(self, tmp_path, monkeypatch, block_size):
+        """块很小时，跨块的分隔符和多字节字符仍与 text.split('\\n\\n') 一致"""
+        monkeypatch.setattr(knowledge_base_service, "_UPLOAD_CHUNK_SIZE", block_size)
+        rng = random.Random(block_size)
+        
+        texts = ["", "\n", "\n\n", "\n\n\n", "段落\n\n", "\n\n段落", "一\n\n\n\n二"]
+        for _ in range(100):
+            texts.append("".join(
+                rng.choice(["\n", "\n\n", "段", "a", " ", "é"])
+                for _ in range(rng.randint(0, 30))
+            ))
+        
+        for text in texts:
+            assert self._paragraphs(tmp_path, text) == text.split("\n\n")
+    
+    def test_multibyte_character_across_block_boundary(self, tmp_path, monkeypatch):
+        """三字节的汉字被块边界拆开时不会丢失或产生乱码"""
+        monkeypatch.setattr(knowledge_base_service, "_UPLOAD_CHUNK_SIZE", 4)
+        # "ab" 之后的 "段" 占第 3-5 字节，跨越第一个块的边界
+        text = "ab段落\n\n第二段"
+        
+        assert self._paragraphs(tmp_path, text) == ["ab段落", "第二段"]
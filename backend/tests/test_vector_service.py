@@ -3,7 +3,7 @@
 """
 import pytest
 import asyncio
-from unittest.mock import Mock, patch, AsyncMock
+from unittest.mock import Mock, MagicMock, patch, AsyncMock
 from sqlalchemy.orm import Session
 
 from app.services.vector_service import VectorService
@@ -38,17 +38,20 @@ class TestVectorService:
     async def test_get_text_embedding_with_openai(self, vector_service):
         """测试OpenAI文本向量化"""
         with patch('app.services.vector_service.settings.OPENAI_API_KEY', 'test_key'):
-            with patch('aiohttp.ClientSession') as mock_session:
+            mock_session = MagicMock()
+            with patch('app.services.vector_service.get_http_session', AsyncMock(return_value=mock_session)):
                 mock_response = AsyncMock()
                 mock_response.status = 200
                 mock_response.json = AsyncMock(return_value={
-                    "data": [{"embedding": [0.1] * settings.TEXT_EMBEDDING_DIMENSION}]
+                    "data": [{"index": 0, "embedding": [0.1] * settings.TEXT_EMBEDDING_DIMENSION}]
                 })
                 
-                mock_session.return_value.__aenter__.return_value.post.return_value.__aenter__.return_value = mock_response
+                mock_session.post.return_value.__aenter__.return_value = mock_response
                 
                 embedding = await vector_service.get_text_embedding("test text")
                 
+                assert mock_session.post.call_args.kwargs["json"]["input"] == ["test text"]
+                
                 assert len(embedding) == settings.TEXT_EMBEDDING_DIMENSION
                 assert all(x == 0.1 for x in embedding)
     
@@ -89,6 +92,65 @@ class TestVectorService:
                 assert result is True
                 mock_upsert.assert_called_once()
     
+    @staticmethod
+    def _text_chunk(chunk_id: str, content: str) -> Mock:
+        chunk = Mock(spec=TextChunk)
+        chunk.id = chunk_id
+        chunk.content = content
+        chunk.source_file = "test.txt"
+        chunk.chunk_index = 0
+        chunk.knowledge_base_id = "test-kb-id"
+        chunk.created_at.isoformat.return_value = "2024-01-01T00:00:00"
+        return chunk
+    
+    @pytest.mark.asyncio
+    async def test_vectorize_text_chunks_reuses_cache(self, vector_service, monkeypatch):
+        """缓存命中的分块不再请求向量，重复内容只请求一次，所有分块一次写入"""
+        from app.services import embedding_router
+        monkeypatch.setattr(embedding_router.settings, "EMBEDDING_CACHE_PATH", None)
+        embedding_router._embedding_cache.clear()
+        model = settings.TEXT_EMBEDDING_MODEL
+        await embedding_router.cache_embeddings([
+            (embedding_router.embedding_cache_key("cached", model), model, [0.25, 0.25])
+        ])
+        chunks = [
+            self._text_chunk("c1", "cached"),
+            self._text_chunk("c2", "duplicate"),
+            self._text_chunk("c3", "duplicate"),
+            self._text_chunk("c4", "new"),
+        ]
+        
+        fetch = AsyncMock(side_effect=lambda texts: [[0.5, -0.5] for _ in texts])
+        with patch.object(vector_service, '_fetch_text_embeddings', fetch):
+            with patch.object(vector_service.qdrant_client, 'upsert') as mock_upsert:
+                count = await vector_service.vectorize_text_chunks(chunks)
+        
+        assert count == 4
+        fetch.assert_awaited_once_with(["duplicate", "new"])
+        mock_upsert.assert_called_once()
+        points = mock_upsert.call_args.kwargs["points"]
+        assert [point.id for point in points] == ["c1", "c2", "c3", "c4"]
+        assert points[0].vector == pytest.approx([0.25, 0.25], abs=0.004)
+        assert points[1].vector == points[2].vector
+        embedding_router._embedding_cache.clear()
+    
+    @pytest.mark.asyncio
+    async def test_vectorize_text_chunks_fallback_not_cached(self, vector_service, monkeypatch):
+        """向量接口失败时使用降级向量，且不写入缓存"""
+        from app.services import embedding_router
+        monkeypatch.setattr(embedding_router.settings, "EMBEDDING_CACHE_PATH", None)
+        embedding_router._embedding_cache.clear()
+        chunks = [self._text_chunk("c1", "content")]
+        
+        with patch.object(vector_service, '_fetch_text_embeddings', AsyncMock(return_value=None)):
+            with patch.object(vector_service.qdrant_client, 'upsert') as mock_upsert:
+                count = await vector_service.vectorize_text_chunks(chunks)
+        
+        assert count == 1
+        points = mock_upsert.call_args.kwargs["points"]
+        assert points[0].vector == vector_service._simple_text_embedding("content")
+        assert len(embedding_router._embedding_cache) == 0
+    
     @pytest.mark.asyncio
     async def test_vectorize_image(self, vector_service):
         """测试图片向量化"""
@@ -107,13 +169,31 @@ class TestVectorService:
                 assert result is True
                 mock_upsert.assert_called_once()
     
+    @pytest.mark.asyncio
+    async def test_query_embeddings_use_shared_cache(self, vector_service, monkeypatch):
+        """查询向量写入共享向量缓存，重复查询只请求一次"""
+        from app.services import embedding_router
+        monkeypatch.setattr(embedding_router.settings, "EMBEDDING_CACHE_PATH", None)
+        embedding_router._embedding_cache.clear()
+        
+        fetch = AsyncMock(return_value=[[0.5, -0.5]])
+        with patch.object(vector_service, '_fetch_text_embeddings', fetch):
+            first = await vector_service.get_query_embeddings(["重复查询", "重复查询"])
+            second = await vector_service.get_query_embeddings(["重复查询"])
+        
+        fetch.assert_awaited_once_with(["重复查询"])
+        assert first == [second[0], second[0]]
+        assert second[0] == pytest.approx([0.5, -0.5], abs=0.004)
+        embedding_router._embedding_cache.clear()
+    
     @pytest.mark.asyncio
     async def test_search_text(self, vector_service):
         """测试文本搜索"""
         query = "test query"
         kb_ids = ["kb1", "kb2"]
         
-        with patch.object(vector_service, 'get_text_embedding', return_value=[0.1] * settings.TEXT_EMBEDDING_DIMENSION):
+        with patch.object(vector_service, 'get_query_embeddings',
+                          AsyncMock(return_value=[[0.1] * settings.TEXT_EMBEDDING_DIMENSION])) as mock_embed:
             with patch.object(vector_service.qdrant_client, 'search') as mock_search:
                 mock_result = Mock()
                 mock_result.id = "result1"
@@ -128,6 +208,8 @@ class TestVectorService:
                 
                 results = await vector_service.search_text(query, kb_ids)
                 
+                mock_embed.assert_awaited_once_with([query])
+                assert mock_search.call_args.kwargs["collection_name"] == "text_vectors"
                 assert len(results) == 1
                 assert results[0]["id"] == "result1"
                 assert results[0]["score"] == 0.95
@@ -139,7 +221,8 @@ class TestVectorService:
         query = "test query"
         kb_ids = ["kb1", "kb2"]
         
-        with patch.object(vector_service, 'get_text_embedding', return_value=[0.1] * settings.TEXT_EMBEDDING_DIMENSION):
+        with patch.object(vector_service, 'get_query_embeddings',
+                          AsyncMock(return_value=[[0.1] * settings.TEXT_EMBEDDING_DIMENSION])) as mock_embed:
             with patch.object(vector_service.qdrant_client, 'search') as mock_search:
                 mock_result = Mock()
                 mock_result.id = "result1"
@@ -153,11 +236,55 @@ class TestVectorService:
                 
                 results = await vector_service.search_image(query, kb_ids)
                 
+                mock_embed.assert_awaited_once_with([query])
+                assert mock_search.call_args.kwargs["collection_name"] == "image_vectors"
                 assert len(results) == 1
                 assert results[0]["id"] == "result1"
                 assert results[0]["score"] == 0.85
                 assert results[0]["filename"] == "test.jpg"
     
+    @pytest.mark.asyncio
+    async def test_search_text_batch(self, vector_service):
+        """测试批量文本搜索：一次向量化，一次批量检索"""
+        requests = [("query one", ["kb1"], 3), ("query two", [], 5)]
+        
+        with patch.object(vector_service, 'get_query_embeddings',
+                          AsyncMock(return_value=[[0.1] * settings.TEXT_EMBEDDING_DIMENSION] * 2)) as mock_embed:
+            with patch.object(vector_service.qdrant_client, 'search_batch') as mock_search_batch:
+                mock_result = Mock()
+                mock_result.id = "result1"
+                mock_result.score = 0.9
+                mock_result.payload = {
+                    "content": "test content",
+                    "source_file": "test.txt",
+                    "chunk_index": 0,
+                    "knowledge_base_id": "kb1"
+                }
+                mock_search_batch.return_value = [[mock_result], []]
+                
+                results = await vector_service.search_text_batch(requests)
+                
+                mock_embed.assert_awaited_once_with(["query one", "query two"])
+                mock_search_batch.assert_called_once()
+                search_requests = mock_search_batch.call_args.kwargs["requests"]
+                assert [request.limit for request in search_requests] == [3, 5]
+                assert search_requests[1].filter is None
+                assert results[0][0]["id"] == "result1"
+                assert results[1] == []
+    
+    @pytest.mark.asyncio
+    async def test_search_text_batch_error_returns_empty_results(self, vector_service):
+        """批量检索失败时每个查询返回空结果"""
+        requests = [("query one", ["kb1"], 3), ("query two", [], 5)]
+        
+        with patch.object(vector_service, 'get_query_embeddings',
+                          AsyncMock(return_value=[[0.1] * settings.TEXT_EMBEDDING_DIMENSION] * 2)):
+            with patch.object(vector_service.qdrant_client, 'search_batch',
+                              side_effect=RuntimeError("qdrant unavailable")):
+                results = await vector_service.search_text_batch(requests)
+        
+        assert results == [[], []]
+    
     @pytest.mark.asyncio
     async def test_hybrid_search(self, vector_service):
         """测试混合搜索"""